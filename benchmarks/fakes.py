@@ -0,0 +1,225 @@
+"""Локальные заглушки внешних сервисов для бенчмарков.
+
+Поднимает на localhost фейковую панель X-UI, API YooKassa и Telegram Bot
+API. У каждой заглушки настраивается задержка ответа, поэтому
+веб-приложение можно нагружать без сети и с предсказуемыми upstream'ами.
+
+    python -m benchmarks.fakes --xui-latency-ms 30 --yookassa-latency-ms 80
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+
+from aiohttp import web
+
+DEFAULT_PORTS = {"xui": 18081, "yookassa": 18082, "telegram": 18083}
+
+
+def with_latency(latency: float, jitter: float = 0.1):
+    """Middleware aiohttp: задержка ответа latency ± jitter·latency."""
+
+    @web.middleware
+    async def middleware(request, handler):
+        if latency:
+            spread = latency * jitter
+            await asyncio.sleep(latency + random.uniform(-spread, spread))
+        return await handler(request)
+
+    return middleware
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def create_xui_app(latency: float) -> web.Application:
+    """Панель X-UI: /login, /panel/inbound/list, /panel/api/inbounds/*.
+
+    Хранит inbound в памяти, поэтому enforcement и сборку устаревших
+    inbound можно прогонять против неё так же, как против панели.
+    """
+    inbounds = []
+    ids = itertools.count(1)
+
+    async def login(request):
+        return web.json_response({"success": True, "token": "fake-token"})
+
+    async def inbound_list(request):
+        return web.json_response({"success": True, "obj": inbounds})
+
+    async def inbound_add(request):
+        payload = await request.json()
+        if any(inb["port"] == payload["port"] for inb in inbounds):
+            return web.json_response(
+                {"success": False, "msg": "port exists"}, status=400
+            )
+        payload.update(id=next(ids), up=0, down=0)
+        inbounds.append(payload)
+        return web.json_response({"success": True, "obj": payload})
+
+    async def client_update(request):
+        return web.json_response({"success": True})
+
+    def find(request):
+        inbound_id = int(request.match_info["inbound_id"])
+        for inbound in inbounds:
+            if inbound["id"] == inbound_id:
+                return inbound
+        return None
+
+    async def inbound_update(request):
+        inbound = find(request)
+        if inbound is None:
+            return web.json_response({"success": False}, status=404)
+        inbound.update(await request.json(), id=inbound["id"])
+        return web.json_response({"success": True, "obj": inbound})
+
+    async def inbound_delete(request):
+        inbound = find(request)
+        if inbound is None:
+            return web.json_response({"success": False}, status=404)
+        inbounds.remove(inbound)
+        return web.json_response({"success": True})
+
+    app = web.Application(middlewares=[with_latency(latency)])
+    app.router.add_post("/login", login)
+    app.router.add_post("/panel/inbound/list", inbound_list)
+    app.router.add_post("/panel/api/inbounds/add", inbound_add)
+    app.router.add_post(
+        "/panel/api/inbounds/update/{inbound_id}", inbound_update
+    )
+    app.router.add_post("/panel/api/inbounds/del/{inbound_id}", inbound_delete)
+    app.router.add_post("/panel/api/client/update", client_update)
+    return app
+
+
+def create_yookassa_app(
+    latency: float, succeed_after: float
+) -> web.Application:
+    """API YooKassa v3: создание платежа и его статус.
+
+    Платёж становится succeeded через succeed_after секунд после создания.
+    """
+    payments = {}
+
+    def render(payment):
+        elapsed = time.monotonic() - payment["_created"]
+        status = "succeeded" if elapsed >= succeed_after else "pending"
+        body = {k: v for k, v in payment.items() if not k.startswith("_")}
+        body.update(status=status, paid=status == "succeeded")
+        return body
+
+    async def create(request):
+        params = await request.json()
+        payment_id = str(uuid.uuid4())
+        payments[payment_id] = {
+            "_created": time.monotonic(),
+            "id": payment_id,
+            "amount": params["amount"],
+            "description": params.get("description", ""),
+            "metadata": params.get("metadata", {}),
+            "recipient": {"account_id": "1", "gateway_id": "1"},
+            "created_at": now_iso(),
+            "confirmation": {
+                "type": "redirect",
+                "confirmation_url": f"https://yoomoney.local/{payment_id}",
+            },
+            "test": True,
+            "refundable": False,
+        }
+        return web.json_response(render(payments[payment_id]))
+
+    async def find_one(request):
+        payment = payments.get(request.match_info["payment_id"])
+        if payment is None:
+            return web.json_response(
+                {"type": "error", "code": "not_found"}, status=404
+            )
+        return web.json_response(render(payment))
+
+    app = web.Application(middlewares=[with_latency(latency)])
+    app.router.add_post("/v3/payments", create)
+    app.router.add_get("/v3/payments/{payment_id}", find_one)
+    return app
+
+
+def create_telegram_app(latency: float) -> web.Application:
+    """Telegram Bot API: любой метод отвечает ok, sendMessage — сообщением."""
+    message_ids = itertools.count(1)
+
+    async def method(request):
+        name = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if name.lower() != "sendmessage":
+            return web.json_response({"ok": True, "result": True})
+        chat_id = int(params.get("chat_id", 0))
+        return web.json_response(
+            {
+                "ok": True,
+                "result": {
+                    "message_id": next(message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": str(params.get("text", "")),
+                },
+            }
+        )
+
+    app = web.Application(middlewares=[with_latency(latency)])
+    app.router.add_post("/bot{token}/{method}", method)
+    return app
+
+
+async def serve(apps: dict, ports: dict) -> None:
+    runners = []
+    for name, app in apps.items():
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", ports[name]).start()
+        runners.append(runner)
+        print(json.dumps({"fake": name, "port": ports[name]}), flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        for runner in runners:
+            await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    for name, port in DEFAULT_PORTS.items():
+        parser.add_argument(f"--{name}-port", type=int, default=port)
+        parser.add_argument(f"--{name}-latency-ms", type=float, default=0.0)
+    parser.add_argument(
+        "--payment-succeed-after",
+        type=float,
+        default=0.0,
+        help="через сколько секунд платёж становится succeeded",
+    )
+    args = parser.parse_args()
+
+    ports = {name: getattr(args, f"{name}_port") for name in DEFAULT_PORTS}
+    apps = {
+        "xui": create_xui_app(args.xui_latency_ms / 1000),
+        "yookassa": create_yookassa_app(
+            args.yookassa_latency_ms / 1000, args.payment_succeed_after
+        ),
+        "telegram": create_telegram_app(args.telegram_latency_ms / 1000),
+    }
+    try:
+        asyncio.run(serve(apps, ports))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
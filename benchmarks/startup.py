@@ -0,0 +1,103 @@
+"""Бенчмарк времени импорта модулей бота и веб-приложения.
+
+Каждый модуль импортируется в отдельном интерпретаторе. Во время импорта
+аудит-хук следит за побочными эффектами: сетевыми соединениями,
+чтением .env и ключа сервисного аккаунта, настройкой корневого
+логгера. Любой такой эффект или превышение бюджета времени — ненулевой
+код выхода.
+
+    python -m benchmarks.startup --runs 5 --budget-ms 1500
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MODULES = [
+    "vpn_utils",
+    "tgbot.services.connect_table",
+    "bot",
+    "payment",
+    "miniapp.main",
+]
+
+PROBE = r"""
+import json, logging, sys, time
+
+events = []
+forbidden_files = (".env", "for_connect_table.json")
+
+
+def hook(event, args):
+    if event == "socket.connect":
+        events.append(f"socket.connect {args[1]!r}")
+    elif event == "open" and isinstance(args[0], str):
+        if args[0].endswith(forbidden_files):
+            events.append(f"open {args[0]}")
+
+
+sys.addaudithook(hook)
+start = time.perf_counter()
+__import__(sys.argv[1])
+elapsed = time.perf_counter() - start
+if logging.getLogger().handlers:
+    events.append("logging.basicConfig")
+print(json.dumps({"elapsed": elapsed, "side_effects": events}))
+"""
+
+
+def measure(module: str) -> dict:
+    """Импортирует модуль в чистом процессе и возвращает замер."""
+    wall_start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE, module],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    wall = time.perf_counter() - wall_start
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1:], "wall": wall}
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["wall"] = wall
+    return result
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=1500.0)
+    parser.add_argument("modules", nargs="*", default=MODULES)
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':<32}{'import, ms':>12}{'process, ms':>14}")
+    for module in args.modules:
+        samples = [measure(module) for _ in range(args.runs)]
+        errors = [s["error"] for s in samples if "error" in s]
+        if errors:
+            print(f"{module:<32}{'ERROR':>12}  {errors[0]}")
+            failed = True
+            continue
+
+        import_ms = statistics.median(s["elapsed"] for s in samples) * 1000
+        wall_ms = statistics.median(s["wall"] for s in samples) * 1000
+        print(f"{module:<32}{import_ms:>12.1f}{wall_ms:>14.1f}")
+
+        side_effects = sorted({e for s in samples for e in s["side_effects"]})
+        for effect in side_effects:
+            print(f"    побочный эффект при импорте: {effect}")
+        if side_effects or import_ms > args.budget_ms:
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
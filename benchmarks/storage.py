@@ -0,0 +1,258 @@
+"""Микробенчмарки операций SubscriptionManager на синтетических таблицах.
+
+Для каждого размера таблицы (по умолчанию 10k, 100k и 1M подписчиков) и
+каждого доступного хранилища прогоняет upsert_subscription, upsert_trial,
+get_user_uuid, increment_ref_count и check_expiration_dates. Печатает
+ops/sec, p50/p99 и пиковую память, а результат сохраняет в JSON, с
+которым можно сравнивать следующие прогоны.
+
+    python -m benchmarks.storage --out baseline_storage.json
+    python -m benchmarks.storage --sizes 10000 --baseline baseline_storage.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+from typing import Callable, Dict, List
+
+from tgbot.services.cache import SubscriberCache
+from tgbot.services.connect_table import COLUMNS, SubscriptionManager
+from tgbot.services.storage import MemoryWorksheet, SqliteWorksheet
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+
+def synthetic_records(size: int, seed: int = 42) -> List[dict]:
+    """Таблица подписчиков: активные, истёкшие, триалы, рефералы."""
+    rnd = random.Random(seed)
+    today = date.today()
+    records = []
+    for user_id in range(1, size + 1):
+        end = today + timedelta(days=rnd.randint(-200, 180))
+        has_trial = rnd.random() < 0.4
+        trial_start = today - timedelta(days=rnd.randint(0, 365))
+        records.append(
+            {
+                "user_id": user_id,
+                "username": f"user{user_id}",
+                "start_date": (end - timedelta(days=30)).strftime("%d.%m.%Y"),
+                "end_date": end.strftime("%d.%m.%Y"),
+                "start_trial_period": (
+                    trial_start.strftime("%d.%m.%Y") if has_trial else ""
+                ),
+                "end_trial_period": (
+                    (trial_start + timedelta(days=4)).strftime("%d.%m.%Y")
+                    if has_trial
+                    else ""
+                ),
+                "last_trial_used": (
+                    trial_start.strftime("%d.%m.%Y") if has_trial else ""
+                ),
+                "client_uuid": f"{user_id:08x}-0000-4000-8000-000000000000",
+                "client_uuid_pair": "",
+                "referrer_id": (
+                    rnd.randint(1, user_id) if rnd.random() < 0.2 else ""
+                ),
+                "ref_count": rnd.randint(0, 3),
+            }
+        )
+    return records
+
+
+def memory_backend(records: List[dict]):
+    return MemoryWorksheet.from_records(COLUMNS, records)
+
+
+def sqlite_backend(records: List[dict]):
+    fd, path = tempfile.mkstemp(suffix=".sqlite3")
+    os.close(fd)
+    return SqliteWorksheet.from_records(path, COLUMNS, records)
+
+
+# Хранилища, на которых гоняются операции: имя -> фабрика листа.
+BACKENDS: Dict[str, Callable] = {
+    "memory": memory_backend,
+    "sqlite": sqlite_backend,
+}
+
+
+class NullBot:
+    """Бот-заглушка: уведомления проверки подписок никуда не уходят."""
+
+    async def send_message(self, *args, **kwargs):
+        return None
+
+
+def operations(manager: SubscriptionManager, size: int, seed: int = 7):
+    rnd = random.Random(seed)
+    new_ids = iter(range(size + 1, size * 2 + 1))
+    bot = NullBot()
+
+    def existing() -> int:
+        return rnd.randint(1, size)
+
+    def upsert_subscription():
+        user_id = existing() if rnd.random() < 0.8 else next(new_ids)
+        manager.upsert_subscription(user_id, "bench", days=30)
+
+    def upsert_trial():
+        user_id = existing() if rnd.random() < 0.8 else next(new_ids)
+        manager.upsert_trial(user_id, "bench", days=3)
+
+    def get_user_uuid():
+        manager.get_user_uuid(existing())
+
+    def increment_ref_count():
+        manager.increment_ref_count(existing())
+
+    def check_expiration_dates():
+        asyncio.run(manager.check_expiration_dates(bot))
+
+    return {
+        "upsert_subscription": upsert_subscription,
+        "upsert_trial": upsert_trial,
+        "get_user_uuid": get_user_uuid,
+        "increment_ref_count": increment_ref_count,
+        "check_expiration_dates": check_expiration_dates,
+    }
+
+
+def measure(op: Callable, max_ops: int, max_seconds: float) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    while len(latencies) < max_ops:
+        start = time.perf_counter()
+        op()
+        latencies.append(time.perf_counter() - start)
+        if time.perf_counter() - started >= max_seconds:
+            break
+    total = time.perf_counter() - started
+
+    tracemalloc.start()
+    op()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+
+    def percentile(q: float) -> float:
+        index = min(len(latencies) - 1, int(len(latencies) * q))
+        return latencies[index] * 1000
+
+    return {
+        "ops": len(latencies),
+        "ops_per_sec": len(latencies) / total,
+        "p50_ms": percentile(0.50),
+        "p99_ms": percentile(0.99),
+        "peak_mem_bytes": peak,
+    }
+
+
+def run(args) -> List[dict]:
+    results = []
+    for size in args.sizes:
+        records = synthetic_records(size)
+        for backend_name in args.backends:
+            tracemalloc.start()
+            sheet = BACKENDS[backend_name](records)
+            _, table_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            manager = SubscriptionManager(
+                json_path="",
+                sheet_key="",
+                cache=SubscriberCache(),
+                sheet=sheet,
+            )
+            ops = operations(manager, size)
+            for op_name in args.ops or list(ops):
+                row = {
+                    "backend": backend_name,
+                    "size": size,
+                    "op": op_name,
+                    "table_peak_bytes": table_peak,
+                    **measure(ops[op_name], args.max_ops, args.max_seconds),
+                }
+                results.append(row)
+                print(
+                    f"{backend_name:<8}{size:>10}  {op_name:<24}"
+                    f"{row['ops_per_sec']:>10.1f}{row['p50_ms']:>10.2f}"
+                    f"{row['p99_ms']:>10.2f}"
+                    f"{row['peak_mem_bytes'] / 2 ** 20:>10.1f}",
+                    flush=True,
+                )
+        del records
+    return results
+
+
+def compare(results: List[dict], baseline_path: str, tolerance: float) -> int:
+    """Сравнивает ops/sec с базовым файлом; 1 — есть регрессии."""
+    with open(baseline_path) as f:
+        baseline = {
+            (r["backend"], r["size"], r["op"]): r
+            for r in json.load(f)["results"]
+        }
+    regressions = 0
+    for row in results:
+        base = baseline.get((row["backend"], row["size"], row["op"]))
+        if not base:
+            continue
+        ratio = row["ops_per_sec"] / base["ops_per_sec"]
+        if ratio < 1 - tolerance:
+            regressions += 1
+            print(
+                f"РЕГРЕССИЯ {row['backend']}/{row['size']}/{row['op']}: "
+                f"{base['ops_per_sec']:.1f} -> {row['ops_per_sec']:.1f} ops/s "
+                f"({(ratio - 1) * 100:+.0f}%)"
+            )
+    return 1 if regressions else 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument(
+        "--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS)
+    )
+    parser.add_argument("--ops", nargs="+")
+    parser.add_argument("--max-ops", type=int, default=200)
+    parser.add_argument("--max-seconds", type=float, default=5.0)
+    parser.add_argument("--out", help="записать результаты в JSON")
+    parser.add_argument("--baseline", help="сравнить с базовым JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    print(
+        f"{'backend':<8}{'size':>10}  {'operation':<24}"
+        f"{'ops/s':>10}{'p50, ms':>10}{'p99, ms':>10}{'peak, MB':>10}"
+    )
+    results = run(args)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "python": sys.version.split()[0],
+                        "platform": platform.platform(),
+                        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.baseline:
+        return compare(results, args.baseline, args.tolerance)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,282 @@
+"""Сквозной бенчмарк веб-приложения на локальных заглушках.
+
+Запускает benchmarks.fakes и miniapp.main:app (uvicorn) в отдельных
+процессах: X-UI, YooKassa и Telegram — заглушки, хранилище — в памяти.
+Затем подаёт нагрузку с постоянной частотой (open loop) на /,
+/api/create_trial и /create_payment и печатает p50/p99 и пропускную
+способность по каждому сценарию.
+
+    python -m benchmarks.web --rps 50 --duration 20 --workers 2
+    python -m benchmarks.web --scenario trial --json trial.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from benchmarks.fakes import DEFAULT_PORTS
+
+ROOT = Path(__file__).resolve().parent.parent
+APP_PORT = 18000
+
+
+@dataclass
+class Result:
+    scenario: str
+    target_rps: float
+    duration: float
+    sent: int = 0
+    ok: int = 0
+    errors: int = 0
+    dropped: int = 0
+    latencies: List[float] = field(default_factory=list, repr=False)
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return float("nan")
+        if len(self.latencies) == 1:
+            return self.latencies[0]
+        return statistics.quantiles(self.latencies, n=100)[q - 1]
+
+    def summary(self) -> dict:
+        data = asdict(self)
+        data.pop("latencies")
+        data.update(
+            throughput=self.ok / self.duration,
+            p50_ms=self.percentile(50) * 1000,
+            p99_ms=self.percentile(99) * 1000,
+        )
+        return data
+
+
+def make_scenarios(base_url: str) -> Dict[str, Callable]:
+    """Сценарии: функция (session, n) -> корутина одного запроса."""
+    trial_ids = itertools.count(10_000_000)
+    known_users = list(range(1, 1001))
+
+    def index(session, n):
+        user_id = random.choice(known_users)
+        return session.get(f"{base_url}/?user_id={user_id}")
+
+    def trial(session, n):
+        user_id = next(trial_ids)
+        return session.get(
+            f"{base_url}/api/create_trial",
+            params={"user_id": user_id, "username": f"bench{user_id}"},
+        )
+
+    def payment(session, n):
+        user_id = random.choice(known_users)
+        return session.post(
+            f"{base_url}/create_payment",
+            json={
+                "user_id": user_id,
+                "username": f"bench{user_id}",
+                "key": random.choice([1, 2, 3]),
+            },
+        )
+
+    return {"index": index, "trial": trial, "payment": payment}
+
+
+async def run_scenario(
+    name: str,
+    request_factory: Callable,
+    rps: float,
+    duration: float,
+    max_in_flight: int,
+) -> Result:
+    """Открытая модель нагрузки: запросы уходят по расписанию, не ожидая
+    ответов; при max_in_flight незавершённых запрос считается dropped."""
+    result = Result(name, rps, duration)
+    in_flight = set()
+    connector = TCPConnector(limit=max_in_flight)
+    timeout = ClientTimeout(total=60)
+
+    async with ClientSession(connector=connector, timeout=timeout) as session:
+
+        async def one(n: int) -> None:
+            start = time.perf_counter()
+            try:
+                async with request_factory(session, n) as response:
+                    await response.read()
+                    if response.status < 400:
+                        result.ok += 1
+                        result.latencies.append(time.perf_counter() - start)
+                    else:
+                        result.errors += 1
+            except Exception:
+                result.errors += 1
+
+        start = time.perf_counter()
+        for n in itertools.count():
+            scheduled = start + n / rps
+            if scheduled - start >= duration:
+                break
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            if len(in_flight) >= max_in_flight:
+                result.dropped += 1
+                continue
+            result.sent += 1
+            task = asyncio.create_task(one(n))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+        if in_flight:
+            await asyncio.wait(in_flight)
+    return result
+
+
+def start_process(args: List[str], env: dict, log_path: Path):
+    log = open(log_path, "w")
+    return subprocess.Popen(
+        args, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+
+async def wait_ready(url: str, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as response:
+                    if response.status < 500:
+                        return
+            except OSError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} не поднялся за {timeout} с")
+
+
+def app_env(args, workdir: Path) -> dict:
+    env = dict(os.environ)
+    env.update(
+        BOT_TOKEN="42:bench",
+        ADMINS="1",
+        USE_REDIS="false",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{DEFAULT_PORTS['telegram']}",
+        HOST=f"http://127.0.0.1:{DEFAULT_PORTS['xui']}",
+        LOGIN="admin",
+        PASSWORD="admin",
+        IP="127.0.0.1",
+        YOOKASSA_SHOP_ID="100500",
+        YOOKASSA_SECRET_KEY="test_bench",
+        YOOKASSA_API_URL=f"http://127.0.0.1:{DEFAULT_PORTS['yookassa']}/v3",
+        STORAGE_BACKEND="memory",
+        STORAGE_LATENCY_MS=str(args.storage_latency_ms),
+        LOCK_DIR=str(workdir / "locks"),
+        PROMETHEUS_MULTIPROC_DIR=str(workdir / "prometheus"),
+        SLOW_REQUEST_THRESHOLD="5",
+    )
+    (workdir / "prometheus").mkdir(exist_ok=True)
+    return env
+
+
+async def main_async(args) -> List[Result]:
+    workdir = Path(tempfile.mkdtemp(prefix="vpnbot-bench-"))
+    fakes = start_process(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.fakes",
+            "--xui-latency-ms",
+            str(args.xui_latency_ms),
+            "--yookassa-latency-ms",
+            str(args.yookassa_latency_ms),
+            "--telegram-latency-ms",
+            str(args.telegram_latency_ms),
+        ],
+        dict(os.environ),
+        workdir / "fakes.log",
+    )
+    app = start_process(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "miniapp.main:app",
+            "--port",
+            str(APP_PORT),
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+        ],
+        app_env(args, workdir),
+        workdir / "app.log",
+    )
+    base_url = f"http://127.0.0.1:{APP_PORT}"
+    try:
+        await wait_ready(f"{base_url}/trial")
+        scenarios = make_scenarios(base_url)
+        names = list(scenarios) if args.scenario == "all" else [args.scenario]
+        results = []
+        for name in names:
+            results.append(
+                await run_scenario(
+                    name,
+                    scenarios[name],
+                    args.rps,
+                    args.duration,
+                    args.max_in_flight,
+                )
+            )
+        return results
+    finally:
+        for proc in (app, fakes):
+            proc.terminate()
+            proc.wait(timeout=10)
+        print(f"логи: {workdir}", file=sys.stderr)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--scenario",
+        choices=["all", "index", "trial", "payment"],
+        default="all",
+    )
+    parser.add_argument("--rps", type=float, default=20)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--xui-latency-ms", type=float, default=20)
+    parser.add_argument("--yookassa-latency-ms", type=float, default=50)
+    parser.add_argument("--telegram-latency-ms", type=float, default=20)
+    parser.add_argument("--storage-latency-ms", type=float, default=100)
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    args = parser.parse_args()
+
+    results = asyncio.run(main_async(args))
+
+    header = (
+        f"{'scenario':<10}{'rps':>8}{'sent':>8}{'ok':>8}{'err':>6}"
+        f"{'drop':>6}{'thr/s':>9}{'p50, ms':>10}{'p99, ms':>10}"
+    )
+    print(header)
+    for result in results:
+        s = result.summary()
+        print(
+            f"{s['scenario']:<10}{s['target_rps']:>8.1f}{s['sent']:>8}"
+            f"{s['ok']:>8}{s['errors']:>6}{s['dropped']:>6}"
+            f"{s['throughput']:>9.1f}{s['p50_ms']:>10.1f}{s['p99_ms']:>10.1f}"
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([r.summary() for r in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
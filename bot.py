@@ -1,24 +1,62 @@
 import asyncio
 import logging
+import os
+from functools import lru_cache
 
 import betterlogging as bl
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
-from aiogram.types import (BotCommand, BotCommandScopeDefault,
-                           MenuButtonCommands)
+from aiogram.types import (
+    BotCommand,
+    BotCommandScopeDefault,
+    MenuButtonCommands,
+)
 
-from tgbot.config import Config, load_config
+from tgbot.config import Config, get_config
 from tgbot.handlers import user_router
+from tgbot.misc.events import registered_commands
 from tgbot.middlewares.config import ConfigMiddleware
+from tgbot.middlewares.metrics import TelegramMetricsMiddleware
+from tgbot.middlewares.throttling import (
+    MemoryBucketStorage,
+    RedisBucketStorage,
+    Rate,
+    ThrottlingMiddleware,
+)
+from tgbot.middlewares.timing import TimingMiddleware
 from tgbot.services import broadcaster
+from tgbot.services.connect_table import catch_up_subscribers
+from tgbot.services.metrics import start_metrics_server
+from tgbot.services.redis_client import get_async_redis
+from tgbot.services.tasks import get_task_supervisor
+
+
+@lru_cache(maxsize=None)
+def get_bot() -> Bot:
+    """Возвращает общий экземпляр Bot, создавая его при первом обращении."""
+    config = get_config()
+    session = None
+    if config.tg_bot.api_url:
+        session = AiohttpSession(
+            api=TelegramAPIServer.from_base(config.tg_bot.api_url)
+        )
+    bot = Bot(
+        token=config.tg_bot.token,
+        session=session,
+        default=DefaultBotProperties(parse_mode="HTML"),
+    )
+    bot.session.middleware(TelegramMetricsMiddleware())
+    return bot
 
-config = load_config(".env")
 
-bot = Bot(
-    token=config.tg_bot.token, default=DefaultBotProperties(parse_mode="HTML")
-)
+async def close_bot() -> None:
+    """Закрывает HTTP-сессию бота, если он был создан."""
+    if get_bot.cache_info().currsize:
+        await get_bot().session.close()
 
 
 async def on_startup(bot: Bot, admin_ids: list[int]):
@@ -35,6 +73,16 @@ def register_global_middlewares(
     dp: Dispatcher, config: Config, session_pool=None
 ):
     middleware_types = [
+        TimingMiddleware(registered_commands(dp)),
+        ThrottlingMiddleware(
+            get_throttling_storage(config),
+            default_rate=Rate(limit=5, period=1),
+            rates={
+                "/start": Rate(limit=2, period=10),
+                "our_reff_link": Rate(limit=1, period=10),
+                "to_check": Rate(limit=1, period=60),
+            },
+        ),
         ConfigMiddleware(config),
     ]
     for middleware_type in middleware_types:
@@ -48,8 +96,8 @@ def setup_logging():
     logging.basicConfig(
         level=logging.INFO,
         format="%(filename)s:%(lineno)d "
-               "#%(levelname)-8s "
-               "[%(asctime)s] - %(name)s - %(message)s",
+        "#%(levelname)-8s "
+        "[%(asctime)s] - %(name)s - %(message)s",
     )
     logger = logging.getLogger(__name__)
     logger.info("Starting bot")
@@ -65,14 +113,29 @@ def get_storage(config):
         return MemoryStorage()
 
 
+def get_throttling_storage(config):
+    if config.tg_bot.use_redis:
+        return RedisBucketStorage(get_async_redis())
+    return MemoryBucketStorage()
+
+
 async def main():
     setup_logging()
+    config = get_config()
+    start_metrics_server()
+    bot = get_bot()
     storage = get_storage(config)
     dp = Dispatcher(storage=storage)
     dp.include_router(user_router)
     register_global_middlewares(dp, config)
     await on_startup(bot, config.tg_bot.admin_ids)
-    await dp.start_polling(bot)
+    supervisor = get_task_supervisor()
+    supervisor.spawn("jobs", catch_up_subscribers(), name="catch_up")
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await supervisor.drain(float(os.getenv("SHUTDOWN_TIMEOUT", "20")))
+        await close_bot()
 
 
 if __name__ == "__main__":
@@ -16,6 +16,9 @@ TARIFFS = {
     },
 }
 
+# Скидка за рефералов: (от скольких приглашённых, процент), по убыванию.
+REFERRAL_DISCOUNTS = ((21, 100), (10, 25), (5, 10))
+
 SCOPE = [
     "https://spreadsheets.google.com/feeds",
     "https://www.googleapis.com/auth/drive",
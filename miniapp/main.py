@@ -1,27 +1,319 @@
 import asyncio
+import hashlib
+import hmac
+import json
 import logging
+import os
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple
 
 import uvicorn
+from dotenv import load_dotenv
 from fastapi import BackgroundTasks, FastAPI, HTTPException, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 
-from bot import bot
+from bot import close_bot, get_bot, get_config
 from constants import TARIFFS
-from vpn_utils import Connection
+from payment import get_payment_manager
+from tgbot.services.analytics import get_analytics
+from tgbot.services.connect_table import (
+    COLUMNS,
+    catch_up_subscribers,
+    get_subscription_manager,
+    upsert_trial_period,
+)
+from tgbot.services.coordination import (
+    LockLost,
+    LockNotAcquired,
+    get_coordinator,
+)
+from tgbot.services.enforcement import EnforcementSweeper
+from tgbot.services.inbound_gc import StaleInboundCollector
+from tgbot.services.journal import get_subscriber_views
+from tgbot.services.metrics import REQUEST_LATENCY, render_metrics
+from tgbot.services.quota import Priority, sheets_priority
+from tgbot.services.resilience import CircuitOpen
+from tgbot.services.sheet_sync import get_sheet_sync
+from tgbot.services.singleflight import get_single_flight
+from tgbot.services.subscriptions import (
+    get_subscription_feed,
+    subscription_hint,
+)
+from tgbot.services.tasks import TaskRejected, get_task_supervisor
+from tgbot.services.tracing import log_if_slow, trace
+from tgbot.services.traffic import (
+    TrafficCollector,
+    get_traffic_store,
+    human_bytes,
+)
+from tgbot.services.webapp_auth import InvalidInitData, get_init_data_validator
+from vpn_utils import Connection, panel_available
 
 BASE_DIR = Path(__file__).resolve().parent
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s] %(levelname)s — %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+def setup_logging() -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s — %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+
+
+async def run_expiry_check() -> None:
+    admin_ids = get_config().tg_bot.admin_ids
+    await get_subscription_manager().check_expiration_dates(
+        get_bot(), admin_ids[0] if admin_ids else None
+    )
+
+
+async def run_traffic_collect() -> None:
+    collector = TrafficCollector(get_traffic_store(), Connection)
+    await asyncio.to_thread(collector.collect)
+
+
+async def run_snapshot() -> None:
+    with sheets_priority(Priority.ADMIN):
+        await asyncio.to_thread(get_subscription_manager().refresh_snapshot)
+
+
+async def run_expiry_enforcement() -> None:
+    sweeper = EnforcementSweeper(
+        Connection, get_subscription_manager().get_live_records
+    )
+    with sheets_priority(Priority.ADMIN):
+        await sweeper.sweep()
+
+
+async def run_deferred_activations() -> None:
+    with sheets_priority(Priority.PAYMENT):
+        await get_payment_manager().run_deferred_activations()
+
+
+async def run_payment_check_resume() -> None:
+    await get_payment_manager().resume_payment_checks()
+
+
+async def run_inbound_gc() -> None:
+    collector = StaleInboundCollector(
+        Connection,
+        get_subscription_manager(),
+        grace_days=int(os.getenv("INBOUND_GC_DAYS", "14")),
+    )
+    with sheets_priority(Priority.ADMIN):
+        await collector.collect()
+
+
+async def run_journal_reconcile() -> None:
+    with sheets_priority(Priority.ADMIN):
+        events = await asyncio.to_thread(
+            get_subscriber_views().reconcile,
+            get_subscription_manager().get_live_records,
+            COLUMNS,
+        )
+    if events:
+        logging.info("Журнал сверен с таблицей: %s событий", events)
+
+
+async def run_sheet_sync() -> None:
+    manager = get_subscription_manager()
+    with sheets_priority(Priority.ADMIN):
+        report = await asyncio.to_thread(
+            get_sheet_sync().sync, manager.cache.invalidate
+        )
+    if report.changed:
+        get_subscription_feed().invalidate()
+
+
+def start_background_jobs() -> None:
+    """Фоновые задачи-одиночки; выполняет их только воркер-лидер."""
+    coordinator = get_coordinator()
+    supervisor = get_task_supervisor()
+    jobs = [
+        ("expiry_check", run_expiry_check, 24 * 3600),
+        (
+            "traffic_collect",
+            run_traffic_collect,
+            int(os.getenv("TRAFFIC_COLLECT_INTERVAL", "300")),
+        ),
+        (
+            "expiry_enforcement",
+            run_expiry_enforcement,
+            int(os.getenv("ENFORCEMENT_INTERVAL", "3600")),
+        ),
+        ("inbound_gc", run_inbound_gc, 24 * 3600),
+        (
+            "subscriber_snapshot",
+            run_snapshot,
+            int(os.getenv("SNAPSHOT_INTERVAL", "600")),
+        ),
+        (
+            "journal_reconcile",
+            run_journal_reconcile,
+            int(os.getenv("JOURNAL_RECONCILE_INTERVAL", "3600")),
+        ),
+        (
+            "deferred_activations",
+            run_deferred_activations,
+            int(os.getenv("DEFERRED_RETRY_INTERVAL", "30")),
+        ),
+        (
+            "payment_check_resume",
+            run_payment_check_resume,
+            int(os.getenv("DEFERRED_RETRY_INTERVAL", "30")),
+        ),
+    ]
+    if os.getenv("STORAGE_BACKEND") == "sqlite":
+        # Рабочая база локальная, лист сводится с ней фоном.
+        jobs.append(
+            (
+                "sheet_sync",
+                run_sheet_sync,
+                int(os.getenv("SHEET_SYNC_INTERVAL", "60")),
+            )
+        )
+    for name, job, interval in jobs:
+        supervisor.spawn(
+            "jobs", coordinator.run_as_leader(name, job, interval), name=name
+        )
+    supervisor.spawn("jobs", catch_up_subscribers(), name="catch_up")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Запуск и остановка приложения: окружение, клиенты, сессии."""
+    setup_logging()
+    load_dotenv()
+    get_config()
+    get_payment_manager()
+    start_background_jobs()
+    logging.info("Веб-приложение запущено")
+    try:
+        yield
+    finally:
+        await get_task_supervisor().drain(
+            float(os.getenv("SHUTDOWN_TIMEOUT", "20"))
+        )
+        await close_bot()
+        logging.info("Веб-приложение остановлено")
+
+
+def get_account_view(user_id: int) -> dict:
+    """Данные личного кабинета; кэшируются вместе с записью подписчика."""
+    manager = get_subscription_manager()
+
+    def build() -> dict:
+        record = manager.get_record(user_id) or {}
+        ref_count = int(record.get("ref_count", 0) or 0)
+        discount = get_payment_manager().get_discount_by_ref_count(ref_count)
+        return {
+            "end_date": record.get("end_date") or None,
+            "ref_count": ref_count,
+            "discount": discount,
+        }
+
+    return manager.cache.get("account", user_id, build)
+
+
+def get_me_view(user_id: int) -> dict:
+    """Ответ /api/me: данные кабинета и трафик, если он был."""
+    usage = get_traffic_store().usage(user_id)
+    traffic = None
+    if usage["total"]:
+        traffic = {key: human_bytes(value) for key, value in usage.items()}
+    return {**get_account_view(user_id), "traffic": traffic}
+
+
+async def activate_trial(user_id: int, username: str) -> str:
+    """Создаёт пробное подключение и возвращает текст для страницы."""
+    if not get_subscription_manager().trials.is_eligible(user_id):
+        return "⛔ Вы уже использовали пробный период."
+    if not panel_available():
+        return "❌ Сервер временно недоступен. Попробуйте через минуту."
+
+    x3 = Connection()
+    result = await asyncio.to_thread(
+        x3.create_inbound, user_id=user_id, is_trial=True
+    )
+    if not result:
+        return "❌ Не удалось создать подключение. Попробуйте позже."
+
+    uuid, port = result["uuid"], result["port"]
+    ip = "82.117.243.199"
+
+    with sheets_priority(Priority.TRIAL):
+        success = await asyncio.to_thread(
+            upsert_trial_period, user_id, username, days=3, client_uuid=uuid
+        )
+    if not success:
+        # Индекс этой реплики не знал о прошлом триале: подключение, не
+        # записанное в таблицу, не должно остаться на панели.
+        await asyncio.to_thread(x3.discard_inbounds, [result])
+        return "⛔ Вы уже использовали пробный период."
+    get_subscription_feed().invalidate()
+
+    link = (
+        f"vless://{uuid}@{ip}:{port}?type=tcp&security=reality"
+        f"&pbk=2UqLjQFhlvLcY7VzaKRotIDQFOgAJe1dYD1njigp9wk"
+        f"&fp=chrome&sni=yahoo.com&sid=47595474&spx=%2F"
+        f"#user_{user_id}-{user_id}_prob"
+    )
+
+    try:
+        await get_bot().send_message(
+            user_id,
+            "Пробная подписка активирована!\n"
+            f"🔗 Ваша ссылка на подключение (3 дня):"
+            f"\n\n<pre>{link}</pre>\n\n"
+            + subscription_hint(result.get("sub_id"))
+            + "Если возникли трудности — @BlackGateSupp",
+            parse_mode="HTML",
+        )
+        logging.info("Ссылка отправлена в Telegram: user_id=%s", user_id)
+    except Exception as e:
+        logging.error("Ошибка отправки в Telegram: %s", e)
+
+    return "Ссылка отправлена вам в Telegram."
+
+
+async def start_payment(
+    user_id: int, username: str, tariff: str
+) -> Tuple[Optional[str], Optional[str]]:
+    """Создаёт платёж и запускает проверку его оплаты.
+
+    Одновременные запросы одного пользователя на тот же тариф (двойное
+    нажатие, /create_payment и /payment_redirect) сливаются в один
+    платёж с одной задачей проверки.
+    """
+
+    async def run() -> Tuple[Optional[str], Optional[str]]:
+        payments = get_payment_manager()
+        supervisor = get_task_supervisor()
+        # Без свободного слота проверки платёж не создаём: его никто не
+        # активирует.
+        if not supervisor.has_capacity("payment_checks"):
+            raise TaskRejected("payment_checks")
+        with sheets_priority(Priority.PAYMENT):
+            payment_id, payment_url = await asyncio.to_thread(
+                payments.create_payment, user_id=user_id, tariff=tariff
+            )
+        if payment_id:
+            supervisor.spawn(
+                "payment_checks",
+                payments.check_payment_loop(
+                    payment_id, user_id, username, TARIFFS[tariff]["days"]
+                ),
+                name=f"payment:{payment_id}",
+            )
+        return payment_id, payment_url
+
+    return tuple(
+        await get_single_flight().do("payment", f"{user_id}:{tariff}", run)
+    )
 
 
 class TrialRequest(BaseModel):
@@ -32,41 +324,114 @@ class TrialRequest(BaseModel):
 
 class VPNWebApp:
     def __init__(self):
-        self.app = FastAPI(title="VPN Web Backend")
+        self.app = FastAPI(title="VPN Web Backend", lifespan=lifespan)
         self.templates = Jinja2Templates(directory=BASE_DIR / "templates")
         self.app.mount(
             "/static",
             StaticFiles(directory=BASE_DIR / "static"),
             name="static",
         )
+        # Оболочка кабинета статична: отдаётся из памяти с ETag.
+        self.account_shell = (
+            BASE_DIR / "static" / "personal_account.html"
+        ).read_bytes()
+        self.account_etag = f'"{hashlib.sha1(self.account_shell).hexdigest()}"'
+        self._add_middlewares()
         self._add_routes()
 
+    def _add_middlewares(self):
+        @self.app.middleware("http")
+        async def timing(request: Request, call_next):
+            """Полное время запроса и разбивка медленных по зависимостям."""
+            try:
+                with trace(f"{request.method} {request.url.path}") as root:
+                    return await call_next(request)
+            finally:
+                route = request.scope.get("route")
+                name = getattr(route, "path", "unmatched")
+                root.name = f"{request.method} {name}"
+                REQUEST_LATENCY.labels("http", root.name).observe(
+                    root.duration
+                )
+                log_if_slow(root)
+
     def _add_routes(self):
         @self.app.get("/", response_class=HTMLResponse)
-        async def index(request: Request, user_id: Optional[int] = None):
-            """Личный кабинет пользователя."""
-            end_date_str, ref_count, discount = None, 0, 0
-
-            if user_id:
-                sheet = connect_to_google_sheets()
-                records = sheet.get_all_records()
-                for record in records:
-                    if str(record.get("user_id")) == str(user_id):
-                        end_date_str = record.get("end_date")
-                        ref_count = int(record.get("ref_count", 0))
-                        discount = get_discount_by_ref_count(ref_count)
-                        break
-
-            return self.templates.TemplateResponse(
-                "personal_account.html",
-                {
-                    "request": request,
-                    "end_date": end_date_str,
-                    "ref_count": ref_count,
-                    "discount": discount,
-                },
+        async def index(request: Request):
+            """Оболочка личного кабинета; данные она берёт из /api/me."""
+            headers = {
+                "ETag": self.account_etag,
+                "Cache-Control": "public, max-age=86400",
+            }
+            if request.headers.get("if-none-match") == self.account_etag:
+                return Response(status_code=304, headers=headers)
+            return HTMLResponse(self.account_shell, headers=headers)
+
+        @self.app.get("/api/me")
+        async def me(request: Request):
+            """Данные кабинета пользователя, подписанного initData."""
+            init_data = request.headers.get("x-telegram-init-data", "")
+            authorization = request.headers.get("authorization", "")
+            if authorization.startswith("tma "):
+                init_data = authorization[len("tma ") :]
+            try:
+                user = get_init_data_validator().validate(init_data)
+            except InvalidInitData:
+                raise HTTPException(status_code=401)
+            view = await asyncio.to_thread(get_me_view, int(user["id"]))
+            body = json.dumps(
+                view, ensure_ascii=False, separators=(",", ":")
+            ).encode()
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            headers = {
+                "ETag": etag,
+                "Cache-Control": "private, no-cache",
+                "Vary": "Authorization, X-Telegram-Init-Data",
+            }
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers=headers)
+            return Response(
+                body, media_type="application/json", headers=headers
             )
 
+        @self.app.get("/metrics", include_in_schema=False)
+        async def metrics():
+            """Метрики в формате Prometheus."""
+            body, content_type = render_metrics()
+            return Response(body, media_type=content_type)
+
+        @self.app.get("/api/admin/stats", include_in_schema=False)
+        async def admin_stats(request: Request):
+            """Статистика подписчиков для админки (ADMIN_API_TOKEN)."""
+            token = os.getenv("ADMIN_API_TOKEN")
+            if not token:
+                raise HTTPException(status_code=404)
+            supplied = request.headers.get("x-admin-token") or ""
+            authorization = request.headers.get("authorization", "")
+            if authorization.startswith("Bearer "):
+                supplied = authorization[len("Bearer ") :]
+            if not hmac.compare_digest(supplied.encode(), token.encode()):
+                raise HTTPException(status_code=403)
+            with sheets_priority(Priority.ADMIN):
+                return await asyncio.to_thread(get_analytics().stats)
+
+        @self.app.get("/sub/{sub_id}", include_in_schema=False)
+        async def subscription(request: Request, sub_id: str):
+            """Подписка для VPN-клиентов: актуальные ссылки в base64."""
+            feed = get_subscription_feed()
+            entry = await asyncio.to_thread(feed.get, sub_id)
+            if entry is None:
+                raise HTTPException(status_code=404)
+            etag, body = entry
+            headers = {
+                "ETag": etag,
+                "Cache-Control": "no-cache",
+                "Profile-Update-Interval": "12",
+            }
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers=headers)
+            return Response(body, media_type="text/plain", headers=headers)
+
         @self.app.get("/trial", response_class=HTMLResponse)
         async def trial_page(request: Request):
             """Страница пробного периода"""
@@ -90,61 +455,23 @@ class VPNWebApp:
                 username,
             )
 
-            x3 = Connection()
-            result = x3.create_inbound(user_id=user_id, is_trial=True)
-            if not result:
-                return self.templates.TemplateResponse(
-                    "trail_link.html",
-                    {
-                        "request": request,
-                        "link": "❌ Не удалось создать подключение."
-                                " Попробуйте позже.",
-                    },
-                )
-
-            uuid, port = result["uuid"], result["port"]
-            ip = "82.117.243.199"
-
-            success = upsert_trial_period(
-                user_id, username, days=3, client_uuid=uuid
-            )
-            if not success:
-                return self.templates.TemplateResponse(
-                    "trail_link.html",
-                    {
-                        "request": request,
-                        "link": "⛔ Вы уже использовали пробный период.",
-                    },
-                )
-
-            link = (
-                f"vless://{uuid}@{ip}:{port}?type=tcp&security=reality"
-                f"&pbk=2UqLjQFhlvLcY7VzaKRotIDQFOgAJe1dYD1njigp9wk"
-                f"&fp=chrome&sni=yahoo.com&sid=47595474&spx=%2F"
-                f"#user_{user_id}-{user_id}_prob"
-            )
+            async def run() -> str:
+                try:
+                    async with get_coordinator().user_lock(
+                        user_id, timeout=10
+                    ):
+                        message = await activate_trial(user_id, username)
+                except LockLost as e:
+                    logging.warning("Триал выдан без блокировки %s", e)
+                return message
 
             try:
-                await bot.send_message(
-                    user_id,
-                    "Пробная подписка активирована!\n"
-                    f"🔗 Ваша ссылка на подключение (3 дня):"
-                    f"\n\n<pre>{link}</pre>\n\n"
-                    "Если возникли трудности — @BlackGateSupp",
-                    parse_mode="HTML",
-                )
-                logging.info(
-                    "Ссылка отправлена в Telegram: user_id=%s", user_id
-                )
-            except Exception as e:
-                logging.error("Ошибка отправки в Telegram: %s", e)
+                message = await get_single_flight().do("trial", user_id, run)
+            except LockNotAcquired:
+                message = "⏳ Запрос уже обрабатывается. Попробуйте позже."
 
             return self.templates.TemplateResponse(
-                "trail_link.html",
-                {
-                    "request": request,
-                    "link": "Ссылка отправлена вам в Telegram.",
-                },
+                "trail_link.html", {"request": request, "link": message}
             )
 
         @self.app.post("/create_payment", response_class=HTMLResponse)
@@ -161,21 +488,20 @@ class VPNWebApp:
                     status_code=400, detail="❌ Неверный ключ тарифа"
                 )
 
-            days = TARIFFS[tariff]["days"]
-            payment_id, payment_url = create_tariff_payment(
-                user_id=data.user_id, tariff=tariff
-            )
+            try:
+                payment_id, payment_url = await start_payment(
+                    data.user_id, data.username, tariff
+                )
+            except (TaskRejected, CircuitOpen):
+                raise HTTPException(
+                    status_code=503,
+                    detail="⏳ Сервис временно недоступен, попробуйте позже",
+                )
             if not payment_id:
                 raise HTTPException(
                     status_code=500, detail="❌ Ошибка создания платежа"
                 )
 
-            asyncio.create_task(
-                check_payment_loop(
-                    payment_id, data.user_id, data.username, bot, days
-                )
-            )
-
             return self.templates.TemplateResponse(
                 "payment_redirect.html",
                 {"request": request, "payment_url": payment_url},
@@ -195,7 +521,6 @@ class VPNWebApp:
                     raise ValueError("invalid tariff")
 
                 user_id = int(user_id_str)
-                days = TARIFFS[tariff]["days"]
 
             except Exception:
                 raise HTTPException(
@@ -203,13 +528,13 @@ class VPNWebApp:
                 )
 
             try:
-                payment_id, payment_url = create_tariff_payment(
-                    user_id=user_id, tariff=tariff
+                payment_id, payment_url = await start_payment(
+                    user_id, username, tariff
                 )
-                asyncio.create_task(
-                    check_payment_loop(
-                        payment_id, user_id, username, bot, days
-                    )
+            except (TaskRejected, CircuitOpen):
+                raise HTTPException(
+                    status_code=503,
+                    detail="⏳ Сервис временно недоступен, попробуйте позже",
                 )
             except Exception as e:
                 raise HTTPException(
@@ -227,4 +552,4 @@ app_instance = VPNWebApp()
 app = app_instance.app
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run("miniapp.main:app", host="0.0.0.0", port=8000, reload=True)
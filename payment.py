@@ -1,53 +1,145 @@
 import asyncio
 import logging
 import os
-from datetime import datetime, timedelta
-from typing import Any, Dict, Optional, Tuple
+import threading
+import uuid
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, Optional, Tuple
 
+from aiogram import Bot
 from aiogram.exceptions import TelegramAPIError
-from dotenv import load_dotenv
 from yookassa import Configuration, Payment
-from yookassa.domain.exceptions import (ApiError, BadRequestError,
-                                        NotFoundError, TooManyRequestsError,
-                                        UnauthorizedError)
-
-from bot import bot
-from constants import TARIFFS
-from tgbot.services.connect_table import (connect_to_google_sheets,
-                                          get_user_uuid, parse_date,
-                                          upsert_subscription_to_sheet)
-from vpn_utils import Connection
-
-load_dotenv()
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s] %(levelname)s — %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
+from yookassa.domain.exceptions import (
+    ApiError,
+    BadRequestError,
+    ForbiddenError,
+    NotFoundError,
+    TooManyRequestsError,
+    UnauthorizedError,
 )
 
+from bot import get_bot
+from constants import REFERRAL_DISCOUNTS, TARIFFS
+from tgbot.config import get_config
+from tgbot.services.broadcaster import broadcast
+from tgbot.services.coordination import LockLost, get_coordinator
+from tgbot.services.metrics import QUEUE_DEPTH, track
+from tgbot.services.quota import Priority, sheets_priority
+from tgbot.services.resilience import (
+    CircuitOpen,
+    get_deferred_queue,
+    get_policy,
+)
+from tgbot.services.subscriptions import (
+    get_subscription_feed,
+    subscription_hint,
+)
+from tgbot.services.tasks import get_task_supervisor
+from tgbot.services.connect_table import (
+    connect_to_google_sheets,
+    get_subscriber,
+    get_subscription_manager,
+    get_user_uuid,
+    upsert_subscription_to_sheet,
+)
+from vpn_utils import (
+    Connection,
+    PanelError,
+    PanelUnavailable,
+    panel_available,
+)
+
+# Сколько хранится отметка об активации платежа.
+ACTIVATION_FLAG_TTL = 30 * 24 * 3600
+
+# Проверок оплаты на платёж и пауза перед каждой, секунды.
+PAYMENT_CHECK_ATTEMPTS = 10
+PAYMENT_CHECK_INTERVAL = 30
+
+# Ошибки запроса, а не сбои YooKassa: автомат их не считает.
+_CLIENT_ERRORS = (
+    BadRequestError,
+    ForbiddenError,
+    NotFoundError,
+    TooManyRequestsError,
+    UnauthorizedError,
+)
+
+
+class _TimedPayment(Payment):
+    """Payment с таймаутом HTTP-запроса: SDK YooKassa его не ставит."""
+
+    _local = threading.local()
+
+    def __init__(self):
+        super().__init__()
+        timeout = getattr(self._local, "timeout", None)
+        get_session = self.client.get_session
+
+        def session_with_timeout():
+            session = get_session()
+            session.request = partial(session.request, timeout=timeout)
+            return session
+
+        self.client.get_session = session_with_timeout
+
+
+def yookassa_call(
+    operation: str, func: Callable[[], Any], idempotent: bool = False
+) -> Any:
+    """Вызов YooKassa через автомат, адаптивный таймаут и повторы.
+
+    SDK превращает сетевые ошибки в произвольные исключения, поэтому
+    повторяется любой сбой, кроме ошибок запроса.
+    """
+
+    def send(timeout: float) -> Any:
+        _TimedPayment._local.timeout = timeout
+        with track("yookassa", operation):
+            return func()
+
+    return get_policy("yookassa").call(
+        send,
+        idempotent=idempotent,
+        ignore=lambda e: isinstance(e, _CLIENT_ERRORS),
+        retry_on=(Exception,),
+    )
+
 
 class PaymentManager:
     """Класс для управления платежами через YooKassa"""
 
     def __init__(self):
-        self.bot = bot
         self.ip = os.getenv("IP")  # адрес VPN-сервера
         self.shop_id = os.getenv("YOOKASSA_SHOP_ID")
         self.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
         self.return_url = ""  # ссылка на бота
         self.tariffs = TARIFFS
-        self.sheet = connect_to_google_sheets()
 
         Configuration.account_id = self.shop_id
         Configuration.secret_key = self.secret_key
+        if os.getenv("YOOKASSA_API_URL"):
+            Configuration.api_url = os.getenv("YOOKASSA_API_URL")
+
+    @property
+    def bot(self) -> Bot:
+        return get_bot()
+
+    @property
+    def sheet(self):
+        """Лист таблицы; подключение создаётся при первом обращении."""
+        return connect_to_google_sheets()
 
     def check_payment_status(
         self, payment_id: str
     ) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
         """Проверяет статус платежа"""
         try:
-            payment = Payment.find_one(payment_id)
+            payment = yookassa_call(
+                "find_one",
+                lambda: _TimedPayment.find_one(payment_id),
+                idempotent=True,
+            )
             return payment.status, payment.metadata
         except (
             ApiError,
@@ -55,18 +147,20 @@ class PaymentManager:
             UnauthorizedError,
             NotFoundError,
             TooManyRequestsError,
+            CircuitOpen,
         ) as e:
             logging.error("Ошибка при проверке платежа: %s", e)
             return None, None
+        except Exception as e:
+            # Сетевой сбой: проверка повторится на следующей попытке.
+            logging.error("YooKassa недоступна: %s", e)
+            return None, None
 
     def get_discount_by_ref_count(self, ref_count: int) -> int:
         """Возвращает скидку в зависимости от количества рефералов"""
-        if ref_count >= 21:
-            return 100
-        if ref_count >= 10:
-            return 25
-        if ref_count >= 5:
-            return 10
+        for threshold, discount in REFERRAL_DISCOUNTS:
+            if ref_count >= threshold:
+                return discount
         return 0
 
     def create_payment(
@@ -81,12 +175,8 @@ class PaymentManager:
         if not config:
             raise ValueError(f"Неизвестный тариф: {tariff}")
 
-        records = self.sheet.get_all_records()
-        ref_count = 0
-        for record in records:
-            if str(record.get("user_id")) == str(user_id):
-                ref_count = int(record.get("ref_count", 0))
-                break
+        record = get_subscriber(user_id) or {}
+        ref_count = int(record.get("ref_count", 0) or 0)
 
         discount = self.get_discount_by_ref_count(ref_count)
         base_price = config["price"]
@@ -100,45 +190,52 @@ class PaymentManager:
             )
             return None, None
 
-        description = (f"{config['label']} "
-                       f"для пользователя {user_id} "
-                       f"(скидка {discount}%)")
+        description = (
+            f"{config['label']} "
+            f"для пользователя {user_id} "
+            f"(скидка {discount}%)"
+        )
 
-        payment = Payment.create(
-            {
-                "amount": {"value": f"{amount:.2f}", "currency": "RUB"},
-                "confirmation": {
-                    "type": "redirect",
-                    "return_url": self.return_url,
+        # Один ключ на все попытки: повтор не создаст второй платёж.
+        idempotency_key = str(uuid.uuid4())
+        params = {
+            "amount": {"value": f"{amount:.2f}", "currency": "RUB"},
+            "confirmation": {
+                "type": "redirect",
+                "return_url": self.return_url,
+            },
+            "capture": True,
+            "description": description,
+            "metadata": {
+                "user_id": str(user_id),
+                "tariff": tariff,
+                "ref_count": ref_count,
+                "discount": discount,
+            },
+            "receipt": {
+                "customer": {
+                    "full_name": str(user_id),
+                    "email": f"user{user_id}@yourvpn.com",
                 },
-                "capture": True,
-                "description": description,
-                "metadata": {
-                    "user_id": str(user_id),
-                    "tariff": tariff,
-                    "ref_count": ref_count,
-                    "discount": discount,
-                },
-                "receipt": {
-                    "customer": {
-                        "full_name": str(user_id),
-                        "email": f"user{user_id}@yourvpn.com",
-                    },
-                    "items": [
-                        {
-                            "description": description,
-                            "quantity": "1.00",
-                            "amount": {
-                                "value": f"{amount:.2f}",
-                                "currency": "RUB",
-                            },
-                            "vat_code": 1,
-                            "payment_mode": "full_payment",
-                            "payment_subject": "service",
-                        }
-                    ],
-                },
-            }
+                "items": [
+                    {
+                        "description": description,
+                        "quantity": "1.00",
+                        "amount": {
+                            "value": f"{amount:.2f}",
+                            "currency": "RUB",
+                        },
+                        "vat_code": 1,
+                        "payment_mode": "full_payment",
+                        "payment_subject": "service",
+                    }
+                ],
+            },
+        }
+        payment = yookassa_call(
+            "create",
+            lambda: _TimedPayment.create(params, idempotency_key),
+            idempotent=True,
         )
 
         logging.info(
@@ -150,47 +247,12 @@ class PaymentManager:
         return payment.id, payment.confirmation.confirmation_url
 
     def apply_referral_bonus_if_needed(
-        self, records, user_id: int, is_paid: bool
+        self, user_id: int, is_paid: bool
     ) -> None:
         """Начисляет бонус владельцу реф.ссылки, если оплата прошла."""
         if not is_paid:
             return
-
-        user_record = next(
-            (r for r in records if str(r.get("user_id")) == str(user_id)), None
-        )
-        if not user_record:
-            return
-
-        referrer_id = user_record.get("referrer_id")
-        if not referrer_id:
-            return
-
-        referrer_record = next(
-            (r for r in records if str(r.get("user_id")) == str(referrer_id)),
-            None,
-        )
-        if not referrer_record:
-            return
-
-        end_str = referrer_record.get("end_date", "")
-        end_date = parse_date(end_str)
-        today = datetime.today().date()
-        if not end_date or end_date < today:
-            logging.warning(
-                "Не начисляем бонус: подписка у %s не активна", referrer_id
-            )
-            return
-
-        new_end = end_date + timedelta(days=5)
-        row_index = records.index(referrer_record) + 2
-        records.update_cell(row_index, 4, new_end.strftime("%d.%m.%Y"))
-        old_count = int(referrer_record.get("ref_count", 0) or 0)
-        records.update_cell(row_index, 11, old_count + 1)
-
-        logging.info(
-            "Бонус для user_id=%s: +5 дней, +1 к ref_count", referrer_id
-        )
+        get_subscription_manager().apply_referral_bonus(user_id, days=5)
 
     def generate_vless_link(self, uuid: str, port: int, user_tag: str) -> str:
         """Генерирует ссылку VLESS для клиента."""
@@ -201,20 +263,72 @@ class PaymentManager:
         )
 
     async def check_payment_loop(
-        self, payment_id: str, user_id: int, username: str, days: int = 30
+        self,
+        payment_id: str,
+        user_id: int,
+        username: str,
+        days: int = 30,
+        attempts: int = PAYMENT_CHECK_ATTEMPTS,
     ) -> None:
-        """Проверка статуса оплаты и активации подписки"""
+        """Проверка статуса оплаты и активации подписки.
+
+        Проверка, отменённая остановкой процесса, сохраняется в очередь
+        payment_checks с оставшимися попытками; её продолжит
+        resume_payment_checks в работающем процессе.
+        """
+        state = {
+            "payment_id": payment_id,
+            "user_id": user_id,
+            "username": username,
+            "days": days,
+            "attempts": attempts,
+        }
+        with QUEUE_DEPTH.labels("payment_checks").track_inprogress():
+            try:
+                await self._poll_payment(state)
+            except asyncio.CancelledError:
+                logging.info(
+                    "Проверка платежа %s отложена до перезапуска", payment_id
+                )
+                await get_deferred_queue("payment_checks").push(state)
+                raise
+
+    async def resume_payment_checks(self) -> int:
+        """Возобновляет проверки оплаты, прерванные остановкой процесса."""
+        supervisor = get_task_supervisor()
+
+        async def resume(item: dict) -> None:
+            supervisor.spawn(
+                "payment_checks",
+                self.check_payment_loop(**item),
+                name=f"payment:{item['payment_id']}",
+            )
+
+        return await get_deferred_queue("payment_checks").drain(
+            resume, get_policy("yookassa")
+        )
+
+    async def _poll_payment(self, state: dict) -> None:
+        payment_id = state["payment_id"]
+        user_id = state["user_id"]
+        username = state["username"]
+        days = state["days"]
         logging.info(
             "Запущен check_payment_loop: user_id=%s, payment_id=%s",
             user_id,
             payment_id,
         )
 
-        for attempt in range(10):
-            logging.info("Попытка %s/10 — проверка оплаты...", attempt + 1)
-            await asyncio.sleep(30)
+        while state["attempts"] > 0:
+            logging.info(
+                "Проверка оплаты, осталось попыток: %s", state["attempts"]
+            )
+            await asyncio.sleep(PAYMENT_CHECK_INTERVAL)
 
-            status, metadata = self.check_payment_status(payment_id)
+            status, metadata = await asyncio.to_thread(
+                self.check_payment_status, payment_id
+            )
+            state["attempts"] -= 1
             logging.info(
                 "Статус платежа: %s, метаданные: %s", status, metadata
             )
@@ -222,112 +336,289 @@ class PaymentManager:
             if status != "succeeded":
                 continue
 
-            logging.info("Оплата прошла успешно: user_id=%s", user_id)
-            self.apply_referral_bonus_if_needed(
-                self.sheet.get_all_records(), user_id, is_paid=True
+            if panel_available():
+                try:
+                    await self.activate_paid(
+                        payment_id, user_id, username, days, metadata
+                    )
+                    return
+                except Exception as e:
+                    logging.error(
+                        "Активация платежа %s не удалась: %s", payment_id, e
+                    )
+            await self.defer_activation(
+                payment_id, user_id, username, days, metadata
             )
+            return
 
-            tariff = metadata.get("tariff", "solo")
-            connect = Connection()
-            is_renewal = False
+        logging.warning(
+            "Время ожидания истекло для payment_id=%s, user_id=%s",
+            payment_id,
+            user_id,
+        )
+        await self.bot.send_message(user_id, "⏳ Оплата не завершена.")
 
-            if tariff == "pair":
-                result1 = connect.create_inbound(user_id)
-                result2 = connect.create_inbound(f"{user_id}_pair")
-                if not result1 or not result2:
-                    await self.bot.send_message(
-                        user_id, "❌ Не удалось создать парную подписку."
+    async def activate_paid(
+        self,
+        payment_id: str,
+        user_id: int,
+        username: str,
+        days: int,
+        metadata: dict,
+    ) -> None:
+        """Активирует оплаченный платёж ровно один раз на все процессы.
+
+        Отметка activated: ставится только после успешной активации;
+        исключение activate_subscription оставляет платёж неактивированным,
+        и вызывающий откладывает его в очередь. Потерянная во время
+        активации блокировка только пишется в лог: подписка уже выдана,
+        и повтор выдал бы её второй раз.
+        """
+        coordinator = get_coordinator()
+        try:
+            async with coordinator.payment_lock(payment_id):
+                if await coordinator.get_flag(f"activated:{payment_id}"):
+                    logging.info(
+                        "Платёж %s уже активирован другим процессом",
+                        payment_id,
                     )
                     return
+                try:
+                    async with coordinator.user_lock(user_id):
+                        with sheets_priority(Priority.PAYMENT):
+                            await self.activate_subscription(
+                                user_id, username, days, metadata
+                            )
+                except LockLost as e:
+                    logging.warning(
+                        "Платёж %s активирован без блокировки %s",
+                        payment_id,
+                        e,
+                    )
+                await coordinator.set_flag(
+                    f"activated:{payment_id}",
+                    str(user_id),
+                    ttl=ACTIVATION_FLAG_TTL,
+                )
+        except LockLost as e:
+            logging.warning(
+                "Платёж %s активирован без блокировки %s", payment_id, e
+            )
+
+    async def defer_activation(
+        self,
+        payment_id: str,
+        user_id: int,
+        username: str,
+        days: int,
+        metadata: dict,
+    ) -> None:
+        """Панель недоступна: активация ждёт в очереди, а не таймаутов."""
+        logging.warning(
+            "Панель недоступна, активация платежа %s отложена", payment_id
+        )
+        await get_deferred_queue("activations").push(
+            {
+                "payment_id": payment_id,
+                "user_id": user_id,
+                "username": username,
+                "days": days,
+                "metadata": metadata,
+            }
+        )
+        try:
+            await self.bot.send_message(
+                user_id,
+                "✅ Оплата получена. Сервер VPN временно недоступен — ключ "
+                "придёт сюда автоматически, как только он восстановится.",
+            )
+        except TelegramAPIError as e:
+            logging.error("Ошибка при отправке сообщения в Telegram: %s", e)
+
+    async def run_deferred_activations(self) -> int:
+        """Выполняет отложенные активации, если панель снова доступна."""
+
+        async def activate(item: dict) -> None:
+            await self.activate_paid(**item)
+
+        async def alert(item: dict) -> None:
+            await broadcast(
+                self.bot,
+                get_config().tg_bot.admin_ids,
+                f"⚠️ Платёж {item['payment_id']} (user_id={item['user_id']}) "
+                "оплачен, но подписка не активирована после нескольких "
+                "попыток — нужна ручная проверка.",
+            )
 
-                uuid1, port1 = result1["uuid"], result1["port"]
-                uuid2, port2 = result2["uuid"], result2["port"]
+        return await get_deferred_queue("activations").drain(
+            activate, get_policy("xui"), on_dead=alert
+        )
 
-                upsert_subscription_to_sheet(
-                    user_id, username, days=30, client_uuid=uuid1
-                )
+    @staticmethod
+    def _panel_failure(message: str) -> Exception:
+        """Исключение для неудачной операции панели.
 
-                sheet = connect_to_google_sheets()
-                records = sheet.get_all_records()
-                for i, record in enumerate(records):
-                    if str(record.get("user_id")) == str(user_id):
-                        row = i + 2
-                        sheet.update_cell(row, 9, uuid2)
-                        break
+        Разомкнутый автомат — PanelUnavailable, иначе PanelError: отказ
+        доступной панели не должен держать очередь активаций.
+        """
+        if panel_available():
+            return PanelError(message)
+        return PanelUnavailable(message)
 
-                link1 = self.generate_vless_link(
-                    uuid1, port1, f"user_{user_id}"
+    async def activate_subscription(
+        self, user_id: int, username: str, days: int, metadata: dict
+    ) -> None:
+        """Активирует или продлевает подписку после успешной оплаты.
+
+        Недоступность панели — PanelUnavailable: очередь отложенных
+        активаций повторит платёж после восстановления. Отказ доступной
+        панели — PanelError: платёж уходит в хвост очереди и после
+        нескольких попыток — администратору.
+        Реферальный бонус начисляется после записи в таблицу, чтобы
+        повтор не начислил его дважды.
+        """
+        logging.info("Оплата прошла успешно: user_id=%s", user_id)
+        tariff = metadata.get("tariff", "solo")
+        connect = Connection()
+        is_renewal = False
+
+        if tariff == "pair":
+            # Один список inbound на оба ключа, создание — параллельно.
+            # Connection (сессия и токен) не потокобезопасен, поэтому у
+            # второго потока своё подключение.
+            ports = await asyncio.to_thread(connect.allocate_ports, 2)
+            results = []
+            if ports:
+                results = await asyncio.gather(
+                    asyncio.to_thread(
+                        connect.create_inbound, user_id, port=ports[0]
+                    ),
+                    asyncio.to_thread(
+                        Connection().create_inbound,
+                        f"{user_id}_pair",
+                        port=ports[1],
+                    ),
                 )
-                link2 = self.generate_vless_link(
-                    uuid2, port2, f"user_{user_id}_pair"
+            if not results or not all(results):
+                # Повтор создаст оба ключа заново: половину убираем.
+                created = [result for result in results if result]
+                if created:
+                    await asyncio.to_thread(connect.discard_inbounds, created)
+                raise self._panel_failure(
+                    f"Не удалось создать парную подписку user_id={user_id}"
                 )
+            result1, result2 = results
 
-                text = (
-                    "🖤 Парная подписка активирована! 🖤\n\n"
-                    f"🔗 Твой ключ:\n<pre>{link1}</pre>\n\n"
-                    f"👬 Ключ для друга:\n<pre>{link2}</pre>\n\n"
-                    "🔥 Если возникли трудности — напиши @BlackGateSupp"
-                )
-                await self.bot.send_message(user_id, text, parse_mode="HTML")
-                return
-
-            client_uuid = get_user_uuid(user_id)
-            if client_uuid:
-                logging.info("UUID найден: %s, продление доступа", client_uuid)
-                success = connect.update_client(client_uuid, days=days)
-                if not success:
-                    await self.bot.send_message(
-                        user_id, "❌ Не удалось продлить VPN-доступ."
-                    )
-                    return
-                is_renewal = True
-            else:
-                logging.info("UUID не найден, создаём новое подключение")
-                result = connect.create_inbound(user_id)
-                if not result:
-                    await self.bot.send_message(
-                        user_id, "❌ Не удалось создать подключение."
-                    )
-                    return
-                client_uuid = result["uuid"]
-                logging.info("Новый клиент создан: %s", client_uuid)
+            uuid1, port1 = result1["uuid"], result1["port"]
+            uuid2, port2 = result2["uuid"], result2["port"]
 
-            upsert_subscription_to_sheet(
-                user_id, username, days=days, client_uuid=client_uuid
+            # Оба UUID — одной записью в таблицу.
+            await asyncio.to_thread(
+                upsert_subscription_to_sheet,
+                user_id,
+                username,
+                days=30,
+                client_uuid=uuid1,
+                pair_uuid=uuid2,
+            )
+            await asyncio.to_thread(get_subscription_feed().invalidate)
+            await asyncio.to_thread(
+                self.apply_referral_bonus_if_needed, user_id, is_paid=True
             )
-            logging.info("Данные о подписке обновлены в Google Sheets")
 
-            inbound = {
-                "uuid": client_uuid,
-                "port": result["port"] if not is_renewal else 0,
-            }
-            link = self.generate_vless_link(
-                inbound["uuid"], inbound["port"], f"user_{user_id}"
+            link1 = self.generate_vless_link(uuid1, port1, f"user_{user_id}")
+            link2 = self.generate_vless_link(
+                uuid2, port2, f"user_{user_id}_pair"
             )
+
             text = (
-                "🔄 Подписка продлена!\n"
-                if is_renewal
-                else "🖤 Подписка активирована! 🖤\n"
-            ) + (
-                f"🔗 Ваш ключ доступа:\n\n<pre>{link}</pre>\n"
-                "🔥 Если возникли трудности —"
-                " обратитесь к менеджеру @BlackGateSupp"
+                "🖤 Парная подписка активирована! 🖤\n\n"
+                f"🔗 Твой ключ:\n<pre>{link1}</pre>\n\n"
+                f"👬 Ключ для друга:\n<pre>{link2}</pre>\n\n"
+                + subscription_hint(result1.get("sub_id"))
+                + "🔥 Если возникли трудности — напиши @BlackGateSupp"
             )
-
+            # Ключи уже выданы: ошибка Telegram не должна привести к
+            # повтору активации.
             try:
                 await self.bot.send_message(user_id, text, parse_mode="HTML")
-                logging.info(
-                    "Сообщение Telegram отправлено пользователю %s", user_id
-                )
             except TelegramAPIError as e:
                 logging.error(
                     "Ошибка при отправке сообщения в Telegram: %s", e
                 )
             return
 
-        logging.warning(
-            "Время ожидания истекло для payment_id=%s, user_id=%s",
-            payment_id,
+        client_uuid = await asyncio.to_thread(get_user_uuid, user_id)
+        if client_uuid:
+            logging.info("UUID найден: %s, продление доступа", client_uuid)
+            success = await asyncio.to_thread(
+                connect.update_client, client_uuid, days=days
+            )
+            if not success:
+                raise self._panel_failure(
+                    f"Не удалось продлить клиента {client_uuid}"
+                )
+            # Проход enforcement мог выключить inbound после истечения,
+            # в том числе пробный, через клиента которого шло продление.
+            record = await asyncio.to_thread(get_subscriber, user_id) or {}
+            await asyncio.to_thread(
+                connect.set_user_inbounds_enabled,
+                user_id,
+                True,
+                (client_uuid, str(record.get("client_uuid_pair", ""))),
+            )
+            is_renewal = True
+        else:
+            logging.info("UUID не найден, создаём новое подключение")
+            result = await asyncio.to_thread(connect.create_inbound, user_id)
+            if not result:
+                raise self._panel_failure(
+                    f"Не удалось создать подключение user_id={user_id}"
+                )
+            client_uuid = result["uuid"]
+            logging.info("Новый клиент создан: %s", client_uuid)
+
+        await asyncio.to_thread(
+            upsert_subscription_to_sheet,
             user_id,
+            username,
+            days=days,
+            client_uuid=client_uuid,
         )
-        await self.bot.send_message(user_id, "⏳ Оплата не завершена.")
+        logging.info("Данные о подписке обновлены в Google Sheets")
+        await asyncio.to_thread(get_subscription_feed().invalidate)
+        await asyncio.to_thread(
+            self.apply_referral_bonus_if_needed, user_id, is_paid=True
+        )
+
+        inbound = {
+            "uuid": client_uuid,
+            "port": result["port"] if not is_renewal else 0,
+        }
+        link = self.generate_vless_link(
+            inbound["uuid"], inbound["port"], f"user_{user_id}"
+        )
+        text = (
+            "🔄 Подписка продлена!\n"
+            if is_renewal
+            else "🖤 Подписка активирована! 🖤\n"
+        ) + (
+            f"🔗 Ваш ключ доступа:\n\n<pre>{link}</pre>\n"
+            + subscription_hint(None if is_renewal else result.get("sub_id"))
+            + "🔥 Если возникли трудности —"
+            " обратитесь к менеджеру @BlackGateSupp"
+        )
+
+        try:
+            await self.bot.send_message(user_id, text, parse_mode="HTML")
+            logging.info(
+                "Сообщение Telegram отправлено пользователю %s", user_id
+            )
+        except TelegramAPIError as e:
+            logging.error("Ошибка при отправке сообщения в Telegram: %s", e)
+
+
+@lru_cache(maxsize=None)
+def get_payment_manager() -> PaymentManager:
+    """Возвращает общий для процесса PaymentManager."""
+    return PaymentManager()
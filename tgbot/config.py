@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Optional
 
 from environs import Env
@@ -54,13 +55,20 @@ class TgBot:
     token: str
     admin_ids: list[int]
     use_redis: bool
+    api_url: Optional[str] = None
 
     @staticmethod
     def from_env(env: Env):
         token = env.str("BOT_TOKEN")
         admin_ids = list(map(int, env.list("ADMINS")))
         use_redis = env.bool("USE_REDIS")
-        return TgBot(token=token, admin_ids=admin_ids, use_redis=use_redis)
+        api_url = env.str("TELEGRAM_API_URL", None)
+        return TgBot(
+            token=token,
+            admin_ids=admin_ids,
+            use_redis=use_redis,
+            api_url=api_url,
+        )
 
 
 @dataclass
@@ -71,7 +79,10 @@ class RedisConfig:
 
     def dsn(self) -> str:
         if self.redis_pass:
-            return f"redis://:{self.redis_pass}@{self.redis_host}:{self.redis_port}/0"
+            return (
+                f"redis://:{self.redis_pass}@"
+                f"{self.redis_host}:{self.redis_port}/0"
+            )
         else:
             return f"redis://{self.redis_host}:{self.redis_port}/0"
 
@@ -102,9 +113,16 @@ class Config:
 def load_config(path: str = None) -> Config:
     env = Env()
     env.read_env(path)
+    tg_bot = TgBot.from_env(env)
     return Config(
-        tg_bot=TgBot.from_env(env),
+        tg_bot=tg_bot,
         # db=DbConfig.from_env(env),
-        # redis=RedisConfig.from_env(env),
+        redis=RedisConfig.from_env(env) if tg_bot.use_redis else None,
         misc=Miscellaneous(),
     )
+
+
+@lru_cache(maxsize=None)
+def get_config() -> Config:
+    """Загружает конфигурацию из .env один раз, при первом обращении."""
+    return load_config(".env")
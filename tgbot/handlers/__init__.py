@@ -0,0 +1,3 @@
+from .user import user_router
+
+__all__ = ["user_router"]
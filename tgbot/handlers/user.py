@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from datetime import datetime
 
@@ -7,14 +8,27 @@ from aiogram.filters import Command, CommandObject, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import CallbackQuery, FSInputFile, Message
-from dotenv import load_dotenv
 
-from tgbot.keyboards.inline import (admin_panel, first_start_keyboard,
-                                    to_payment)
-from tgbot.services.connect_table import (connect_to_google_sheets, parse_date,
-                                          schedule_daily_check)
-
-load_dotenv()
+from tgbot.keyboards.inline import (
+    admin_panel,
+    extend_confirm,
+    first_start_keyboard,
+    to_payment,
+)
+from tgbot.services.analytics import get_analytics, render_stats
+from tgbot.services.bulk_extend import (
+    BulkExtendJob,
+    ExtendFilter,
+    get_bulk_extender,
+)
+from tgbot.services.connect_table import (
+    get_subscriber,
+    get_subscription_manager,
+    parse_date,
+    schedule_daily_check,
+)
+from tgbot.services.quota import Priority, sheets_priority
+from tgbot.services.tasks import TaskRejected, get_task_supervisor
 
 user_router = Router()
 
@@ -47,21 +61,12 @@ async def user_start(message: Message, command: CommandObject):
         except ValueError:
             referrer_id = None
 
-    sheet = connect_to_google_sheets()
-    records = sheet.get_all_records()
-    user_row = None
-    for i, record in enumerate(records):
-        if str(record.get("user_id")) == str(user_id):
-            user_row = i + 2
-            break
-    if user_row:
-        sheet.update_cell(user_row, 2, username)
-        if referrer_id and not records[user_row - 2].get("referrer_id"):
-            sheet.update_cell(user_row, 6, referrer_id)
-    else:
-        sheet.append_row(
-            [user_id, username, "", "", "", "", "", "", "", referrer_id, 0]
-        )
+    await asyncio.to_thread(
+        get_subscription_manager().register_user,
+        user_id,
+        username,
+        referrer_id,
+    )
     print(f"🌀 Новый запуск: user_id={user_id}, referrer_id={referrer_id}")
 
     video_path = "/root/vpnbot/TestNew/Files/1.mp4"
@@ -87,10 +92,7 @@ async def admin_panel_handler(message: types.Message):
     if message.from_user.id != 7792300158:
         await message.answer("У вас нет прав на использование этой команды.")
         return
-    await message.answer(
-        "Панель админа",
-        reply_markup=admin_panel()
-    )
+    await message.answer("Панель админа", reply_markup=admin_panel())
 
 
 @user_router.callback_query(F.data == "send_all")
@@ -107,8 +109,10 @@ async def process_broadcast_message(
     message: types.Message, state: FSMContext, bot: Bot
 ):
     text = message.text
-    sheet = connect_to_google_sheets()
-    users = sheet.get_all_records()
+    with sheets_priority(Priority.ADMIN):
+        users = await asyncio.to_thread(
+            get_subscription_manager().get_all_records
+        )
     count = 0
     for record in users:
         user_id = record.get("user_id")
@@ -128,10 +132,119 @@ async def o_daily_check(call: CallbackQuery, bot: Bot):
     await call.message.answer(
         "📅 Запуск планировщика для проверки подписок..."
     )
-    schedule_daily_check(bot)
+    if not schedule_daily_check(bot):
+        await call.message.answer("⏳ Проверка подписок уже выполняется.")
+        return
     await call.message.answer("✅ Проверка подписок была успешно запущена.")
 
 
+async def send_stats(message: types.Message) -> None:
+    with sheets_priority(Priority.ADMIN):
+        stats = await asyncio.to_thread(get_analytics().stats)
+    await message.answer(render_stats(stats))
+
+
+@user_router.message(Command("stats"))
+async def stats_handler(message: types.Message):
+    if message.from_user.id != 7792300158:
+        await message.answer("У вас нет прав на использование этой команды.")
+        return
+    await send_stats(message)
+
+
+@user_router.callback_query(F.data == "stats")
+async def stats_callback(call: CallbackQuery):
+    await call.answer()
+    if call.from_user.id != 7792300158:
+        await call.message.answer("Вы не администратор")
+        return
+    await send_stats(call.message)
+
+
+EXTEND_USAGE = (
+    "Использование:\n"
+    "/extend <дни> [all] [tariff=solo|long|pair] [before=ДД.ММ.ГГГГ]\n"
+    "/extend resume <id>"
+)
+
+
+async def run_bulk_extend(message: types.Message, job: BulkExtendJob):
+    """Выполняет продление, обновляя сообщение с прогрессом."""
+    status = await message.answer(job.render())
+
+    async def progress(job: BulkExtendJob) -> None:
+        try:
+            await status.edit_text(job.render())
+        except TelegramAPIError as e:
+            logging.warning("Прогресс продления не обновлён: %s", e)
+
+    job = await get_bulk_extender().run(job, progress)
+    await message.answer(job.render())
+
+
+def start_bulk_extend(message: types.Message, job: BulkExtendJob) -> bool:
+    """Запускает продление в фоне; False — другое уже выполняется."""
+    try:
+        get_task_supervisor().spawn(
+            "bulk_extend",
+            run_bulk_extend(message, job),
+            name=f"bulk_extend:{job.job_id}",
+        )
+    except TaskRejected:
+        return False
+    return True
+
+
+@user_router.message(Command("extend"))
+async def extend_handler(message: types.Message, command: CommandObject):
+    if message.from_user.id != 7792300158:
+        await message.answer("У вас нет прав на использование этой команды.")
+        return
+    args = (command.args or "").split()
+    extender = get_bulk_extender()
+    if len(args) == 2 and args[0] == "resume":
+        job = extender.load(args[1])
+        if job is None:
+            await message.answer(f"❌ Задание {args[1]} не найдено.")
+        elif not start_bulk_extend(message, job):
+            await message.answer("⏳ Массовое продление уже выполняется.")
+        return
+    try:
+        days = int(args[0]) if args else 0
+        flt = ExtendFilter.parse(args[1:])
+    except ValueError:
+        days = 0
+    if days <= 0:
+        await message.answer(EXTEND_USAGE)
+        return
+    try:
+        with sheets_priority(Priority.ADMIN):
+            job = await asyncio.to_thread(extender.plan, days, flt)
+    except Exception as e:
+        logging.error("Продление не запланировано: %s", e)
+        await message.answer("❌ Таблица недоступна, попробуйте позже.")
+        return
+    await message.answer(job.render(), reply_markup=extend_confirm(job.job_id))
+
+
+@user_router.callback_query(F.data.startswith("extend_run:"))
+async def extend_run_callback(call: CallbackQuery):
+    await call.answer()
+    if call.from_user.id != 7792300158:
+        await call.message.answer("Вы не администратор")
+        return
+    job_id = call.data.split(":", 1)[1]
+    job = get_bulk_extender().load(job_id)
+    if job is None:
+        await call.message.answer(f"❌ Задание {job_id} не найдено.")
+    elif job.status != "planned":
+        await call.message.answer(
+            f"Задание уже запускалось, продолжить: /extend resume {job_id}"
+        )
+    elif not start_bulk_extend(call.message, job):
+        await call.message.answer("⏳ Массовое продление уже выполняется.")
+
+
 @user_router.callback_query(F.data == "send_user")
 async def send_message_to_user_handler(call: CallbackQuery, state: FSMContext):
     await call.answer()
@@ -170,11 +283,7 @@ async def process_message_text(
 @user_router.callback_query(F.data == "our_reff_link")
 async def get_reff_link(call: CallbackQuery, bot: Bot):
     user_id = call.from_user.id
-    sheet = connect_to_google_sheets()
-    records = sheet.get_all_records()
-    user_record = next(
-        (r for r in records if str(r.get("user_id")) == str(user_id)), None
-    )
+    user_record = await asyncio.to_thread(get_subscriber, user_id)
     if user_record:
         end_date_str = user_record.get("end_date")
         end_date = parse_date(end_date_str)
@@ -207,8 +316,10 @@ async def send_payment_notification(bot: Bot, user_id: int):
 
 async def check_expiration_dates(bot: Bot):
     try:
-        sheet = connect_to_google_sheets()
-        records = sheet.get_all_records()
+        with sheets_priority(Priority.ADMIN):
+            records = await asyncio.to_thread(
+                get_subscription_manager().get_all_records
+            )
         today = datetime.today().date()
         logging.info(f"📅 Проверка подписок на {today}")
         admin_id = "ADMIN_ID"
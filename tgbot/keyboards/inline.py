@@ -33,11 +33,21 @@ def admin_panel():
     )
     builder.button(text="❗️Сообщение пользователю", callback_data="send_user")
     builder.button(text="🔍Проверка подписок", callback_data="to_check")
+    builder.button(text="📊Статистика", callback_data="stats")
     builder.button(text="Назад 🔙️", callback_data="back_to_menu")
     builder.adjust(1, 1)
     return builder.as_markup()
 
 
+def extend_confirm(job_id: str):
+    builder = InlineKeyboardBuilder()
+    builder.button(
+        text="✅Запустить продление", callback_data=f"extend_run:{job_id}"
+    )
+    builder.adjust(1)
+    return builder.as_markup()
+
+
 def to_payment():
     builder = InlineKeyboardBuilder()
     builder.button(
@@ -0,0 +1,23 @@
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware,
+    NextRequestMiddlewareType,
+)
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from tgbot.services.metrics import track
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет каждый запрос к Telegram Bot API по имени метода."""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        operation = getattr(method, "__api_method__", type(method).__name__)
+        with track("telegram", operation):
+            return await make_request(bot, method)
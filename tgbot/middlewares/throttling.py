@@ -0,0 +1,146 @@
+import logging
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, TelegramObject
+from redis import asyncio as aioredis
+
+from tgbot.misc.events import event_key
+from tgbot.services.metrics import THROTTLED_EVENTS
+
+_TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local refill = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(redis.call("HGET", KEYS[1], "t") or capacity)
+local updated = tonumber(redis.call("HGET", KEYS[1], "ts") or now)
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * refill)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call("HSET", KEYS[1], "t", tokens, "ts", now)
+redis.call("PEXPIRE", KEYS[1], ARGV[4])
+return allowed
+"""
+
+
+@dataclass(frozen=True)
+class Rate:
+    """limit событий за period секунд; limit — это и размер всплеска."""
+
+    limit: int
+    period: float
+
+    @property
+    def refill(self) -> float:
+        return self.limit / self.period
+
+
+class MemoryBucketStorage:
+    """Token bucket в памяти процесса."""
+
+    def __init__(self, max_items: int = 100000):
+        self.max_items = max_items
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    async def consume(self, key: str, rate: Rate) -> bool:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (rate.limit, now))
+        tokens = min(rate.limit, tokens + (now - updated) * rate.refill)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_items:
+            self._buckets.popitem(last=False)
+        return allowed
+
+
+class RedisBucketStorage:
+    """Token bucket в Redis: общий лимит для всех процессов бота."""
+
+    def __init__(self, client: aioredis.Redis, prefix: str = "vpnbot:rl"):
+        self.redis = client
+        self.prefix = prefix
+
+    async def consume(self, key: str, rate: Rate) -> bool:
+        result = await self.redis.eval(
+            _TOKEN_BUCKET_SCRIPT,
+            1,
+            f"{self.prefix}:{key}",
+            rate.limit,
+            rate.refill,
+            time.time(),
+            int(rate.period * 2000),
+        )
+        return bool(result)
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Ограничивает частоту событий от одного пользователя.
+
+    Ключ лимита — команда сообщения (/start), callback_data кнопки или
+    состояние FSM, поэтому тяжёлым обработчикам можно задать свои
+    лимиты в rates.
+    Пока обработчик того же ключа у пользователя ещё выполняется,
+    повторные события склеиваются с ним и отбрасываются сразу.
+    """
+
+    def __init__(
+        self,
+        storage=None,
+        default_rate: Rate = Rate(limit=5, period=1),
+        rates: Optional[Dict[str, Rate]] = None,
+    ) -> None:
+        self.storage = storage or MemoryBucketStorage()
+        self.default_rate = default_rate
+        self.rates = rates or {}
+        self.shed: Counter = Counter()
+        self._in_flight: Set[Tuple[int, str]] = set()
+
+    async def _reject(self, event: TelegramObject, key: str, reason: str):
+        self.shed[(key, reason)] += 1
+        THROTTLED_EVENTS.labels(
+            key if key in self.rates else "default", reason
+        ).inc()
+        logging.debug(
+            "Событие %s отброшено (%s): user %s",
+            key,
+            reason,
+            event.from_user.id,
+        )
+        if isinstance(event, CallbackQuery):
+            try:
+                await event.answer("Слишком часто, подождите немного")
+            except Exception:
+                pass
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = getattr(event, "from_user", None)
+        if user is None:
+            return await handler(event, data)
+
+        key = event_key(event, data)
+        flight_key = (user.id, key)
+        if flight_key in self._in_flight:
+            return await self._reject(event, key, "merged")
+
+        rate = self.rates.get(key, self.default_rate)
+        if not await self.storage.consume(f"{user.id}:{key}", rate):
+            return await self._reject(event, key, "rate_limited")
+
+        self._in_flight.add(flight_key)
+        try:
+            return await handler(event, data)
+        finally:
+            self._in_flight.discard(flight_key)
@@ -0,0 +1,37 @@
+from typing import Any, Awaitable, Callable, Dict, Iterable
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from tgbot.misc.events import event_key
+from tgbot.services.metrics import REQUEST_LATENCY
+from tgbot.services.tracing import log_if_slow, trace
+
+
+class TimingMiddleware(BaseMiddleware):
+    """Замеряет полное время обработки события и логирует медленные.
+
+    commands — известные команды (registered_commands роутера); прочие
+    команды попадают в метрики как /unknown.
+    """
+
+    def __init__(
+        self, commands: Iterable[str] = ("/start", "/admin_panel")
+    ) -> None:
+        self.commands = set(commands)
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        name = event_key(event, data)
+        if name.startswith("/") and name not in self.commands:
+            name = "/unknown"
+        try:
+            with trace(f"bot {name}") as root:
+                return await handler(event, data)
+        finally:
+            REQUEST_LATENCY.labels("bot", name).observe(root.duration)
+            log_if_slow(root)
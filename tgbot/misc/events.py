@@ -0,0 +1,39 @@
+from typing import Any, Dict, Optional, Set
+
+from aiogram import Router
+from aiogram.filters import Command
+from aiogram.types import BotCommand, CallbackQuery, Message, TelegramObject
+
+
+def event_key(
+    event: TelegramObject, data: Optional[Dict[str, Any]] = None
+) -> str:
+    """Короткое имя события: команда, действие callback или состояние FSM.
+
+    У callback_data берётся часть до первого ':' — параметры вроде
+    extend_run:<id> не должны плодить новые имена.
+    """
+    if isinstance(event, CallbackQuery):
+        return (event.data or "callback").split(":", 1)[0]
+    if isinstance(event, Message) and event.text:
+        if event.text.startswith("/"):
+            return event.text.split()[0].split("@")[0]
+    if data and data.get("raw_state"):
+        return data["raw_state"]
+    return "message"
+
+
+def registered_commands(router: Router) -> Set[str]:
+    """Команды из фильтров Command обработчиков роутера и вложенных."""
+    commands: Set[str] = set()
+    for current in router.chain_tail:
+        for handler in current.message.handlers:
+            for flt in handler.filters or ():
+                if not isinstance(flt.callback, Command):
+                    continue
+                for command in flt.callback.commands:
+                    if isinstance(command, BotCommand):
+                        command = command.command
+                    if isinstance(command, str):
+                        commands.add(f"/{command}")
+    return commands
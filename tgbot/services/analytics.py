@@ -0,0 +1,224 @@
+"""Сводная статистика по таблице подписчиков для администратора.
+
+Записи один раз раскладываются в столбцы NumPy (даты — datetime64[D],
+отсутствующая дата — NaT), после чего каждый показатель считается
+векторной операцией над всей таблицей. Источник — локальный снимок
+подписчиков: подсчёт не тратит квоту Sheets, а результат кэшируется до
+выхода новой версии снимка.
+"""
+
+import logging
+import threading
+import time
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import numpy as np
+
+from constants import REFERRAL_DISCOUNTS, TARIFFS
+from tgbot.services.connect_table import get_subscription_manager
+
+# Оплата от стольких дней считается длинным тарифом: upsert_subscription
+# ставит end_date = сегодня + days + 1.
+LONG_PERIOD_DAYS = TARIFFS["long"]["days"]
+EXPIRING_DAYS = 7
+
+_NAT = np.datetime64("NaT", "D")
+
+
+def infer_tariff(
+    start: Optional[date], end: Optional[date], pair_uuid: Any = ""
+) -> Optional[str]:
+    """Тариф последней оплаты по записи; None — оплат не было.
+
+    Правило то же, что в compute_stats.
+    """
+    if not start or not end:
+        return None
+    if (end - start).days >= LONG_PERIOD_DAYS:
+        return "long"
+    return "pair" if str(pair_uuid or "").strip() else "solo"
+
+
+def _dates(values: Iterable[Any], parse_date: Callable) -> np.ndarray:
+    # Разных дат в таблице немного: каждую строку парсим один раз.
+    parsed: Dict[Any, Any] = {}
+    result = []
+    for value in values:
+        if value not in parsed:
+            day = parse_date(value)
+            parsed[value] = np.datetime64(day, "D") if day else _NAT
+        result.append(parsed[value])
+    return np.array(result, dtype="datetime64[D]")
+
+
+def _ints(values: Iterable[Any]) -> np.ndarray:
+    result = []
+    for value in values:
+        value = str(value).strip()
+        result.append(int(value) if value.isdigit() else 0)
+    return np.array(result, dtype=np.int64)
+
+
+def load_arrays(records: Iterable[dict], parse_date: Callable) -> dict:
+    """Столбцы таблицы подписчиков в виде массивов NumPy."""
+    records = [
+        record
+        for record in records
+        if str(record.get("user_id", "")).strip().isdigit()
+    ]
+
+    def field(name: str) -> list:
+        return [record.get(name, "") for record in records]
+
+    trial_start = _dates(field("start_trial_period"), parse_date)
+    last_trial = _dates(field("last_trial_used"), parse_date)
+    return {
+        "start": _dates(field("start_date"), parse_date),
+        "end": _dates(field("end_date"), parse_date),
+        "trial_end": _dates(field("end_trial_period"), parse_date),
+        "had_trial": ~np.isnat(trial_start) | ~np.isnat(last_trial),
+        "has_pair": np.array(
+            [bool(str(uuid).strip()) for uuid in field("client_uuid_pair")],
+            dtype=bool,
+        ),
+        "ref_count": _ints(field("ref_count")),
+    }
+
+
+def compute_stats(arrays: dict, today: date) -> dict:
+    """Показатели по массивам load_arrays на дату today."""
+    today = np.datetime64(today, "D")
+    start, end = arrays["start"], arrays["end"]
+    total = len(end)
+
+    paid = ~np.isnat(start) & ~np.isnat(end)
+    active = end >= today
+    expiring = active & (end < today + EXPIRING_DAYS)
+    trial_active = arrays["trial_end"] >= today
+    had_trial = arrays["had_trial"]
+    converted = had_trial & paid
+
+    # Тариф последней оплаты: по её длительности и наличию второго ключа.
+    duration = np.where(paid, (end - start).astype(np.int64), 0)
+    is_long = paid & (duration >= LONG_PERIOD_DAYS)
+    is_pair = paid & ~is_long & arrays["has_pair"]
+    is_solo = paid & ~is_long & ~is_pair
+    tariffs = {}
+    masks = {"solo": is_solo, "long": is_long, "pair": is_pair}
+    for name, mask in masks.items():
+        count = int(mask.sum())
+        tariffs[name] = {
+            "paid": count,
+            "active": int((mask & active).sum()),
+            "revenue": count * TARIFFS[name]["price"],
+        }
+
+    # Уровни скидки — те же пороги, что в get_discount_by_ref_count.
+    thresholds = sorted(threshold for threshold, _ in REFERRAL_DISCOUNTS)
+    discounts = [0] + [discount for _, discount in sorted(REFERRAL_DISCOUNTS)]
+    tiers = np.bincount(
+        np.digitize(arrays["ref_count"], thresholds),
+        minlength=len(discounts),
+    )
+
+    trials = int(had_trial.sum())
+    return {
+        "date": str(today),
+        "users": total,
+        "active": int(active.sum()),
+        "expiring": int(expiring.sum()),
+        "expiring_days": EXPIRING_DAYS,
+        "trial_active": int(trial_active.sum()),
+        "trials": trials,
+        "converted": int(converted.sum()),
+        "conversion": (
+            round(float(converted.sum()) / trials, 4) if trials else 0.0
+        ),
+        "tariffs": tariffs,
+        "revenue": sum(item["revenue"] for item in tariffs.values()),
+        "referrals": int(arrays["ref_count"].sum()),
+        "referral_tiers": {
+            str(discount): int(count)
+            for discount, count in zip(discounts, tiers)
+        },
+    }
+
+
+def render_stats(stats: dict) -> str:
+    """Текст статистики для сообщения администратору."""
+    lines = [
+        f"📊 Статистика на {stats['date']}",
+        f"Пользователей: {stats['users']}",
+        f"Активных подписок: {stats['active']}",
+        f"Истекают за {stats['expiring_days']} дн.: {stats['expiring']}",
+        f"Активных триалов: {stats['trial_active']}",
+        (
+            f"Конверсия триал → оплата: {stats['converted']}/"
+            f"{stats['trials']} ({stats['conversion']:.1%})"
+        ),
+        "",
+        "Тарифы (по последней оплате):",
+    ]
+    for name, item in stats["tariffs"].items():
+        lines.append(
+            f"  {name}: оплат {item['paid']}, активных {item['active']}, "
+            f"{item['revenue']}₽"
+        )
+    lines.append(f"Выручка по последним оплатам: {stats['revenue']}₽")
+    lines.append("")
+    lines.append(f"Приглашено рефералов: {stats['referrals']}")
+    for discount, count in stats["referral_tiers"].items():
+        lines.append(f"  скидка {discount}%: {count}")
+    return "\n".join(lines)
+
+
+class SubscriberAnalytics:
+    """Статистика с кэшем по версии снимка подписчиков.
+
+    Пока снимок тот же, повторный запрос отдаёт готовый результат; без
+    снимка записи читаются из хранилища и кэшируются на ttl секунд.
+    """
+
+    def __init__(self, manager, ttl: float = 60):
+        self.manager = manager
+        self.ttl = ttl
+        self._key = None
+        self._stats: Optional[dict] = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    def _source(self):
+        snapshot = self.manager.snapshot and self.manager.snapshot.current
+        if snapshot is not None:
+            return ("snapshot", snapshot.version), snapshot.records
+        return ("storage", None), self.manager.get_all_records
+
+    def stats(self, today: Optional[date] = None) -> dict:
+        """Показатели на сегодня; блокирующий вызов."""
+        today = today or datetime.today().date()
+        key, records = self._source()
+        key = (*key, today)
+        with self._lock:
+            fresh = key[1] is not None or (
+                time.monotonic() - self._built_at < self.ttl
+            )
+            if self._stats is not None and self._key == key and fresh:
+                return self._stats
+            started = time.perf_counter()
+            arrays = load_arrays(records(), self.manager.parse_date)
+            stats = compute_stats(arrays, today)
+            logging.info(
+                "Статистика по %s записям посчитана за %.3f с",
+                stats["users"],
+                time.perf_counter() - started,
+            )
+            self._key, self._stats = key, stats
+            self._built_at = time.monotonic()
+            return stats
+
+
+@lru_cache(maxsize=None)
+def get_analytics() -> SubscriberAnalytics:
+    return SubscriberAnalytics(get_subscription_manager())
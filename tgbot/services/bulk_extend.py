@@ -0,0 +1,359 @@
+"""Массовое продление подписок: акции и компенсация простоя.
+
+Задание сначала планируется: по фильтру (активные, тариф, окончание
+раньше даты) отбираются подписчики и для каждого считается новая дата
+окончания. План сохраняется в JSON, после чего новые даты пишутся в
+таблицу одним пакетным обновлением — кроме подписок, продлённых уже
+после планирования (их end_date не та, от которой считался план), —
+а expiryTime клиентов на панели обновляется пачками с ограниченной
+параллельностью. Прогресс
+сохраняется после каждой пачки, поэтому прерванное задание можно
+продолжить: даты в плане абсолютные, и повтор ничего не сдвигает.
+
+    python -m tgbot.services.bulk_extend 3 --tariff solo --dry-run
+    python -m tgbot.services.bulk_extend --resume <id>
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from tgbot.services.analytics import infer_tariff
+from tgbot.services.connect_table import (
+    SubscriptionManager,
+    get_subscription_manager,
+)
+from tgbot.services.enforcement import ConnectionPool
+from tgbot.services.quota import Priority, sheets_priority
+from tgbot.services.subscriptions import get_subscription_feed
+from vpn_utils import Connection
+
+DATE_FORMAT = "%d.%m.%Y"
+
+
+@dataclass
+class ExtendFilter:
+    """Кого продлевать: по умолчанию всех с активной подпиской."""
+
+    active_only: bool = True
+    tariff: Optional[str] = None
+    expiring_before: Optional[date] = None
+
+    def matches(
+        self,
+        start: Optional[date],
+        end: date,
+        pair_uuid: str,
+        today: date,
+    ) -> bool:
+        if self.active_only and end < today:
+            return False
+        if self.expiring_before and end >= self.expiring_before:
+            return False
+        if self.tariff and infer_tariff(start, end, pair_uuid) != self.tariff:
+            return False
+        return True
+
+    @classmethod
+    def parse(cls, args: List[str]) -> "ExtendFilter":
+        """Фильтр из аргументов команды: all, tariff=…, before=ДД.ММ.ГГГГ.
+
+        Неизвестный аргумент — ValueError.
+        """
+        flt = cls()
+        for arg in args:
+            key, _, value = arg.partition("=")
+            if arg == "all":
+                flt.active_only = False
+            elif key == "tariff" and value in ("solo", "long", "pair"):
+                flt.tariff = value
+            elif key == "before" and value:
+                flt.expiring_before = datetime.strptime(
+                    value, DATE_FORMAT
+                ).date()
+            else:
+                raise ValueError(f"Неизвестный аргумент: {arg}")
+        return flt
+
+    def describe(self) -> str:
+        parts = ["активные" if self.active_only else "все с подпиской"]
+        if self.tariff:
+            parts.append(f"тариф {self.tariff}")
+        if self.expiring_before:
+            parts.append(f"окончание до {self.expiring_before:%d.%m.%Y}")
+        return ", ".join(parts)
+
+
+@dataclass
+class BulkExtendJob:
+    """План и прогресс одного массового продления."""
+
+    job_id: str
+    days: int
+    filter: ExtendFilter
+    created: float = field(default_factory=time.time)
+    # user_id -> новая end_date, end_date на момент плана и UUID
+    # клиентов на панели.
+    ends: Dict[int, str] = field(default_factory=dict)
+    planned_from: Dict[int, str] = field(default_factory=dict)
+    clients: Dict[int, List[str]] = field(default_factory=dict)
+    storage_done: bool = False
+    # Продлены после планирования: не трогаются ни в таблице, ни на панели.
+    skipped: List[int] = field(default_factory=list)
+    pushed: List[int] = field(default_factory=list)
+    failed: List[int] = field(default_factory=list)
+    status: str = "planned"
+
+    @property
+    def pending(self) -> List[int]:
+        """Пользователи, чьи клиенты на панели ещё не обновлены."""
+        done = set(self.pushed) | set(self.skipped)
+        return [user_id for user_id in self.ends if user_id not in done]
+
+    def render(self) -> str:
+        """Сводка для администратора."""
+        total = len(self.ends) - len(self.skipped)
+        lines = [
+            f"Продление {self.job_id} на {self.days} дн. ({self.status})",
+            f"Фильтр: {self.filter.describe()}",
+            f"Подписчиков: {len(self.ends)}",
+            f"Таблица: {'обновлена' if self.storage_done else 'ожидает'}",
+            f"Панель: {len(self.pushed)}/{total}",
+        ]
+        if self.skipped:
+            lines.append(f"Продлены после плана: {len(self.skipped)}")
+        if self.failed:
+            lines.append(f"Ошибок панели: {len(self.failed)}")
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        expiring_before = self.filter.expiring_before
+        data["filter"]["expiring_before"] = (
+            expiring_before.isoformat() if expiring_before else None
+        )
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BulkExtendJob":
+        flt = dict(data.pop("filter"))
+        if flt.get("expiring_before"):
+            flt["expiring_before"] = date.fromisoformat(flt["expiring_before"])
+        # JSON хранит ключи словарей строками.
+        data["ends"] = {int(k): v for k, v in data["ends"].items()}
+        data["planned_from"] = {
+            int(k): v for k, v in data.get("planned_from", {}).items()
+        }
+        data["clients"] = {int(k): v for k, v in data["clients"].items()}
+        return cls(filter=ExtendFilter(**flt), **data)
+
+
+def expiry_ms(end: str) -> int:
+    """expiryTime панели для даты окончания: полночь после неё, мс."""
+    day = datetime.strptime(end, DATE_FORMAT) + timedelta(days=1)
+    return int(day.timestamp() * 1000)
+
+
+class BulkExtender:
+    """Планирует и выполняет массовые продления с возобновлением."""
+
+    def __init__(
+        self,
+        manager: SubscriptionManager,
+        connection_factory: Callable,
+        state_dir: str,
+        concurrency: int = 4,
+        batch_size: int = 50,
+    ):
+        self.manager = manager
+        self.connection_factory = connection_factory
+        self.state_dir = state_dir
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+
+    def plan(
+        self, days: int, flt: ExtendFilter, today: Optional[date] = None
+    ) -> BulkExtendJob:
+        """Отбирает подписчиков и сохраняет план; блокирующий вызов.
+
+        Новая дата — days дней от текущего окончания, а у истёкших —
+        от сегодня. Пользователи без оплаченной подписки не попадают.
+        Записи читаются из самой таблицы: при её недоступности —
+        исключение, а не план по устаревшему снимку.
+        """
+        today = today or datetime.today().date()
+        job = BulkExtendJob(uuid.uuid4().hex[:8], days, flt)
+        parse_date = self.manager.parse_date
+        for record in self.manager.get_live_records():
+            user_id = str(record.get("user_id", "")).strip()
+            end = parse_date(record.get("end_date"))
+            if not user_id.isdigit() or end is None:
+                continue
+            pair_uuid = str(record.get("client_uuid_pair", "")).strip()
+            start = parse_date(record.get("start_date"))
+            if not flt.matches(start, end, pair_uuid, today):
+                continue
+            user_id = int(user_id)
+            if user_id in job.ends:
+                continue
+            new_end = max(end, today) + timedelta(days=days)
+            job.ends[user_id] = new_end.strftime(DATE_FORMAT)
+            job.planned_from[user_id] = end.strftime(DATE_FORMAT)
+            clients = [str(record.get("client_uuid", "")).strip(), pair_uuid]
+            job.clients[user_id] = [client for client in clients if client]
+        self.save(job)
+        return job
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.state_dir, f"{job_id}.json")
+
+    def save(self, job: BulkExtendJob) -> None:
+        """Пишет состояние задания атомарно."""
+        os.makedirs(self.state_dir, exist_ok=True)
+        path = self._path(job.job_id)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(job.to_dict(), f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    def load(self, job_id: str) -> Optional[BulkExtendJob]:
+        try:
+            with open(self._path(job_id), encoding="utf-8") as f:
+                return BulkExtendJob.from_dict(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    async def _push_user(
+        self, pool: ConnectionPool, job: BulkExtendJob, user_id: int
+    ) -> bool:
+        expiry = expiry_ms(job.ends[user_id])
+        results = await asyncio.gather(
+            *(
+                pool.call("set_client_expiry", client, expiry)
+                for client in job.clients.get(user_id, ())
+            )
+        )
+        return all(results)
+
+    async def run(
+        self,
+        job: BulkExtendJob,
+        progress: Optional[Callable[[BulkExtendJob], Awaitable]] = None,
+    ) -> BulkExtendJob:
+        """Выполняет задание или продолжает прерванное.
+
+        Таблица обновляется один раз; пользователи, чью подписку
+        продлили после планирования, попадают в skipped и на панель не
+        пишутся. На панели повторяются только пользователи, ещё не
+        попавшие в pushed, включая прошлые ошибки.
+        """
+        job.status = "running"
+        if not job.storage_done:
+            with sheets_priority(Priority.ADMIN):
+                extended = await asyncio.to_thread(
+                    self.manager.extend_subscriptions,
+                    job.ends,
+                    job.planned_from,
+                )
+            job.skipped = [
+                user_id for user_id in job.ends if user_id not in extended
+            ]
+            job.storage_done = True
+            self.save(job)
+            get_subscription_feed().invalidate()
+            logging.info(
+                "Продление %s: в таблице продлено %s, пропущено %s",
+                job.job_id,
+                len(extended),
+                len(job.skipped),
+            )
+
+        pending = job.pending
+        job.failed = []
+        pool = ConnectionPool(self.connection_factory, self.concurrency)
+        for start in range(0, len(pending), self.batch_size):
+            batch = pending[start : start + self.batch_size]
+            results = await asyncio.gather(
+                *(self._push_user(pool, job, user_id) for user_id in batch)
+            )
+            for user_id, ok in zip(batch, results):
+                (job.pushed if ok else job.failed).append(user_id)
+            self.save(job)
+            logging.info(
+                "Продление %s: панель %s/%s, ошибок %s",
+                job.job_id,
+                len(job.pushed),
+                len(job.ends) - len(job.skipped),
+                len(job.failed),
+            )
+            if progress is not None:
+                await progress(job)
+
+        job.status = "failed" if job.failed else "done"
+        self.save(job)
+        return job
+
+
+@lru_cache(maxsize=None)
+def get_bulk_extender() -> BulkExtender:
+    return BulkExtender(
+        get_subscription_manager(),
+        Connection,
+        os.getenv(
+            "BULK_EXTEND_DIR",
+            os.path.join(tempfile.gettempdir(), "vpnbot-bulk-extend"),
+        ),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("days", type=int, nargs="?")
+    parser.add_argument("--all", action="store_true", help="и истёкшие")
+    parser.add_argument("--tariff", choices=("solo", "long", "pair"))
+    parser.add_argument("--before", help="окончание раньше ДД.ММ.ГГГГ")
+    parser.add_argument("--resume", help="продолжить задание по id")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s — %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    extender = get_bulk_extender()
+    if args.resume:
+        job = extender.load(args.resume)
+        if job is None:
+            parser.error(f"задание {args.resume} не найдено")
+    else:
+        if args.days is None or args.days <= 0:
+            parser.error("укажите число дней больше нуля")
+        flt = ExtendFilter(
+            active_only=not args.all,
+            tariff=args.tariff,
+            expiring_before=(
+                datetime.strptime(args.before, DATE_FORMAT).date()
+                if args.before
+                else None
+            ),
+        )
+        job = extender.plan(args.days, flt)
+    if not args.dry_run:
+        job = asyncio.run(extender.run(job))
+    print(job.render())
+
+
+if __name__ == "__main__":
+    main()
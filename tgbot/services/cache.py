@@ -0,0 +1,142 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Tuple, Union
+
+import redis
+
+UserId = Union[int, str]
+
+_MISSING = object()
+
+
+class SubscriberCache:
+    """Двухуровневый кэш записей подписчиков: память процесса + Redis.
+
+    Локальный near-cache отвечает без сетевых обращений, Redis делит
+    прогретые значения между репликами бота и веб-приложения. При записи
+    ключи пользователя удаляются из Redis, а в канал инвалидации
+    публикуется его user_id, чтобы остальные процессы сбросили свои копии.
+    """
+
+    CHANNEL = "vpnbot:subscribers:invalidate"
+    KINDS = ("record", "account")
+
+    def __init__(
+        self,
+        client: Optional[redis.Redis] = None,
+        ttl: int = 30,
+        local_ttl: float = 5.0,
+        max_local_items: int = 10000,
+        prefix: str = "vpnbot:subscriber",
+    ):
+        self.redis = client
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.max_local_items = max_local_items
+        self.prefix = prefix
+        self._local: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def _key(self, kind: str, user_id: UserId) -> str:
+        return f"{self.prefix}:{kind}:{user_id}"
+
+    def _get_local(self, kind: str, user_id: UserId) -> Any:
+        key = (kind, str(user_id))
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return _MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._local[key]
+                return _MISSING
+            self._local.move_to_end(key)
+            return value
+
+    def _set_local(self, kind: str, user_id: UserId, value: Any) -> None:
+        key = (kind, str(user_id))
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.local_ttl, value)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_local_items:
+                self._local.popitem(last=False)
+
+    def _evict_local(self, user_id: UserId) -> None:
+        with self._lock:
+            for kind in self.KINDS:
+                self._local.pop((kind, str(user_id)), None)
+
+    def get(
+        self, kind: str, user_id: UserId, loader: Callable[[], Any]
+    ) -> Any:
+        """Возвращает значение из кэша или загружает его через loader."""
+        value = self._get_local(kind, user_id)
+        if value is not _MISSING:
+            return value
+
+        if self.redis is not None:
+            try:
+                raw = self.redis.get(self._key(kind, user_id))
+            except redis.RedisError as e:
+                logging.warning("Redis недоступен при чтении кэша: %s", e)
+                raw = None
+            if raw is not None:
+                value = json.loads(raw)
+                self._set_local(kind, user_id, value)
+                return value
+
+        value = loader()
+        self.set(kind, user_id, value)
+        return value
+
+    def set(self, kind: str, user_id: UserId, value: Any) -> None:
+        """Кладёт значение в оба уровня кэша."""
+        self._set_local(kind, user_id, value)
+        if self.redis is None:
+            return
+        try:
+            self.redis.set(
+                self._key(kind, user_id), json.dumps(value), ex=self.ttl
+            )
+        except redis.RedisError as e:
+            logging.warning("Redis недоступен при записи кэша: %s", e)
+
+    def invalidate(self, user_id: UserId) -> None:
+        """Сбрасывает все закэшированные представления пользователя."""
+        self._evict_local(user_id)
+        if self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline()
+            pipe.delete(*(self._key(kind, user_id) for kind in self.KINDS))
+            pipe.publish(self.CHANNEL, str(user_id))
+            pipe.execute()
+        except redis.RedisError as e:
+            logging.warning("Не удалось инвалидировать кэш %s: %s", user_id, e)
+
+    def clear_local(self) -> None:
+        with self._lock:
+            self._local.clear()
+
+    def _on_message(self, message: dict) -> None:
+        self._evict_local(message["data"])
+
+    def start_listener(self) -> None:
+        """Подписывается на канал инвалидации в фоновом потоке."""
+        if self.redis is None or self._listener is not None:
+            return
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.CHANNEL: self._on_message})
+        self._listener = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+        logging.info("Подписка на инвалидацию кэша подписчиков запущена")
+
+    def stop_listener(self) -> None:
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
@@ -1,41 +1,206 @@
 import asyncio
 import logging
 import os
+import tempfile
 from datetime import datetime, timedelta
-from typing import Optional
+from functools import lru_cache
+from typing import Dict, List, Optional, Set
 
-import gspread
 from aiogram import Bot
 from aiogram.exceptions import TelegramForbiddenError
-from oauth2client.service_account import ServiceAccountCredentials
 
+from constants import JSON_PATH, SCOPE
 from tgbot.keyboards.inline import to_payment
+from tgbot.services import journal
+from tgbot.services.cache import SubscriberCache
+from tgbot.services.metrics import InstrumentedProxy, instrument
+from tgbot.services.quota import (
+    Priority,
+    ScheduledWorksheet,
+    get_sheets_scheduler,
+    sheets_priority,
+)
+from tgbot.services.redis_client import get_redis
+from tgbot.services.resilience import get_policy
+from tgbot.services.sheets import SheetsClient
+from tgbot.services.snapshot import SnapshotStore
+from tgbot.services.storage import MemoryWorksheet, SqliteWorksheet
+from tgbot.services.tasks import TaskRejected, get_task_supervisor
+from tgbot.services.trials import TrialIndex, trial_allowed
+
+# Порядок колонок листа подписчиков (A–K).
+COLUMNS = [
+    "user_id",
+    "username",
+    "start_date",
+    "end_date",
+    "start_trial_period",
+    "end_trial_period",
+    "last_trial_used",
+    "client_uuid",
+    "client_uuid_pair",
+    "referrer_id",
+    "ref_count",
+]
+
+
+def column(name: str) -> int:
+    """Номер колонки листа (с 1) по имени поля."""
+    return COLUMNS.index(name) + 1
+
+
+def cell_range(row: int, first: str, last: Optional[str] = None) -> str:
+    """Диапазон A1 строки row от поля first до поля last."""
+    start = chr(ord("A") + column(first) - 1)
+    end = chr(ord("A") + column(last or first) - 1)
+    return f"{start}{row}:{end}{row}"
 
 
 class SubscriptionManager:
     """Класс для управления подписками и интеграцией с Google Sheets."""
 
-    def __init__(self, json_path: str, sheet_key: str):
-        self.scope = [
-            "https://spreadsheets.google.com/feeds",
-            "https://www.googleapis.com/auth/drive",
-        ]
+    def __init__(
+        self,
+        json_path: str,
+        sheet_key: str,
+        cache: Optional[SubscriberCache] = None,
+        sheet=None,
+        snapshot: Optional[SnapshotStore] = None,
+        events: Optional[journal.EventJournal] = None,
+    ):
+        self.scope = SCOPE
         self.json_path = json_path
         self.sheet_key = sheet_key
-        self.sheet = self._connect_to_google_sheets()
+        self.cache = cache or SubscriberCache()
+        self.trials = TrialIndex()
+        self.snapshot = snapshot
+        self.events = events
+        self._sheet = sheet
+        # Пока таблица не прочитана после старта, записи берутся из
+        # снимка; пользователи, изменённые за это время, — из таблицы.
+        self._caught_up = snapshot is None
+        self._changed_since_snapshot: Set[str] = set()
+
+    @property
+    def sheet(self):
+        """Лист таблицы; подключение выполняется при первом обращении."""
+        if self._sheet is None:
+            self._sheet = self._connect_to_google_sheets()
+        return self._sheet
 
+    @instrument("sheets", "connect")
     def _connect_to_google_sheets(self):
-        """Подключение к Google Sheets."""
-        creds = ServiceAccountCredentials.from_json_keyfile_name(
-            self.json_path, self.scope
+        """Подключение к Google Sheets через общий клиент процесса."""
+        return open_google_sheet(
+            self.json_path, self.sheet_key, tuple(self.scope)
         )
-        client = gspread.authorize(creds)
-        return client.open_by_key(self.sheet_key).sheet1
 
     def _get_records(self):
         """Возвращает все записи из таблицы."""
         return self.sheet.get_all_records()
 
+    def _read_records(self) -> List[dict]:
+        """Записи для чтения; при недоступной таблице — из снимка.
+
+        Только для путей без записи: номера строк снимка могут не
+        совпадать с текущим листом.
+        """
+        try:
+            return self._get_records()
+        except Exception as e:
+            snapshot = self.snapshot and self.snapshot.current
+            if snapshot is None:
+                raise
+            logging.warning("Таблица недоступна, чтение из снимка: %s", e)
+            return list(snapshot.records())
+
+    def get_all_records(self) -> List[dict]:
+        """Все записи подписчиков, в обход кэша."""
+        return self._read_records()
+
+    def get_live_records(self) -> List[dict]:
+        """Все записи из самой таблицы, без запасного снимка.
+
+        Для заданий, которые выключают, удаляют или продлевают по
+        записям: устаревший снимок для них хуже пропущенного прохода.
+        """
+        return self._get_records()
+
+    def _changed(self, user_id) -> None:
+        """Запись пользователя изменена: сбросить кэш и не верить снимку."""
+        if not self._caught_up:
+            self._changed_since_snapshot.add(str(user_id))
+        self.cache.invalidate(user_id)
+
+    def _record(
+        self, event_type: str, user_id, fields: dict = None, **data
+    ) -> None:
+        """Дописывает событие в журнал; таблица уже обновлена.
+
+        Потерянное событие восстановит сверка журнала с таблицей.
+        """
+        if self.events is None:
+            return
+        try:
+            self.events.append(event_type, int(user_id), fields, **data)
+        except Exception:
+            logging.exception(
+                "Событие %s для %s не записано в журнал", event_type, user_id
+            )
+
+    def refresh_snapshot(self) -> int:
+        """Читает таблицу, сохраняет снимок и прогревает индекс триалов.
+
+        После первого успешного вызова чтения идут из таблицы, а снимок
+        остаётся запасным вариантом на время её недоступности.
+        """
+        since = self.trials.mark()
+        records = self._get_records()
+        self.trials.warm(records, self.parse_date, since)
+        if self.snapshot is not None:
+            self.snapshot.save(records)
+        self._caught_up = True
+        self._changed_since_snapshot.clear()
+        return len(records)
+
+    def _find_row(self, records, user_id: int) -> Optional[int]:
+        """Номер строки листа для user_id или None."""
+        for i, record in enumerate(records):
+            if str(record.get("user_id")) == str(user_id):
+                return i + 2
+        return None
+
+    def _snapshot_record(self, user_id: int) -> Optional[dict]:
+        snapshot = self.snapshot and self.snapshot.current
+        if snapshot is None or not str(user_id).isdigit():
+            return None
+        return snapshot.lookup(int(user_id))
+
+    def _load_record(self, user_id: int) -> Optional[dict]:
+        if (
+            not self._caught_up
+            and str(user_id) not in self._changed_since_snapshot
+        ):
+            record = self._snapshot_record(user_id)
+            if record is not None:
+                return record
+        try:
+            records = self._get_records()
+        except Exception as e:
+            record = self._snapshot_record(user_id)
+            if record is None:
+                raise
+            logging.warning("Таблица недоступна, запись из снимка: %s", e)
+            return record
+        row = self._find_row(records, user_id)
+        return records[row - 2] if row else None
+
+    def get_record(self, user_id: int) -> Optional[dict]:
+        """Запись подписчика через кэш; лист читается только при промахе."""
+        return self.cache.get(
+            "record", user_id, lambda: self._load_record(user_id)
+        )
+
     @staticmethod
     def parse_date(date_value) -> Optional[datetime.date]:
         """Пытается распарсить дату из строки или объекта datetime."""
@@ -63,41 +228,79 @@ class SubscriptionManager:
         days: int = 30,
         client_uuid: str = "",
         referrer_id: int = None,
+        pair_uuid: str = "",
     ) -> None:
-        """Создать или обновить подписку пользователя."""
+        """Создать или обновить подписку пользователя.
+
+        Даты и UUID (включая второй ключ парной подписки) записываются
+        одним вызовом к таблице.
+        """
         records = self._get_records()
         today = datetime.now().date()
         start = today.strftime("%d.%m.%Y")
         end = (today + timedelta(days=days + 1)).strftime("%d.%m.%Y")
 
-        for i, record in enumerate(records):
-            if str(record.get("user_id")) == str(user_id):
-                row = i + 2
-                self.sheet.update_cell(row, 3, start)
-                self.sheet.update_cell(row, 4, end)
-                if client_uuid:
-                    self.sheet.update_cell(row, 8, client_uuid)
-                return
-
-        self.sheet.append_row(
-            [
-                user_id,
-                username,
-                "",
-                "",
-                "",
-                "",
-                "",  # C–G
-                client_uuid,
-                "",
-                referrer_id,
-                0,
+        row = self._find_row(records, user_id)
+        if row:
+            updates = [
+                {
+                    "range": cell_range(row, "start_date", "end_date"),
+                    "values": [[start, end]],
+                }
             ]
+            for name, value in (
+                ("client_uuid", client_uuid),
+                ("client_uuid_pair", pair_uuid),
+            ):
+                if value:
+                    updates.append(
+                        {"range": cell_range(row, name), "values": [[value]]}
+                    )
+            self.sheet.batch_update(updates, value_input_option="USER_ENTERED")
+            self._changed(user_id)
+            previous_end = self.parse_date(records[row - 2].get("end_date"))
+            fields = {"start_date": start, "end_date": end}
+            if client_uuid:
+                fields["client_uuid"] = client_uuid
+            if pair_uuid:
+                fields["client_uuid_pair"] = pair_uuid
+            self._record(
+                (
+                    journal.RENEWED
+                    if previous_end and previous_end >= today
+                    else journal.PAYMENT_SUCCEEDED
+                ),
+                user_id,
+                fields,
+                days=days,
+            )
+            return
+
+        row_values = [
+            user_id,
+            username,
+            start,
+            end,
+            "",
+            "",
+            "",  # C–G
+            client_uuid,
+            pair_uuid,
+            referrer_id,
+            0,
+        ]
+        self.sheet.append_row(row_values)
+        self._changed(user_id)
+        self._record(
+            journal.PAYMENT_SUCCEEDED,
+            user_id,
+            dict(zip(COLUMNS, row_values)),
+            days=days,
         )
 
     def get_user_uuid(self, user_id: int) -> Optional[str]:
         """Возвращает UUID клиента по user_id."""
-        records = self._get_records()
+        records = self._read_records()
         for record in reversed(records):
             if str(record.get("user_id")) == str(user_id):
                 uuid_val = record.get("client_uuid")
@@ -122,38 +325,48 @@ class SubscriptionManager:
         for i, record in enumerate(records):
             if str(record.get("user_id")) == str(user_id):
                 row = i + 2
-                last_trial = record.get("last_trial_used")
-                if last_trial:
-                    try:
-                        last_trial_date = self.parse_date(last_trial)
-                        if (
-                            last_trial_date
-                            and (today - last_trial_date).days < 180
-                        ):
-                            return False
-                    except Exception:
-                        pass
+                last_trial = self.parse_date(record.get("last_trial_used"))
+                if not trial_allowed(last_trial, today):
+                    self.trials.record(user_id, last_trial)
+                    return False
                 self.sheet.update_cell(row, 5, start)
                 self.sheet.update_cell(row, 6, end)
                 self.sheet.update_cell(row, 7, start)
                 if client_uuid:
                     self.sheet.update_cell(row, 8, client_uuid)
+                self.trials.record(user_id, today)
+                self._changed(user_id)
+                fields = {
+                    "start_trial_period": start,
+                    "end_trial_period": end,
+                    "last_trial_used": start,
+                }
+                if client_uuid:
+                    fields["client_uuid"] = client_uuid
+                self._record(journal.TRIAL_GRANTED, user_id, fields, days=days)
                 return True
 
-        self.sheet.append_row(
-            [
-                user_id,
-                username,
-                "",
-                "",
-                "",
-                "",
-                "",  # C–G
-                client_uuid,
-                "",
-                referrer_id,
-                0,
-            ]
+        row_values = [
+            user_id,
+            username,
+            "",
+            "",
+            start,
+            end,
+            start,  # C–G
+            client_uuid,
+            "",
+            referrer_id,
+            0,
+        ]
+        self.sheet.append_row(row_values)
+        self.trials.record(user_id, today)
+        self._changed(user_id)
+        self._record(
+            journal.TRIAL_GRANTED,
+            user_id,
+            dict(zip(COLUMNS, row_values)),
+            days=days,
         )
         return True
 
@@ -168,9 +381,185 @@ class SubscriptionManager:
                     current_count = int(current_count)
                 except Exception:
                     current_count = 0
-                self.sheet.update_cell(row, 10, current_count + 1)
+                self.sheet.update_cell(
+                    row, column("ref_count"), current_count + 1
+                )
+                self._changed(referrer_id)
+                self._record(
+                    journal.REFERRAL_COUNTED,
+                    referrer_id,
+                    {"ref_count": current_count + 1},
+                )
                 return
 
+    def register_user(
+        self, user_id: int, username: str, referrer_id: int = None
+    ) -> None:
+        """Регистрирует пользователя или обновляет его username.
+
+        В журнал попадает новая строка или изменившиеся поля, а не
+        каждый /start.
+        """
+        records = self._get_records()
+        row = self._find_row(records, user_id)
+        if row:
+            record = records[row - 2]
+            fields = {}
+            self.sheet.update_cell(row, column("username"), username)
+            if str(record.get("username", "")) != str(username):
+                fields["username"] = username
+            if referrer_id and not record.get("referrer_id"):
+                self.sheet.update_cell(row, column("referrer_id"), referrer_id)
+                fields["referrer_id"] = referrer_id
+            self._changed(user_id)
+            if fields:
+                self._record(journal.PROFILE_UPDATED, user_id, fields)
+            return
+
+        row_values = [
+            user_id,
+            username,
+            "",
+            "",
+            "",
+            "",
+            "",
+            "",
+            "",
+            referrer_id,
+            0,
+        ]
+        self.sheet.append_row(row_values)
+        self._changed(user_id)
+        self._record(
+            journal.REGISTERED, user_id, dict(zip(COLUMNS, row_values))
+        )
+
+    def apply_referral_bonus(self, user_id: int, days: int = 5) -> None:
+        """Продлевает подписку пригласившего после оплаты приглашённого."""
+        records = self._get_records()
+        user_row = self._find_row(records, user_id)
+        if not user_row:
+            return
+
+        referrer_id = records[user_row - 2].get("referrer_id")
+        if not referrer_id:
+            return
+
+        row = self._find_row(records, referrer_id)
+        if not row:
+            return
+        referrer_record = records[row - 2]
+
+        end_date = self.parse_date(referrer_record.get("end_date", ""))
+        today = datetime.today().date()
+        if not end_date or end_date < today:
+            logging.warning(
+                "Не начисляем бонус: подписка у %s не активна", referrer_id
+            )
+            return
+
+        new_end = end_date + timedelta(days=days)
+        self.sheet.update_cell(
+            row, column("end_date"), new_end.strftime("%d.%m.%Y")
+        )
+        old_count = int(referrer_record.get("ref_count", 0) or 0)
+        self.sheet.update_cell(row, column("ref_count"), old_count + 1)
+        self._changed(referrer_id)
+        self._record(
+            journal.REFERRAL_BONUS,
+            referrer_id,
+            {
+                "end_date": new_end.strftime("%d.%m.%Y"),
+                "ref_count": old_count + 1,
+            },
+            invited=user_id,
+            days=days,
+        )
+
+        logging.info(
+            "Бонус для user_id=%s: +%s дней, +1 к ref_count",
+            referrer_id,
+            days,
+        )
+
+    def extend_subscriptions(
+        self, ends: Dict[int, str], planned_from: Dict[int, str]
+    ) -> Set[int]:
+        """Ставит новые даты окончания одним пакетным обновлением листа.
+
+        ends — user_id -> новая end_date (ДД.ММ.ГГГГ), planned_from — его
+        end_date, от которой она посчитана. Строка, где end_date уже не
+        planned_from (подписку продлили после планирования), не
+        трогается. Даты абсолютные: строка, где end_date уже новая,
+        считается продлённой, поэтому повторный вызов ничего не сдвигает.
+        Возвращает пользователей, чья end_date теперь равна новой.
+        """
+        if not ends:
+            return set()
+        records = self._get_records()
+        rows, extended = {}, set()
+        for i, record in enumerate(records):
+            user_id = str(record.get("user_id", "")).strip()
+            if not user_id.isdigit() or int(user_id) not in ends:
+                continue
+            user_id = int(user_id)
+            if user_id in rows or user_id in extended:
+                continue
+            current = self.parse_date(record.get("end_date"))
+            if current == self.parse_date(ends[user_id]):
+                extended.add(user_id)
+            elif current == self.parse_date(planned_from.get(user_id)):
+                rows[user_id] = i + 2
+        if rows:
+            self.sheet.batch_update(
+                [
+                    {
+                        "range": cell_range(row, "end_date"),
+                        "values": [[ends[user_id]]],
+                    }
+                    for user_id, row in rows.items()
+                ],
+                value_input_option="USER_ENTERED",
+            )
+        for user_id in rows:
+            self._changed(user_id)
+            self._record(
+                journal.EXTENDED,
+                user_id,
+                {"end_date": ends[user_id]},
+                previous_end=planned_from.get(user_id),
+            )
+        return extended | set(rows)
+
+    def clear_client_uuids(self, uuids: Dict[int, Set[str]]) -> int:
+        """Стирает UUID удалённых клиентов из записей подписчиков.
+
+        uuids — user_id -> UUID клиентов удалённых inbound. Колонка
+        очищается, только если в ней записан один из этих UUID, так что
+        созданное позже подключение не затрагивается. Возвращает число
+        очищенных ячеек.
+        """
+        if not uuids:
+            return 0
+        records = self._get_records()
+        cleared = 0
+        for user_id, removed in uuids.items():
+            row = self._find_row(records, user_id)
+            if not row:
+                continue
+            record = records[row - 2]
+            fields = {}
+            for field in ("client_uuid", "client_uuid_pair"):
+                if str(record.get(field, "")).strip() in removed:
+                    self.sheet.update_cell(row, column(field), "")
+                    fields[field] = ""
+            cleared += len(fields)
+            self._changed(user_id)
+            if fields:
+                self._record(journal.KEYS_CLEARED, user_id, fields)
+        return cleared
+
     async def send_payment_notification(self, bot: Bot, user_id: int) -> None:
         """Отправить уведомление о завершении подписки."""
         await bot.send_message(
@@ -184,7 +573,8 @@ class SubscriptionManager:
     ) -> None:
         """Проверяет подписки и отправляет уведомления об окончании."""
         try:
-            records = self._get_records()
+            with sheets_priority(Priority.ADMIN):
+                records = await asyncio.to_thread(self._read_records)
             today = datetime.today().date()
             logging.info("📅 Проверка подписок на %s", today)
 
@@ -233,7 +623,152 @@ class SubscriptionManager:
         except Exception as e:
             logging.exception("💥 Ошибка при проверке подписок: %s", e)
 
-    def schedule_daily_check(self, bot: Bot, admin_id: int = None) -> None:
-        """Запускает асинхронную проверку подписок."""
+    def schedule_daily_check(self, bot: Bot, admin_id: int = None) -> bool:
+        """Запускает проверку подписок; False — она уже идёт."""
         logging.info("✅ Запуск проверки подписок вручную")
-        asyncio.create_task(self.check_expiration_dates(bot, admin_id))
+        try:
+            get_task_supervisor().spawn(
+                "expiry_check", self.check_expiration_dates(bot, admin_id)
+            )
+        except TaskRejected:
+            logging.info("Проверка подписок уже выполняется")
+            return False
+        return True
+
+
+@lru_cache(maxsize=None)
+def get_subscription_manager() -> SubscriptionManager:
+    """Возвращает общий для процесса SubscriptionManager."""
+    cache = SubscriberCache(
+        get_redis(),
+        ttl=int(os.getenv("SUBSCRIBER_CACHE_TTL", "30")),
+        local_ttl=float(os.getenv("SUBSCRIBER_LOCAL_CACHE_TTL", "5")),
+    )
+    cache.start_listener()
+    backend = os.getenv("STORAGE_BACKEND", "sheets")
+    snapshot = None
+    if backend == "sheets":
+        snapshot = SnapshotStore(
+            os.getenv(
+                "SNAPSHOT_PATH",
+                os.path.join(tempfile.gettempdir(), "vpnbot-subscribers.snap"),
+            ),
+            COLUMNS,
+        )
+        snapshot.load()
+    return SubscriptionManager(
+        json_path=os.getenv("GOOGLE_CREDENTIALS_PATH", JSON_PATH),
+        sheet_key=os.getenv("SHEET_KEY", ""),
+        cache=cache,
+        sheet=create_storage_backend(backend),
+        snapshot=snapshot,
+        events=journal.get_event_journal(),
+    )
+
+
+async def catch_up_subscribers() -> None:
+    """Догоняет таблицу после старта процесса.
+
+    Пока идёт чтение листа, запросы обслуживает снимок с диска, а индекс
+    триалов прогревается из него же. Снимок старше процесса, поэтому
+    все уже сделанные процессом записи триалов остаются поверх него.
+    """
+    manager = get_subscription_manager()
+    snapshot = manager.snapshot and manager.snapshot.current
+    if snapshot is not None:
+        await asyncio.to_thread(
+            manager.trials.warm, snapshot.records(), parse_date, 0
+        )
+    try:
+        size = await asyncio.to_thread(manager.refresh_snapshot)
+        logging.info("Таблица подписчиков прочитана: %s записей", size)
+    except Exception:
+        logging.exception("Не удалось прочитать таблицу подписчиков")
+
+
+@lru_cache(maxsize=None)
+def get_sheets_client(json_path: str, scopes: tuple) -> SheetsClient:
+    """Общий авторизованный клиент Sheets для учётных данных."""
+    return SheetsClient(json_path, scopes).start()
+
+
+def open_google_sheet(json_path: str, sheet_key: str, scopes: tuple):
+    """Лист Google Sheets с квотой, автоматом и метриками."""
+    client = get_sheets_client(json_path, scopes)
+    worksheet = client.open_worksheet(sheet_key)
+    return ScheduledWorksheet(
+        InstrumentedProxy(worksheet, "sheets"),
+        get_sheets_scheduler(),
+        policy=get_policy("sheets"),
+        set_timeout=client.set_timeout,
+    )
+
+
+def sqlite_path() -> str:
+    """Файл базы подписчиков для STORAGE_BACKEND=sqlite (SQLITE_PATH)."""
+    return os.getenv(
+        "SQLITE_PATH",
+        os.path.join(tempfile.gettempdir(), "vpnbot-subscribers.sqlite3"),
+    )
+
+
+def create_storage_backend(name: str):
+    """Лист для STORAGE_BACKEND; None — подключиться к Google Sheets.
+
+    sqlite — локальная база, которую с листом сводит sheet_sync.
+    """
+    if name == "sheets":
+        return None
+    if name == "memory":
+        latency = float(os.getenv("STORAGE_LATENCY_MS", "0")) / 1000
+        return InstrumentedProxy(MemoryWorksheet(COLUMNS, latency), "memory")
+    if name == "sqlite":
+        return InstrumentedProxy(
+            SqliteWorksheet(sqlite_path(), COLUMNS), "sqlite"
+        )
+    raise ValueError(f"Неизвестное хранилище: {name}")
+
+
+def connect_to_google_sheets():
+    """Возвращает лист таблицы подписчиков."""
+    return get_subscription_manager().sheet
+
+
+parse_date = SubscriptionManager.parse_date
+
+
+def get_user_uuid(user_id: int) -> Optional[str]:
+    return get_subscription_manager().get_user_uuid(user_id)
+
+
+def get_subscriber(user_id: int) -> Optional[dict]:
+    return get_subscription_manager().get_record(user_id)
+
+
+def upsert_subscription_to_sheet(
+    user_id: int,
+    username: str,
+    days: int = 30,
+    client_uuid: str = "",
+    referrer_id: int = None,
+    pair_uuid: str = "",
+) -> None:
+    get_subscription_manager().upsert_subscription(
+        user_id, username, days, client_uuid, referrer_id, pair_uuid
+    )
+
+
+def upsert_trial_period(
+    user_id: int,
+    username: str,
+    days: int = 3,
+    client_uuid: str = "",
+    referrer_id: int = None,
+) -> bool:
+    return get_subscription_manager().upsert_trial(
+        user_id, username, days, client_uuid, referrer_id
+    )
+
+
+def schedule_daily_check(bot: Bot, admin_id: int = None) -> bool:
+    return get_subscription_manager().schedule_daily_check(bot, admin_id)
@@ -0,0 +1,263 @@
+import abc
+import asyncio
+import fcntl
+import logging
+import os
+import tempfile
+import time
+import uuid
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from redis import asyncio as aioredis
+
+from tgbot.services.redis_client import get_async_redis
+
+_RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class LockNotAcquired(Exception):
+    """Не удалось получить блокировку за отведённое время."""
+
+
+class LockLost(LockNotAcquired):
+    """Аренда блокировки истекла, пока блок под ней выполнялся."""
+
+
+class Coordinator(abc.ABC):
+    """Блокировки, флаги и выбор лидера для нескольких процессов.
+
+    Наследники реализуют примитивы acquire/renew/release и флаги,
+    а общая логика — ожидание блокировки и цикл фоновых задач,
+    которые выполняет только текущий лидер.
+    """
+
+    @abc.abstractmethod
+    async def acquire(self, name: str, ttl: float) -> Optional[str]:
+        """Токен блокировки name на ttl секунд или None, если она занята."""
+
+    @abc.abstractmethod
+    async def renew(self, name: str, token: str, ttl: float) -> bool:
+        """Продлевает аренду; False — блокировка уже не наша."""
+
+    @abc.abstractmethod
+    async def release(self, name: str, token: str) -> None:
+        """Снимает блокировку, если она ещё наша."""
+
+    @abc.abstractmethod
+    async def set_flag(self, name: str, value: str, ttl: float) -> None:
+        """Ставит флаг name на ttl секунд."""
+
+    @abc.abstractmethod
+    async def get_flag(self, name: str) -> Optional[str]:
+        """Значение флага или None, если его нет или он истёк."""
+
+    @asynccontextmanager
+    async def lock(
+        self, name: str, ttl: float = 120, timeout: float = 30
+    ) -> AsyncIterator[None]:
+        """Взаимное исключение по имени между всеми процессами.
+
+        Пока блок выполняется, аренда продлевается каждые ttl/3 секунд,
+        так что ttl ограничивает только время жизни блокировки упавшего
+        процесса, а не длительность работы под ней. Если аренда потеряна
+        (её мог взять другой процесс), блок, закончившийся без
+        исключения, завершается LockLost: его работа шла без взаимного
+        исключения.
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while True:
+            token = await self.acquire(name, ttl)
+            if token is not None:
+                break
+            if time.monotonic() >= deadline:
+                raise LockNotAcquired(name)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1.0)
+        keeper = asyncio.create_task(self._keep(name, token, ttl))
+        try:
+            yield
+        finally:
+            lost = keeper.done() and not keeper.cancelled()
+            keeper.cancel()
+            await self.release(name, token)
+        if lost:
+            raise LockLost(name)
+
+    async def _keep(self, name: str, token: str, ttl: float) -> None:
+        """Продлевает аренду блокировки, пока её держит владелец.
+
+        Возвращается, только когда блокировка потеряна.
+        """
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if not await self.renew(name, token, ttl):
+                    logging.warning("Блокировка %s потеряна", name)
+                    return
+            except Exception as e:
+                logging.warning("Блокировка %s не продлена: %s", name, e)
+
+    def user_lock(self, user_id, ttl: float = 120, timeout: float = 30):
+        return self.lock(f"user:{user_id}", ttl=ttl, timeout=timeout)
+
+    def payment_lock(self, payment_id: str, ttl: float = 120):
+        return self.lock(f"payment:{payment_id}", ttl=ttl)
+
+    async def run_as_leader(
+        self,
+        job_name: str,
+        job: Callable[[], Awaitable[None]],
+        interval: float,
+        lease: float = 30,
+    ) -> None:
+        """Периодически выполняет job, но только в процессе-лидере.
+
+        Лидерство — это аренда ключа leader:<job_name>, которую лидер
+        продлевает каждые lease/3 секунд. Время последнего запуска
+        хранится во флаге, поэтому при смене лидера задача не
+        выполняется повторно раньше срока.
+        """
+        lock_name = f"leader:{job_name}"
+        last_run_flag = f"last_run:{job_name}"
+        token: Optional[str] = None
+        tick = lease / 3
+        while True:
+            try:
+                if token is None:
+                    token = await self.acquire(lock_name, lease)
+                    if token is not None:
+                        logging.info(
+                            "Процесс стал лидером задачи %s", job_name
+                        )
+                elif not await self.renew(lock_name, token, lease):
+                    logging.warning("Лидерство в задаче %s потеряно", job_name)
+                    token = None
+
+                if token is not None:
+                    last_run = float(await self.get_flag(last_run_flag) or 0)
+                    if time.time() - last_run >= interval:
+                        await self.set_flag(
+                            last_run_flag, str(time.time()), interval * 2
+                        )
+                        await job()
+            except asyncio.CancelledError:
+                if token is not None:
+                    await self.release(lock_name, token)
+                raise
+            except Exception as e:
+                logging.exception("Ошибка фоновой задачи %s: %s", job_name, e)
+            await asyncio.sleep(tick)
+
+
+class RedisCoordinator(Coordinator):
+    """Координация через Redis: работает между процессами и хостами."""
+
+    def __init__(self, client: aioredis.Redis, prefix: str = "vpnbot:coord"):
+        self.redis = client
+        self.prefix = prefix
+
+    def _key(self, name: str) -> str:
+        return f"{self.prefix}:{name}"
+
+    async def acquire(self, name: str, ttl: float) -> Optional[str]:
+        token = uuid.uuid4().hex
+        ok = await self.redis.set(
+            self._key(name), token, nx=True, px=int(ttl * 1000)
+        )
+        return token if ok else None
+
+    async def renew(self, name: str, token: str, ttl: float) -> bool:
+        result = await self.redis.eval(
+            _RENEW_SCRIPT, 1, self._key(name), token, int(ttl * 1000)
+        )
+        return bool(result)
+
+    async def release(self, name: str, token: str) -> None:
+        await self.redis.eval(_RELEASE_SCRIPT, 1, self._key(name), token)
+
+    async def set_flag(self, name: str, value: str, ttl: float) -> None:
+        await self.redis.set(self._key(name), value, px=int(ttl * 1000))
+
+    async def get_flag(self, name: str) -> Optional[str]:
+        return await self.redis.get(self._key(name))
+
+
+class FileLockCoordinator(Coordinator):
+    """Координация через advisory-блокировки flock на одном хосте.
+
+    Подходит для нескольких воркеров uvicorn без Redis. Блокировка
+    держится, пока открыт файл, поэтому ttl не используется: при падении
+    процесса ядро снимает её само.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = Path(
+            directory or Path(tempfile.gettempdir()) / "vpnbot-locks"
+        )
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._held: Dict[str, int] = {}
+
+    def _path(self, name: str) -> Path:
+        return self.directory / name.replace("/", "_").replace(":", "_")
+
+    async def acquire(self, name: str, ttl: float) -> Optional[str]:
+        if name in self._held:
+            return None
+        fd = os.open(self._path(name), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        self._held[name] = fd
+        return name
+
+    async def renew(self, name: str, token: str, ttl: float) -> bool:
+        return name in self._held
+
+    async def release(self, name: str, token: str) -> None:
+        fd = self._held.pop(name, None)
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    async def set_flag(self, name: str, value: str, ttl: float) -> None:
+        path = self._path(f"{name}.flag")
+        path.write_text(f"{time.time() + ttl}\n{value}")
+
+    async def get_flag(self, name: str) -> Optional[str]:
+        try:
+            expires_at, value = (
+                self._path(f"{name}.flag").read_text().split("\n", 1)
+            )
+        except (FileNotFoundError, ValueError):
+            return None
+        return value if float(expires_at) > time.time() else None
+
+
+@lru_cache(maxsize=None)
+def get_coordinator() -> Coordinator:
+    """Redis, если он настроен; иначе — файловые блокировки хоста."""
+    client = get_async_redis()
+    if client is not None:
+        return RedisCoordinator(client)
+    logging.warning(
+        "Redis не настроен: координация воркеров только в пределах хоста"
+    )
+    return FileLockCoordinator(os.getenv("LOCK_DIR"))
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import date, datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from tgbot.services.connect_table import SubscriptionManager
+from tgbot.services.metrics import ENFORCEMENT_ACTIONS
+from tgbot.services.subscriptions import get_subscription_feed
+from vpn_utils import inbound_client_ids, parse_remark
+
+
+@dataclass
+class EnforcementReport:
+    """Итог прохода: сколько inbound выключено, включено и не удалось."""
+
+    disabled: int = 0
+    enabled: int = 0
+    failed: int = 0
+
+    @property
+    def reclaimed(self) -> int:
+        """Слушатели Xray, освобождённые этим проходом."""
+        return self.disabled
+
+
+def index_records(records: Iterable[dict]) -> Dict[int, dict]:
+    """Записи подписчиков по user_id."""
+    index = {}
+    for record in records:
+        user_id = str(record.get("user_id", "")).strip()
+        if user_id.isdigit():
+            index[int(user_id)] = record
+    return index
+
+
+def access_end(
+    inbound: dict, kind: str, record: Optional[dict]
+) -> Optional[date]:
+    """До какого дня inbound должен работать; None — данных нет.
+
+    Пробный inbound живёт до end_trial_period, основной и парный — до
+    end_date. Если клиент пробного inbound записан как client_uuid,
+    продление шло через него, и он живёт до end_date тоже.
+    """
+    if record is None:
+        return None
+    fields = ["end_trial_period"] if kind == "prob" else ["end_date"]
+    if kind == "prob" and str(record.get("client_uuid", "")).strip() in (
+        inbound_client_ids(inbound)
+    ):
+        fields.append("end_date")
+    ends = [
+        SubscriptionManager.parse_date(record.get(field)) for field in fields
+    ]
+    ends = [end for end in ends if end]
+    return max(ends) if ends else None
+
+
+def plan_enforcement(
+    inbounds: Iterable[dict], records: Dict[int, dict], today: date
+) -> Tuple[List[dict], List[dict]]:
+    """Inbound, которые нужно выключить, и inbound, которые включить."""
+    to_disable, to_enable = [], []
+    for inbound in inbounds:
+        parsed = parse_remark(inbound.get("remark"))
+        if parsed is None:
+            continue
+        user_id, kind = parsed
+        end = access_end(inbound, kind, records.get(user_id))
+        if end is None:
+            continue
+        enabled = bool(inbound.get("enable"))
+        if end < today and enabled:
+            to_disable.append(inbound)
+        elif end >= today and not enabled:
+            to_enable.append(inbound)
+    return to_disable, to_enable
+
+
+class ConnectionPool:
+    """Ограниченный набор сессий панели для параллельных вызовов.
+
+    Connection держит requests.Session и токен, поэтому одновременно
+    каждую использует только один поток; вызовы, которым не хватило
+    сессии, ждут. Неудачный вызов (False или исключение) повторяется
+    retries раз с экспоненциальной паузой.
+    """
+
+    def __init__(
+        self,
+        connection_factory: Callable,
+        size: int = 4,
+        retries: int = 3,
+        backoff: float = 1.0,
+    ):
+        self.retries = retries
+        self.backoff = backoff
+        self._free: asyncio.Queue = asyncio.Queue()
+        for _ in range(size):
+            self._free.put_nowait(connection_factory())
+
+    async def call(self, method: str, *args) -> bool:
+        for attempt in range(self.retries):
+            connection = await self._free.get()
+            try:
+                ok = bool(
+                    await asyncio.to_thread(getattr(connection, method), *args)
+                )
+            except Exception:
+                logging.exception("Ошибка вызова панели %s%s", method, args)
+                ok = False
+            finally:
+                self._free.put_nowait(connection)
+            if ok:
+                return True
+            if attempt + 1 < self.retries:
+                await asyncio.sleep(self.backoff * 2**attempt)
+        return False
+
+
+class EnforcementSweeper:
+    """Выключает на панели inbound с истёкшей подпиской или триалом.
+
+    Срок действия хранится только в таблице, а create_inbound создаёт
+    inbound без expiryTime, поэтому без прохода истёкшие пользователи
+    сохраняют работающих слушателей Xray. Проход читает список inbound
+    один раз и обновляет их пачками по batch_size; одновременных запросов
+    к панели не больше concurrency, у каждого своя сессия Connection.
+    Inbound, срок которых снова актуален (продление), включаются обратно.
+    """
+
+    def __init__(
+        self,
+        connection_factory: Callable,
+        records_loader: Callable[[], List[dict]],
+        concurrency: int = 4,
+        batch_size: int = 50,
+        retries: int = 3,
+        backoff: float = 1.0,
+    ):
+        self.connection_factory = connection_factory
+        self.records_loader = records_loader
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+
+    async def _run_batches(
+        self, pool: ConnectionPool, inbounds: List[dict], enabled: bool
+    ) -> Tuple[int, int]:
+        done = failed = 0
+        action = "enable" if enabled else "disable"
+        for start in range(0, len(inbounds), self.batch_size):
+            batch = inbounds[start : start + self.batch_size]
+            results = await asyncio.gather(
+                *(
+                    pool.call("set_inbound_enabled", inbound, enabled)
+                    for inbound in batch
+                )
+            )
+            for ok in results:
+                result = "ok" if ok else "failed"
+                ENFORCEMENT_ACTIONS.labels(action, result).inc()
+            done += sum(results)
+            failed += len(results) - sum(results)
+            logging.info(
+                "Enforcement %s: %s/%s",
+                action,
+                start + len(batch),
+                len(inbounds),
+            )
+        return done, failed
+
+    async def sweep(self, today: Optional[date] = None) -> EnforcementReport:
+        """Один проход; панель и таблица читаются по одному разу."""
+        today = today or datetime.today().date()
+        report = EnforcementReport()
+
+        connection = self.connection_factory()
+        data = await asyncio.to_thread(connection.list_inbounds)
+        if not data.get("success", True) or "obj" not in data:
+            logging.warning("Enforcement пропущен: панель вернула %s", data)
+            return report
+        try:
+            loaded = await asyncio.to_thread(self.records_loader)
+        except Exception as e:
+            logging.warning("Enforcement пропущен: таблица недоступна: %s", e)
+            return report
+        records = index_records(loaded)
+
+        to_disable, to_enable = plan_enforcement(
+            data["obj"] or [], records, today
+        )
+        if not to_disable and not to_enable:
+            logging.info("Enforcement: изменений нет")
+            return report
+
+        pool = ConnectionPool(
+            self.connection_factory,
+            self.concurrency,
+            self.retries,
+            self.backoff,
+        )
+
+        report.disabled, failed = await self._run_batches(
+            pool, to_disable, False
+        )
+        report.failed += failed
+        report.enabled, failed = await self._run_batches(pool, to_enable, True)
+        report.failed += failed
+        if report.disabled or report.enabled:
+            get_subscription_feed().invalidate()
+
+        logging.info(
+            "Enforcement: выключено %s, включено %s, ошибок %s",
+            report.disabled,
+            report.enabled,
+            report.failed,
+        )
+        return report
@@ -0,0 +1,297 @@
+"""Сборка устаревших inbound на панели X-UI.
+
+Пробные inbound (user_<id>_prob) и подключения истёкших подписок
+никогда не удаляются: они занимают порты 50102–52999 и раздувают каждый
+ответ /panel/inbound/list. Сборка удаляет inbound, доступ по которым
+закончился больше grace_days дней назад, стирает их UUID из таблицы и
+возвращает порты в пул. Удаление идёт под блокировками пользователей
+по перечитанным записям: подписку, продлённую во время сборки, она не
+трогает.
+
+    python -m tgbot.services.inbound_gc --days 14 --dry-run
+"""
+
+import argparse
+import asyncio
+import logging
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set
+
+from dotenv import load_dotenv
+
+from tgbot.services.connect_table import (
+    SubscriptionManager,
+    get_subscription_manager,
+)
+from tgbot.services.coordination import (
+    LockLost,
+    LockNotAcquired,
+    get_coordinator,
+)
+from tgbot.services.enforcement import (
+    ConnectionPool,
+    access_end,
+    inbound_client_ids,
+    index_records,
+)
+from tgbot.services.subscriptions import get_subscription_feed
+from vpn_utils import PORT_POOL, Connection, PortPool, parse_remark
+
+
+@dataclass
+class StaleInbound:
+    id: int
+    remark: str
+    port: int
+    user_id: int
+    ended: date
+    client_ids: Set[str] = field(default_factory=set, repr=False)
+
+
+@dataclass
+class GCReport:
+    dry_run: bool
+    grace_days: int
+    stale: List[StaleInbound] = field(default_factory=list)
+    deleted: int = 0
+    failed: int = 0
+    cleared_uuids: int = 0
+    free_ports: int = 0
+
+    def render(self) -> str:
+        """Отчёт для лога и администратора."""
+        mode = "пробный прогон" if self.dry_run else "удаление"
+        lines = [
+            f"Сборка inbound ({mode}), старше {self.grace_days} дн.:",
+            f"  устаревших: {len(self.stale)}",
+        ]
+        if not self.dry_run:
+            lines += [
+                f"  удалено: {self.deleted}, ошибок: {self.failed}",
+                f"  очищено UUID в таблице: {self.cleared_uuids}",
+            ]
+        lines.append(f"  свободных портов: {self.free_ports}")
+        for item in self.stale[:20]:
+            lines.append(
+                f"  - #{item.id} {item.remark} порт {item.port},"
+                f" доступ до {item.ended:%d.%m.%Y}"
+            )
+        if len(self.stale) > 20:
+            lines.append(f"  … и ещё {len(self.stale) - 20}")
+        return "\n".join(lines)
+
+
+def find_stale(
+    inbounds: List[dict], records: Dict[int, dict], cutoff: date
+) -> List[StaleInbound]:
+    """Inbound, доступ по которым закончился раньше cutoff."""
+    stale = []
+    for inbound in inbounds:
+        parsed = parse_remark(inbound.get("remark"))
+        if parsed is None:
+            continue
+        user_id, kind = parsed
+        end = access_end(inbound, kind, records.get(user_id))
+        if end is None or end >= cutoff:
+            continue
+        stale.append(
+            StaleInbound(
+                id=int(inbound["id"]),
+                remark=inbound["remark"],
+                port=int(inbound.get("port") or 0),
+                user_id=user_id,
+                ended=end,
+                client_ids=inbound_client_ids(inbound),
+            )
+        )
+    return stale
+
+
+class StaleInboundCollector:
+    """Удаляет устаревшие inbound пачками и освобождает их порты."""
+
+    def __init__(
+        self,
+        connection_factory: Callable,
+        manager: SubscriptionManager,
+        grace_days: int = 14,
+        concurrency: int = 4,
+        port_pool: PortPool = PORT_POOL,
+        batch_size: int = 50,
+        lock_timeout: float = 5,
+    ):
+        self.connection_factory = connection_factory
+        self.manager = manager
+        self.grace_days = grace_days
+        self.concurrency = concurrency
+        self.port_pool = port_pool
+        self.batch_size = batch_size
+        self.lock_timeout = lock_timeout
+
+    async def collect(
+        self, dry_run: bool = False, today: Optional[date] = None
+    ) -> GCReport:
+        today = today or datetime.today().date()
+        report = GCReport(dry_run=dry_run, grace_days=self.grace_days)
+
+        connection = self.connection_factory()
+        data = await asyncio.to_thread(connection.list_inbounds)
+        if not data.get("success", True) or "obj" not in data:
+            logging.warning("Сборка inbound пропущена: ответ панели %s", data)
+            return report
+        inbounds = data["obj"] or []
+        try:
+            loaded = await asyncio.to_thread(self.manager.get_live_records)
+        except Exception as e:
+            logging.warning(
+                "Сборка inbound пропущена: таблица недоступна: %s", e
+            )
+            return report
+        records = index_records(loaded)
+
+        cutoff = today - timedelta(days=self.grace_days)
+        report.stale = find_stale(inbounds, records, cutoff)
+        used = {int(inb.get("port") or 0) for inb in inbounds}
+        if dry_run or not report.stale:
+            report.free_ports = self.port_pool.free_count(used)
+            self._log(report)
+            return report
+
+        pool = ConnectionPool(self.connection_factory, self.concurrency)
+        users = sorted({item.user_id for item in report.stale})
+        deleted: List[StaleInbound] = []
+        for start in range(0, len(users), self.batch_size):
+            deleted += await self._collect_users(
+                pool,
+                users[start : start + self.batch_size],
+                inbounds,
+                cutoff,
+                report,
+            )
+
+        if deleted:
+            get_subscription_feed().invalidate()
+        freed = [item.port for item in deleted]
+        self.port_pool.release(freed)
+        report.free_ports = self.port_pool.free_count(used - set(freed))
+        self._log(report)
+        return report
+
+    async def _collect_users(
+        self,
+        pool: ConnectionPool,
+        users: List[int],
+        inbounds: List[dict],
+        cutoff: date,
+        report: GCReport,
+    ) -> List[StaleInbound]:
+        """Удаляет устаревшие inbound пачки пользователей под их блокировками.
+
+        Пока блокировки взяты, продление не пройдёт. Занятые пользователи
+        пропускаются до следующей сборки.
+        """
+        coordinator = get_coordinator()
+        deleted: List[StaleInbound] = []
+        try:
+            async with AsyncExitStack() as stack:
+                locked = set()
+                for user_id in users:
+                    try:
+                        await stack.enter_async_context(
+                            coordinator.user_lock(
+                                user_id, timeout=self.lock_timeout
+                            )
+                        )
+                    except LockNotAcquired:
+                        logging.info(
+                            "Сборка inbound: пользователь %s занят", user_id
+                        )
+                        continue
+                    locked.add(user_id)
+                if locked:
+                    deleted = await self._delete_locked(
+                        pool, locked, inbounds, cutoff, report
+                    )
+        except LockLost as e:
+            logging.warning(
+                "Сборка inbound: блокировка %s потеряна во время удаления", e
+            )
+        return deleted
+
+    async def _delete_locked(
+        self,
+        pool: ConnectionPool,
+        locked: Set[int],
+        inbounds: List[dict],
+        cutoff: date,
+        report: GCReport,
+    ) -> List[StaleInbound]:
+        """Перечитывает записи и удаляет то, что устарело и по ним."""
+        try:
+            loaded = await asyncio.to_thread(self.manager.get_live_records)
+        except Exception as e:
+            logging.warning(
+                "Сборка inbound: пачка пропущена, таблица недоступна: %s", e
+            )
+            return []
+        planned = {item.id for item in report.stale if item.user_id in locked}
+        candidates = [
+            inbound for inbound in inbounds if int(inbound["id"]) in planned
+        ]
+        stale = find_stale(candidates, index_records(loaded), cutoff)
+        results = await asyncio.gather(
+            *(pool.call("delete_inbound", item.id) for item in stale)
+        )
+        deleted = [item for item, ok in zip(stale, results) if ok]
+        report.deleted += len(deleted)
+        report.failed += len(results) - len(deleted)
+
+        removed: Dict[int, Set[str]] = {}
+        for item in deleted:
+            removed.setdefault(item.user_id, set()).update(item.client_ids)
+        report.cleared_uuids += await asyncio.to_thread(
+            self.manager.clear_client_uuids, removed
+        )
+        return deleted
+
+    @staticmethod
+    def _log(report: GCReport) -> None:
+        logging.info(
+            "Сборка inbound%s: устаревших %s, удалено %s, ошибок %s,"
+            " очищено UUID %s, свободных портов %s",
+            " (пробный прогон)" if report.dry_run else "",
+            len(report.stale),
+            report.deleted,
+            report.failed,
+            report.cleared_uuids,
+            report.free_ports,
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s — %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    collector = StaleInboundCollector(
+        Connection,
+        get_subscription_manager(),
+        grace_days=args.days,
+        concurrency=args.concurrency,
+    )
+    report = asyncio.run(collector.collect(dry_run=args.dry_run))
+    print(report.render())
+
+
+if __name__ == "__main__":
+    main()
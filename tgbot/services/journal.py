@@ -0,0 +1,367 @@
+"""Журнал событий подписок и материализованные представления над ним.
+
+Таблица хранит только текущее состояние: ячейки перезаписываются на
+месте. Журнал — append-only поток Redis (XADD), общий для бота и
+miniapp: SubscriptionManager дописывает в него событие после каждой
+записи в таблицу (регистрация, триал, оплата, продление, реферальный
+бонус). Правки, сделанные мимо бота (администратор в листе, sheet_sync),
+попадают в журнал событием sheet_edited: задание сверки сравнивает
+таблицу с представлением и дописывает расхождения.
+
+Из журнала инкрементально строятся представления — состояние
+подписчиков, счётчики рефералов и индекс окончаний подписок, — а при
+необходимости их можно пересобрать с нуля повторным проигрыванием.
+Без Redis журнал живёт в памяти процесса.
+
+    python -m tgbot.services.journal [--user ID]
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+import redis
+from dotenv import load_dotenv
+
+from tgbot.services.redis_client import get_redis
+
+REGISTERED = "registered"
+PROFILE_UPDATED = "profile_updated"
+TRIAL_GRANTED = "trial_granted"
+PAYMENT_SUCCEEDED = "payment_succeeded"
+RENEWED = "renewed"
+REFERRAL_COUNTED = "referral_counted"
+REFERRAL_BONUS = "referral_bonus"
+EXTENDED = "extended"
+KEYS_CLEARED = "keys_cleared"
+SHEET_EDITED = "sheet_edited"
+SHEET_REMOVED = "sheet_removed"
+
+
+def _text(value: Any) -> str:
+    return "" if value is None else str(value).strip()
+
+
+@dataclass
+class Event:
+    """Событие журнала.
+
+    fields — новые значения полей записи подписчика (как в листе), по
+    ним строятся представления; data — подробности для истории.
+    """
+
+    type: str
+    user_id: int
+    fields: Dict[str, str] = field(default_factory=dict)
+    data: Dict[str, Any] = field(default_factory=dict)
+    ts: float = field(default_factory=time.time)
+    id: str = ""
+
+    def to_entry(self) -> Dict[str, str]:
+        return {
+            "type": self.type,
+            "user_id": str(self.user_id),
+            "ts": repr(self.ts),
+            "fields": json.dumps(self.fields, ensure_ascii=False),
+            "data": json.dumps(self.data, ensure_ascii=False),
+        }
+
+    @classmethod
+    def from_entry(cls, entry_id: str, entry: Dict[str, str]) -> "Event":
+        return cls(
+            type=entry["type"],
+            user_id=int(entry["user_id"]),
+            fields=json.loads(entry.get("fields") or "{}"),
+            data=json.loads(entry.get("data") or "{}"),
+            ts=float(entry.get("ts") or 0),
+            id=entry_id,
+        )
+
+
+class _Batch:
+    def __init__(self):
+        self.events: List[Event] = []
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class EventJournal:
+    """Append-only журнал событий с групповой фиксацией.
+
+    append() ставит событие в текущую пачку и ждёт, пока фоновый поток не
+    запишет её в поток Redis одним конвейером XADD: одновременные записи
+    платят за обращение к Redis один раз. Номер события — ID записи
+    потока, монотонный для всех процессов.
+    """
+
+    def __init__(
+        self,
+        client: Optional[redis.Redis],
+        key: str = "vpnbot:events",
+        commit_interval: float = 0.005,
+        max_batch: int = 512,
+        read_chunk: int = 1000,
+    ):
+        self.client = client
+        self.key = key
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.read_chunk = read_chunk
+        self._local: List[Event] = []
+        self._batch = _Batch()
+        self._cond = threading.Condition()
+        self._writer: Optional[threading.Thread] = None
+
+    def append(
+        self,
+        type: str,
+        user_id: int,
+        fields: Optional[Dict[str, Any]] = None,
+        **data: Any,
+    ) -> Event:
+        """Дописывает событие; возвращает его после записи в поток."""
+        event = Event(
+            type,
+            int(user_id),
+            {name: _text(value) for name, value in (fields or {}).items()},
+            data,
+        )
+        with self._cond:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._write_loop, name="event-journal", daemon=True
+                )
+                self._writer.start()
+            batch = self._batch
+            batch.events.append(event)
+            self._cond.notify()
+        batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+        return event
+
+    def _write_loop(self) -> None:
+        while True:
+            with self._cond:
+                while not self._batch.events:
+                    self._cond.wait()
+            # Даём соседним вызовам попасть в ту же пачку.
+            time.sleep(self.commit_interval)
+            with self._cond:
+                batch, self._batch = self._batch, _Batch()
+            try:
+                self._commit(batch.events)
+            except BaseException as e:
+                logging.exception("Не удалось записать журнал событий")
+                batch.error = e
+            batch.done.set()
+
+    def _commit(self, events: List[Event]) -> None:
+        if self.client is None:
+            for event in events:
+                event.id = f"{len(self._local) + 1}-0"
+                self._local.append(event)
+            return
+        for start in range(0, len(events), self.max_batch):
+            chunk = events[start : start + self.max_batch]
+            pipe = self.client.pipeline(transaction=False)
+            for event in chunk:
+                pipe.xadd(self.key, event.to_entry())
+            for event, entry_id in zip(chunk, pipe.execute()):
+                event.id = entry_id
+
+    def read(self, after: str = "0-0") -> Iterator[Event]:
+        """События с ID больше after, по порядку."""
+        if self.client is None:
+            yield from self._local[int(after.split("-")[0]) :]
+            return
+        while True:
+            response = self.client.xread(
+                {self.key: after}, count=self.read_chunk
+            )
+            if not response:
+                return
+            entries = response[0][1]
+            for entry_id, entry in entries:
+                after = entry_id
+                try:
+                    yield Event.from_entry(entry_id, entry)
+                except (KeyError, ValueError, TypeError):
+                    logging.warning("Пропущено повреждённое событие %s", after)
+            if len(entries) < self.read_chunk:
+                return
+
+
+def _day(value: Any) -> Optional[date]:
+    try:
+        return datetime.strptime(_text(value), "%d.%m.%Y").date()
+    except ValueError:
+        return None
+
+
+class SubscriberViews:
+    """Представления, которые поддерживаются по журналу инкрементально.
+
+    state — запись подписчика в полях листа, referrals — число
+    приглашённых, expiry — индекс дата окончания -> user_id. Каждый запрос
+    сначала применяет события, появившиеся с прошлого раза.
+    """
+
+    def __init__(self, journal: EventJournal):
+        self.journal = journal
+        self.state: Dict[int, Dict[str, str]] = {}
+        self.referrals: Dict[int, int] = {}
+        self.expiry: Dict[date, Set[int]] = {}
+        self.last_id = "0-0"
+        self._lock = threading.RLock()
+
+    def catch_up(self) -> int:
+        """Применяет новые события журнала; возвращает их число."""
+        with self._lock:
+            applied = 0
+            for event in self.journal.read(self.last_id):
+                self.apply(event)
+                self.last_id = event.id
+                applied += 1
+            return applied
+
+    def _index_end(self, user_id: int, old: Any, new: Any) -> None:
+        old, new = _day(old), _day(new)
+        if old == new:
+            return
+        if old in self.expiry:
+            self.expiry[old].discard(user_id)
+            if not self.expiry[old]:
+                del self.expiry[old]
+        if new:
+            self.expiry.setdefault(new, set()).add(user_id)
+
+    def apply(self, event: Event) -> None:
+        user_id = event.user_id
+        record = self.state.get(user_id, {})
+        if event.type == SHEET_REMOVED:
+            self._index_end(user_id, record.get("end_date"), None)
+            self.state.pop(user_id, None)
+            self.referrals.pop(user_id, None)
+            return
+        self.state[user_id] = record
+        self._index_end(
+            user_id,
+            record.get("end_date"),
+            event.fields.get("end_date", record.get("end_date")),
+        )
+        record.update(event.fields)
+        record["user_id"] = str(user_id)
+        try:
+            self.referrals[user_id] = int(record.get("ref_count") or 0)
+        except ValueError:
+            self.referrals[user_id] = 0
+
+    def reconcile(
+        self,
+        load_records: Callable[[], List[dict]],
+        columns: List[str],
+    ) -> int:
+        """Дописывает в журнал правки таблицы, сделанные мимо бота.
+
+        Журнал дочитывается до чтения таблицы: событие пишется после
+        записи в лист, поэтому всё, что уже есть в представлении, есть и
+        в прочитанных записях. В событие попадают только отличающиеся
+        поля; первая сверка переносит в журнал всю таблицу. Возвращает
+        число дописанных событий.
+        """
+        with self._lock:
+            self.catch_up()
+            records = load_records()
+            seen: Set[int] = set()
+            events = 0
+            for record in records:
+                user_id = _text(record.get("user_id"))
+                if not user_id.isdigit() or int(user_id) in seen:
+                    continue
+                user_id = int(user_id)
+                seen.add(user_id)
+                current = self.state.get(user_id, {})
+                changed = {
+                    name: _text(record.get(name))
+                    for name in columns
+                    if name != "user_id"
+                    and _text(record.get(name)) != current.get(name, "")
+                }
+                if changed or user_id not in self.state:
+                    self.journal.append(SHEET_EDITED, user_id, changed)
+                    events += 1
+            for user_id in set(self.state) - seen:
+                self.journal.append(SHEET_REMOVED, user_id)
+                events += 1
+            self.catch_up()
+            return events
+
+    def subscriber(self, user_id: int) -> Optional[Dict[str, str]]:
+        self.catch_up()
+        record = self.state.get(int(user_id))
+        return dict(record) if record else None
+
+    def referral_count(self, user_id: int) -> int:
+        self.catch_up()
+        return self.referrals.get(int(user_id), 0)
+
+    def expiring(self, first: date, last: date) -> List[int]:
+        """user_id с окончанием подписки в [first, last]."""
+        self.catch_up()
+        users: List[int] = []
+        day = first
+        while day <= last:
+            users.extend(sorted(self.expiry.get(day, ())))
+            day += timedelta(days=1)
+        return users
+
+
+@lru_cache(maxsize=None)
+def get_event_journal() -> EventJournal:
+    """Общий журнал событий (поток Redis JOURNAL_STREAM)."""
+    return EventJournal(
+        get_redis(), os.getenv("JOURNAL_STREAM", "vpnbot:events")
+    )
+
+
+@lru_cache(maxsize=None)
+def get_subscriber_views() -> SubscriberViews:
+    return SubscriberViews(get_event_journal())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Проиграть журнал событий подписок"
+    )
+    parser.add_argument("--user", type=int, help="история одного user_id")
+    args = parser.parse_args()
+
+    load_dotenv()
+    journal = get_event_journal()
+    if args.user is not None:
+        for event in journal.read():
+            if event.user_id == args.user:
+                print(json.dumps(asdict(event), ensure_ascii=False))
+        return
+
+    views = SubscriberViews(journal)
+    events = views.catch_up()
+    today = datetime.today().date()
+    print(f"событий: {events}, подписчиков: {len(views.state)}")
+    print(f"рефералов: {sum(views.referrals.values())}")
+    print(
+        "истекают за 7 дней:",
+        len(views.expiring(today, today + timedelta(days=7))),
+    )
+
+
+if __name__ == "__main__":
+    main()
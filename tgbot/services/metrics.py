@@ -0,0 +1,212 @@
+import functools
+import inspect
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+
+from tgbot.services.tracing import span
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+
+DEPENDENCY_LATENCY = Histogram(
+    "vpnbot_dependency_latency_seconds",
+    "Время вызова внешней зависимости",
+    ["dependency", "operation"],
+    buckets=LATENCY_BUCKETS,
+)
+DEPENDENCY_ERRORS = Counter(
+    "vpnbot_dependency_errors_total",
+    "Ошибки вызовов внешней зависимости",
+    ["dependency", "operation"],
+)
+DEPENDENCY_IN_FLIGHT = Gauge(
+    "vpnbot_dependency_in_flight",
+    "Вызовы внешней зависимости, выполняющиеся сейчас",
+    ["dependency", "operation"],
+    multiprocess_mode="livesum",
+)
+QUEUE_DEPTH = Gauge(
+    "vpnbot_queue_depth",
+    "Размер очередей и число фоновых задач",
+    ["queue"],
+    multiprocess_mode="livesum",
+)
+REQUEST_LATENCY = Histogram(
+    "vpnbot_request_latency_seconds",
+    "Полное время HTTP-запроса или обработчика бота",
+    ["kind", "name"],
+    buckets=LATENCY_BUCKETS,
+)
+THROTTLED_EVENTS = Counter(
+    "vpnbot_throttled_events_total",
+    "События бота, отброшенные ограничителем частоты",
+    ["key", "reason"],
+)
+DEDUPLICATED_REQUESTS = Counter(
+    "vpnbot_deduplicated_requests_total",
+    "Повторные операции, слитые с уже выполняющейся",
+    ["operation", "scope"],
+)
+QUOTA_WAIT = Histogram(
+    "vpnbot_sheets_quota_wait_seconds",
+    "Ожидание квоты Google Sheets перед вызовом",
+    ["kind", "priority"],
+    buckets=LATENCY_BUCKETS,
+)
+ENFORCEMENT_ACTIONS = Counter(
+    "vpnbot_enforcement_actions_total",
+    "Включения и выключения inbound проходом по истёкшим подпискам",
+    ["action", "result"],
+)
+BACKGROUND_TASKS = Gauge(
+    "vpnbot_background_tasks",
+    "Фоновые задачи супервизора: выполняются и ждут слота",
+    ["group", "state"],
+    multiprocess_mode="livesum",
+)
+BACKGROUND_TASK_RESULTS = Counter(
+    "vpnbot_background_task_results_total",
+    "Завершённые и отклонённые фоновые задачи",
+    ["group", "result"],
+)
+CIRCUIT_STATE = Gauge(
+    "vpnbot_circuit_state",
+    "Состояние автомата зависимости: 0 замкнут, 1 проба, 2 разомкнут",
+    ["dependency"],
+    multiprocess_mode="max",
+)
+CIRCUIT_REJECTIONS = Counter(
+    "vpnbot_circuit_rejections_total",
+    "Вызовы, отклонённые разомкнутым автоматом",
+    ["dependency"],
+)
+DEPENDENCY_RETRIES = Counter(
+    "vpnbot_dependency_retries_total",
+    "Повторы идемпотентных вызовов зависимости",
+    ["dependency"],
+)
+DEPENDENCY_TIMEOUT = Gauge(
+    "vpnbot_dependency_timeout_seconds",
+    "Текущий адаптивный таймаут вызова зависимости",
+    ["dependency"],
+    multiprocess_mode="max",
+)
+
+
+@contextmanager
+def track(dependency: str, operation: str) -> Iterator[None]:
+    """Замеряет вызов: латентность, ошибки и число одновременных вызовов.
+
+    Внутри trace() вызов также попадает в дерево замеров запроса.
+    """
+    labels = (dependency, operation)
+    in_flight = DEPENDENCY_IN_FLIGHT.labels(*labels)
+    in_flight.inc()
+    start = time.perf_counter()
+    try:
+        with span(f"{dependency}.{operation}"):
+            yield
+    except BaseException:
+        DEPENDENCY_ERRORS.labels(*labels).inc()
+        raise
+    finally:
+        DEPENDENCY_LATENCY.labels(*labels).observe(time.perf_counter() - start)
+        in_flight.dec()
+
+
+def instrument(
+    dependency: str,
+    operation: Optional[str] = None,
+    falsy_is_error: bool = False,
+) -> Callable:
+    """Декоратор для track(); работает с обычными и async-функциями.
+
+    falsy_is_error — для методов, которые не бросают исключения, а
+    сообщают об ошибке пустым результатом (None, False, {}).
+    """
+
+    def decorator(func: Callable) -> Callable:
+        op = operation or func.__name__
+
+        def check(result: Any) -> Any:
+            if falsy_is_error and not result:
+                DEPENDENCY_ERRORS.labels(dependency, op).inc()
+            return result
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with track(dependency, op):
+                    return check(await func(*args, **kwargs))
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track(dependency, op):
+                return check(func(*args, **kwargs))
+
+        return wrapper
+
+    return decorator
+
+
+class InstrumentedProxy:
+    """Обёртка над клиентом: каждый публичный метод замеряется track()."""
+
+    def __init__(self, target: Any, dependency: str):
+        self._target = target
+        self._dependency = dependency
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        return instrument(self._dependency, name)(attr)
+
+
+def render_metrics() -> Tuple[bytes, str]:
+    """Текст метрик в формате Prometheus и его content-type.
+
+    При PROMETHEUS_MULTIPROC_DIR метрики собираются со всех воркеров.
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_metrics_server(port: Optional[int] = None) -> None:
+    """HTTP-экспортёр метрик для процесса бота (METRICS_PORT)."""
+    port = port or int(os.getenv("METRICS_PORT", "0"))
+    if port:
+        start_http_server(port)
@@ -0,0 +1,375 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import redis
+
+from tgbot.services.metrics import QUEUE_DEPTH, QUOTA_WAIT
+from tgbot.services.redis_client import get_redis
+from tgbot.services.resilience import TRANSIENT, DependencyPolicy
+
+# ARGV: rate, capacity, now, действие (take, peek, drain), TTL в мс.
+_SHARED_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(redis.call("HGET", KEYS[1], "t") or capacity)
+local updated = tonumber(redis.call("HGET", KEYS[1], "ts") or now)
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local taken = 0
+if ARGV[4] == "take" and tokens >= 1 then
+    tokens = tokens - 1
+    taken = 1
+elseif ARGV[4] == "drain" then
+    tokens = 0
+end
+redis.call("HSET", KEYS[1], "t", tokens, "ts", now)
+redis.call("PEXPIRE", KEYS[1], ARGV[5])
+return {taken, tostring(tokens)}
+"""
+
+
+class Priority(IntEnum):
+    """Классы вызовов Sheets; меньшее значение обслуживается раньше."""
+
+    PAYMENT = 0
+    TRIAL = 1
+    PAGE_VIEW = 2
+    ADMIN = 3
+
+
+# Сколько вызов готов ждать квоту, прежде чем сдаться, секунды.
+DEFAULT_DEADLINES = {
+    Priority.PAYMENT: 120.0,
+    Priority.TRIAL: 30.0,
+    Priority.PAGE_VIEW: 10.0,
+    Priority.ADMIN: 600.0,
+}
+
+_priority: ContextVar[Priority] = ContextVar(
+    "sheets_priority", default=Priority.PAGE_VIEW
+)
+
+
+@contextmanager
+def sheets_priority(priority: Priority) -> Iterator[None]:
+    """Класс для вызовов Sheets внутри блока, включая asyncio.to_thread."""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+# Самая короткая пауза головы очереди между попытками взять токен:
+# бакет мог пополниться между try_take и wait_time.
+MIN_WAIT = 0.05
+
+
+class QuotaTimeout(Exception):
+    """Квота Sheets не освободилась до дедлайна вызова."""
+
+
+class TokenBucket:
+    """Бюджет запросов: rate в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def try_take(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    def wait_time(self) -> float:
+        """Через сколько секунд появится целый токен."""
+        with self._lock:
+            self._refill()
+            return max(0.0, (1 - self.tokens) / self.rate)
+
+    def drain(self) -> None:
+        """Обнуляет бюджет, когда API уже ответил 429."""
+        with self._lock:
+            self.tokens = 0
+            self.updated = time.monotonic()
+
+
+class RedisTokenBucket:
+    """TokenBucket в Redis: одна квота проекта на все процессы.
+
+    Интерфейс тот же, что у TokenBucket. Пока Redis недоступен, бюджет
+    считается локально, как без Redis.
+    """
+
+    def __init__(
+        self, client: redis.Redis, key: str, rate: float, capacity: float
+    ):
+        self.redis = client
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        self.local = TokenBucket(rate, capacity)
+        self._ttl_ms = int(capacity / rate * 2000) + 1000
+
+    def _call(self, action: str) -> Optional[Tuple[bool, float]]:
+        try:
+            taken, tokens = self.redis.eval(
+                _SHARED_BUCKET_SCRIPT,
+                1,
+                self.key,
+                self.rate,
+                self.capacity,
+                time.time(),
+                action,
+                self._ttl_ms,
+            )
+        except redis.RedisError as e:
+            logging.warning("Redis недоступен, квота Sheets локальная: %s", e)
+            return None
+        return bool(taken), float(tokens)
+
+    def try_take(self) -> bool:
+        result = self._call("take")
+        return self.local.try_take() if result is None else result[0]
+
+    def wait_time(self) -> float:
+        result = self._call("peek")
+        if result is None:
+            return self.local.wait_time()
+        return max(0.0, (1 - result[1]) / self.rate)
+
+    def drain(self) -> None:
+        if self._call("drain") is None:
+            self.local.drain()
+
+
+class QuotaScheduler:
+    """Очередь вызовов Sheets с приоритетами поверх квоты API.
+
+    Для чтений и записей свой токен-бакет под поминутную квоту проекта.
+    Вызов, которому не хватило токена, не падает с 429, а ждёт в очереди:
+    токен достаётся ожидающему с наивысшим приоритетом (при равном — кто
+    пришёл раньше), так что сканы администратора не вытесняют оплату.
+    Если дедлайн класса истёк раньше, вызов получает QuotaTimeout.
+
+    С client бакеты общие для всех процессов (RedisTokenBucket), так что
+    квота проекта соблюдается при любом числе воркеров; очередь
+    приоритетов при этом у каждого процесса своя.
+    """
+
+    def __init__(
+        self,
+        reads_per_minute: float = 60,
+        writes_per_minute: float = 60,
+        deadlines: Dict[Priority, float] = None,
+        client: Optional[redis.Redis] = None,
+        prefix: str = "vpnbot:quota",
+    ):
+        limits = {"read": reads_per_minute, "write": writes_per_minute}
+        self.buckets = {}
+        for kind, per_minute in limits.items():
+            rate, capacity = per_minute / 60, per_minute / 6
+            self.buckets[kind] = (
+                TokenBucket(rate, capacity)
+                if client is None
+                else RedisTokenBucket(
+                    client, f"{prefix}:{kind}", rate, capacity
+                )
+            )
+        self.deadlines = {**DEFAULT_DEADLINES, **(deadlines or {})}
+        self._waiters: Dict[str, List[Tuple[int, int]]] = {
+            kind: [] for kind in self.buckets
+        }
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def deadline(self) -> float:
+        """Дедлайн (time.monotonic) вызова с текущим приоритетом."""
+        return time.monotonic() + self.deadlines[_priority.get()]
+
+    def acquire(self, kind: str, deadline: Optional[float] = None) -> None:
+        """Блокирует поток, пока вызову не достанется токен kind.
+
+        deadline — общий для всех попыток одного вызова; по умолчанию
+        отсчитывается от начала ожидания. Токен берёт только голова
+        очереди, и обращается к бакету (для RedisTokenBucket — сетевой
+        вызов) без блокировки очереди.
+        """
+        priority = _priority.get()
+        bucket = self.buckets[kind]
+        waiters = self._waiters[kind]
+        entry = (int(priority), next(self._seq))
+        start = time.monotonic()
+        if deadline is None:
+            deadline = start + self.deadlines[priority]
+        queue = QUEUE_DEPTH.labels(f"sheets_{kind}")
+        with self._cond:
+            heapq.heappush(waiters, entry)
+            queue.inc()
+            # Новый вызов может оказаться приоритетнее текущей головы.
+            self._cond.notify_all()
+        try:
+            while True:
+                with self._cond:
+                    while waiters[0] != entry:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            raise QuotaTimeout(f"{kind} {priority.name}")
+                        self._cond.wait(left)
+                if bucket.try_take():
+                    break
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise QuotaTimeout(f"{kind} {priority.name}")
+                pause = max(bucket.wait_time(), MIN_WAIT)
+                with self._cond:
+                    self._cond.wait(min(left, pause))
+        finally:
+            with self._cond:
+                waiters.remove(entry)
+                heapq.heapify(waiters)
+                queue.dec()
+                # Голова очереди сменилась — пусть следующий проверит.
+                self._cond.notify_all()
+        QUOTA_WAIT.labels(kind, priority.name.lower()).observe(
+            time.monotonic() - start
+        )
+
+    def throttled(self, kind: str) -> None:
+        """API ответил 429: бюджет kind исчерпан раньше, чем считали."""
+        self.buckets[kind].drain()
+
+
+def _status(error: BaseException) -> Optional[int]:
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+
+def _is_rate_limited(error: Exception) -> bool:
+    return _status(error) == 429
+
+
+def _is_client_error(error: BaseException) -> bool:
+    """Ошибка запроса (4xx), а не сбой самого Sheets."""
+    status = _status(error)
+    return status is not None and 400 <= status < 500
+
+
+class ScheduledWorksheet:
+    """Лист, каждый вызов которого проходит через QuotaScheduler.
+
+    Методы из READS тратят квоту чтения, остальные публичные — записи.
+    При 429 бюджет обнуляется и вызов повторяется; дедлайн считается
+    один раз на вызов, и после него повторы заканчиваются QuotaTimeout.
+
+    С policy вызов идёт через автомат и адаптивный таймаут Sheets
+    (set_timeout применяет таймаут к HTTP-клиенту), а чтения при сбое сети
+    повторяются с паузой — каждый повтор снова берёт токен квоты.
+    """
+
+    READS = frozenset(
+        {
+            "get_all_records",
+            "get_all_values",
+            "get_values",
+            "get",
+            "batch_get",
+            "acell",
+            "cell",
+            "col_values",
+            "row_values",
+            "find",
+            "findall",
+        }
+    )
+
+    def __init__(
+        self,
+        target: Any,
+        scheduler: QuotaScheduler,
+        policy: Optional[DependencyPolicy] = None,
+        set_timeout: Optional[Callable[[float], None]] = None,
+    ):
+        self._target = target
+        self._scheduler = scheduler
+        self._policy = policy
+        self._set_timeout = set_timeout
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._target, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+        kind = "read" if name in self.READS else "write"
+        scheduler = self._scheduler
+        policy = self._policy
+        set_timeout = self._set_timeout
+
+        def send(timeout: float, args, kwargs) -> Any:
+            if set_timeout is not None:
+                set_timeout(timeout)
+            return attr(*args, **kwargs)
+
+        def call(*args, **kwargs):
+            failures = 0
+            deadline = scheduler.deadline()
+            while True:
+                scheduler.acquire(kind, deadline)
+                try:
+                    if policy is None:
+                        return attr(*args, **kwargs)
+                    return policy.call(
+                        lambda timeout: send(timeout, args, kwargs),
+                        ignore=_is_client_error,
+                    )
+                except Exception as e:
+                    if _is_rate_limited(e):
+                        scheduler.throttled(kind)
+                        if time.monotonic() >= deadline:
+                            raise QuotaTimeout(f"{kind} {name}: 429") from e
+                        continue
+                    if (
+                        policy is None
+                        or kind != "read"
+                        or not isinstance(e, TRANSIENT)
+                        or failures >= policy.retries
+                    ):
+                        raise
+                    policy.pause(failures)
+                    failures += 1
+
+        return call
+
+
+@lru_cache(maxsize=None)
+def get_sheets_scheduler() -> QuotaScheduler:
+    """Планировщик квоты (SHEETS_READS/WRITES_PER_MINUTE).
+
+    С Redis квота общая для всех процессов, иначе — на процесс.
+    """
+    return QuotaScheduler(
+        reads_per_minute=float(os.getenv("SHEETS_READS_PER_MINUTE", "60")),
+        writes_per_minute=float(os.getenv("SHEETS_WRITES_PER_MINUTE", "60")),
+        client=get_redis(),
+    )
@@ -0,0 +1,25 @@
+from functools import lru_cache
+from typing import Optional
+
+import redis
+from redis import asyncio as aioredis
+
+from tgbot.config import get_config
+
+
+@lru_cache(maxsize=None)
+def get_redis() -> Optional[redis.Redis]:
+    """Общий синхронный клиент Redis или None, если Redis выключен."""
+    config = get_config()
+    if config.redis is None:
+        return None
+    return redis.Redis.from_url(config.redis.dsn(), decode_responses=True)
+
+
+@lru_cache(maxsize=None)
+def get_async_redis() -> Optional[aioredis.Redis]:
+    """Общий асинхронный клиент Redis или None, если Redis выключен."""
+    config = get_config()
+    if config.redis is None:
+        return None
+    return aioredis.Redis.from_url(config.redis.dsn(), decode_responses=True)
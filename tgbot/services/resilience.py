@@ -0,0 +1,337 @@
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Deque, Optional, Tuple, Type
+
+import requests
+from redis import asyncio as aioredis
+
+from tgbot.services.metrics import (
+    CIRCUIT_REJECTIONS,
+    CIRCUIT_STATE,
+    DEPENDENCY_RETRIES,
+    DEPENDENCY_TIMEOUT,
+)
+from tgbot.services.redis_client import get_async_redis
+
+# Сбои сети, после которых идемпотентный вызов можно повторить.
+TRANSIENT: Tuple[Type[BaseException], ...] = (
+    requests.ConnectionError,
+    requests.Timeout,
+)
+
+
+class CircuitOpen(Exception):
+    """Автомат зависимости разомкнут: вызов отклонён без попытки."""
+
+
+class CircuitBreaker:
+    """Автомат: после threshold сбоев подряд вызовы отклоняются сразу.
+
+    Через reset_timeout секунд пропускается один пробный вызов: успех
+    замыкает автомат, сбой размыкает снова.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(
+        self, name: str, threshold: int = 5, reset_timeout: float = 30
+    ):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.labels(name).set(0)
+
+    @property
+    def is_open(self) -> bool:
+        """Разомкнут и время пробного вызова ещё не пришло."""
+        return self.state == self.OPEN and (
+            time.monotonic() - self.opened_at < self.reset_timeout
+        )
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logging.warning(
+                "Автомат %s: %s -> %s", self.name, self.state, state
+            )
+        self.state = state
+        CIRCUIT_STATE.labels(self.name).set(
+            (self.CLOSED, self.HALF_OPEN, self.OPEN).index(state)
+        )
+
+    def allow(self) -> None:
+        """Бросает CircuitOpen, если вызов сейчас делать нельзя."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and not self.is_open:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+        CIRCUIT_REJECTIONS.labels(self.name).inc()
+        raise CircuitOpen(self.name)
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+
+class AdaptiveTimeout:
+    """Таймаут по наблюдаемой латентности зависимости.
+
+    Берётся quantile последних window успешных вызовов, умноженный на
+    multiplier и ограниченный [minimum, maximum]. Пока замеров меньше
+    min_samples, действует maximum.
+    """
+
+    def __init__(
+        self,
+        minimum: float,
+        maximum: float,
+        quantile: float = 0.99,
+        multiplier: float = 3.0,
+        window: int = 500,
+        min_samples: int = 20,
+    ):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.quantile = quantile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def current(self) -> float:
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return self.maximum
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(len(ordered) * self.quantile))
+        return min(
+            self.maximum,
+            max(self.minimum, ordered[index] * self.multiplier),
+        )
+
+
+class DependencyPolicy:
+    """Автомат, адаптивный таймаут и повторы для одной зависимости.
+
+    call(func) передаёт в func текущий таймаут. Сбой — исключение (кроме
+    тех, что ignore считает ошибкой запроса, а не зависимости) или
+    результат, для которого is_failure истинно. Идемпотентные вызовы при
+    сбое сети или сбойном ответе повторяются до retries раз с паузой
+    «full jitter»: случайной в пределах backoff * 2^попытка.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        breaker: CircuitBreaker,
+        timeout: AdaptiveTimeout,
+        retries: int = 2,
+        backoff: float = 0.5,
+    ):
+        self.name = name
+        self.breaker = breaker
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+    def call(
+        self,
+        func: Callable[[float], Any],
+        idempotent: bool = False,
+        is_failure: Optional[Callable[[Any], bool]] = None,
+        ignore: Optional[Callable[[BaseException], bool]] = None,
+        retry_on: Tuple[Type[BaseException], ...] = TRANSIENT,
+    ) -> Any:
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            self.breaker.allow()
+            timeout = self.timeout.current()
+            DEPENDENCY_TIMEOUT.labels(self.name).set(timeout)
+            start = time.monotonic()
+            try:
+                result = func(timeout)
+            except Exception as e:
+                if ignore is not None and ignore(e):
+                    self.breaker.success()
+                    raise
+                self.breaker.failure()
+                if attempt + 1 == attempts or not isinstance(e, retry_on):
+                    raise
+                logging.warning("%s: %s, повтор", self.name, e)
+            else:
+                if is_failure is None or not is_failure(result):
+                    self.timeout.observe(time.monotonic() - start)
+                    self.breaker.success()
+                    return result
+                self.breaker.failure()
+                if attempt + 1 == attempts:
+                    return result
+                logging.warning("%s: сбойный ответ, повтор", self.name)
+            self.pause(attempt)
+
+    def pause(self, attempt: int) -> None:
+        """Пауза перед повтором номер attempt + 1."""
+        DEPENDENCY_RETRIES.labels(self.name).inc()
+        time.sleep(random.uniform(0, self.backoff * 2**attempt))
+
+
+# Таймауты по умолчанию: (минимум, максимум) в секундах.
+DEFAULT_TIMEOUTS = {
+    "xui": (2.0, 10.0),
+    "yookassa": (3.0, 30.0),
+    "sheets": (5.0, 60.0),
+}
+
+
+@lru_cache(maxsize=None)
+def get_policy(name: str) -> DependencyPolicy:
+    """Общая для процесса политика зависимости name."""
+    minimum, maximum = DEFAULT_TIMEOUTS.get(name, (1.0, 30.0))
+    return DependencyPolicy(
+        name,
+        CircuitBreaker(name),
+        AdaptiveTimeout(minimum, maximum),
+    )
+
+
+class DeferredQueue:
+    """Операции, отложенные до восстановления зависимости.
+
+    Пока автомат зависимости разомкнут, вызывающий не ждёт таймаута, а
+    кладёт операцию (JSON) в список Redis deferred:<name>; фоновая задача
+    выполняет их, когда автомат снова пропускает вызовы. Операции, после
+    max_attempts попыток так и не выполненные, переносятся в список
+    deferred:<name>:dead. Без Redis очереди живут в памяти процесса.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        client: Optional[aioredis.Redis] = None,
+        max_attempts: int = 5,
+    ):
+        self.name = name
+        self.key = f"deferred:{name}"
+        self.dead_key = f"deferred:{name}:dead"
+        self.client = client
+        self.max_attempts = max_attempts
+        self._local: Deque[str] = deque()
+        self._dead: Deque[str] = deque()
+
+    async def push(self, item: dict, front: bool = False) -> None:
+        raw = json.dumps(item, ensure_ascii=False)
+        if self.client is None:
+            if front:
+                self._local.appendleft(raw)
+            else:
+                self._local.append(raw)
+        elif front:
+            await self.client.lpush(self.key, raw)
+        else:
+            await self.client.rpush(self.key, raw)
+
+    async def _pop(self) -> Optional[str]:
+        if self.client is None:
+            return self._local.popleft() if self._local else None
+        return await self.client.lpop(self.key)
+
+    async def _size(self) -> int:
+        if self.client is None:
+            return len(self._local)
+        return await self.client.llen(self.key)
+
+    async def _bury(self, item: dict) -> None:
+        raw = json.dumps(item, ensure_ascii=False)
+        if self.client is None:
+            self._dead.append(raw)
+        else:
+            await self.client.rpush(self.dead_key, raw)
+
+    async def drain(
+        self,
+        handler: Callable[[dict], Awaitable[Any]],
+        policy: DependencyPolicy,
+        on_dead: Optional[Callable[[dict], Awaitable[Any]]] = None,
+    ) -> int:
+        """Выполняет отложенные операции, пока автомат policy замкнут.
+
+        Операция, упёршаяся в недоступность (CircuitOpen, сбой сети),
+        возвращается в голову очереди, и проход заканчивается. Любая
+        другая ошибка — операция уходит в хвост со счётчиком попыток, а
+        после max_attempts — в список мёртвых с вызовом on_dead; такая
+        операция не задерживает остальные. Проход берёт не больше
+        операций, чем было в очереди в его начале. Возвращает число
+        выполненных.
+        """
+        done = 0
+        for _ in range(await self._size()):
+            if policy.breaker.is_open:
+                break
+            raw = await self._pop()
+            if raw is None:
+                break
+            item = json.loads(raw)
+            attempts = item.pop("_attempts", 0)
+            try:
+                await handler(item)
+            except TRANSIENT + (CircuitOpen,):
+                await self.push(dict(item, _attempts=attempts), front=True)
+                break
+            except Exception:
+                attempts += 1
+                if attempts < self.max_attempts:
+                    logging.exception(
+                        "Отложенная операция %s не выполнена, попытка %s/%s",
+                        item,
+                        attempts,
+                        self.max_attempts,
+                    )
+                    await self.push(dict(item, _attempts=attempts))
+                    continue
+                logging.exception(
+                    "Отложенная операция %s не выполнена за %s попыток, "
+                    "перенесена в %s",
+                    item,
+                    attempts,
+                    self.dead_key,
+                )
+                await self._bury(item)
+                if on_dead is not None:
+                    await on_dead(item)
+                continue
+            done += 1
+        if done:
+            logging.info("Выполнены отложенные %s: %s", self.name, done)
+        return done
+
+
+@lru_cache(maxsize=None)
+def get_deferred_queue(name: str) -> DeferredQueue:
+    return DeferredQueue(name, get_async_redis())
@@ -0,0 +1,248 @@
+"""Синхронизация листа подписчиков Google Sheets с базой SQLite.
+
+С STORAGE_BACKEND=sqlite рабочие запросы обслуживает локальная база, а
+лист остаётся представлением для администраторов. Проход синхронизации:
+
+    pull  лист читается диапазонами по chunk_size строк; хэш каждой
+          строки сравнивается с хэшем её последней синхронной версии, и
+          в базу переносятся только отличающиеся строки;
+    push  строки, изменённые в базе, пишутся в лист пачками по
+          push_batch диапазонов за вызов, новые — дописываются.
+
+Строки сопоставляются по user_id, а не по номеру: вставка, удаление и
+сортировка строк листа не делают остальные строки изменёнными. Номер
+строки в листе push находит по колонке user_id, прочитанной прямо перед
+записью пачки. Правки администратора в листе применяются, если запись
+этого пользователя не меняли локально; иначе побеждает локальная версия.
+Строки листа без числового user_id и повторы user_id не синхронизируются.
+
+    python -m tgbot.services.sheet_sync            # первичный перенос
+    python -m tgbot.services.sheet_sync --push
+"""
+
+import argparse
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set
+
+from dotenv import load_dotenv
+
+from constants import JSON_PATH, SCOPE
+from tgbot.services.connect_table import (
+    COLUMNS,
+    open_google_sheet,
+    sqlite_path,
+)
+from tgbot.services.storage import SqliteWorksheet, row_hash
+
+
+@dataclass
+class SyncReport:
+    fetched: int = 0
+    changed: int = 0
+    pushed: int = 0
+    appended: int = 0
+    last_row: int = 0
+
+    def render(self) -> str:
+        return (
+            f"Синхронизация: прочитано {self.fetched} строк листа, "
+            f"применено {self.changed}, записано в лист {self.pushed}, "
+            f"дописано {self.appended}"
+        )
+
+
+class SheetSync:
+    """Инкрементальная синхронизация листа и SqliteWorksheet."""
+
+    def __init__(
+        self,
+        local: SqliteWorksheet,
+        remote_factory: Callable[[], Any],
+        columns: Sequence[str],
+        chunk_size: int = 5000,
+        push_batch: int = 500,
+    ):
+        self.local = local
+        self.remote_factory = remote_factory
+        self.columns = list(columns)
+        self.chunk_size = chunk_size
+        self.push_batch = push_batch
+        self._remote = None
+        self._lock = threading.Lock()
+        self._last_col = chr(ord("A") + len(self.columns) - 1)
+        self._key = self.columns.index("user_id")
+
+    @property
+    def remote(self):
+        if self._remote is None:
+            self._remote = self.remote_factory()
+        return self._remote
+
+    def _row(self, values: Sequence[Any]) -> List[str]:
+        width = len(self.columns)
+        row = ([str(value) for value in values] + [""] * width)[:width]
+        row[self._key] = row[self._key].strip()
+        return row
+
+    def pull(
+        self,
+        report: Optional[SyncReport] = None,
+        on_change: Optional[Callable[[int], None]] = None,
+    ) -> SyncReport:
+        """Переносит в базу строки листа, изменённые с прошлого прохода.
+
+        on_change вызывается с user_id каждой применённой строки и
+        каждого пользователя, удалённого из листа.
+        """
+        report = report or SyncReport()
+        header = self.remote.get(f"A1:{self._last_col}1")
+        if not header or self._row(header[0]) != self.columns:
+            raise ValueError(
+                f"Заголовок листа не совпадает с колонками: {header}"
+            )
+
+        known = self.local.synced_hashes()
+        seen: Set[str] = set()
+        duplicates = 0
+        last_row = 1
+        start = 2
+        # Пустой диапазон — конец листа; пустые строки внутри
+        # диапазона gspread отдаёт пустыми списками.
+        while True:
+            end = start + self.chunk_size - 1
+            values = self.remote.get(f"A{start}:{self._last_col}{end}")
+            if not values:
+                break
+            report.fetched += len(values)
+            last_row = start + len(values) - 1
+            changed = {}
+            for row_values in values:
+                row_values = self._row(row_values)
+                key = row_values[self._key]
+                if not key.isdigit():
+                    continue
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                if known.get(key) != row_hash(row_values):
+                    changed[key] = row_values
+            applied = self.local.apply_rows(changed)
+            report.changed += len(applied)
+            if on_change is not None:
+                for key in applied:
+                    on_change(int(key))
+            start = end + 1
+
+        if duplicates:
+            logging.warning(
+                "В листе %s повторов user_id: синхронизируется первая строка",
+                duplicates,
+            )
+        cleared = self.local.finish_pull(set(known) - seen)
+        report.changed += len(cleared)
+        report.last_row = last_row
+        if on_change is not None:
+            for key in cleared:
+                on_change(int(key))
+        return report
+
+    def _positions(self) -> Dict[str, int]:
+        """user_id -> номер строки листа; первая строка из повторов."""
+        positions: Dict[str, int] = {}
+        for row, value in enumerate(self.remote.col_values(self._key + 1)):
+            positions.setdefault(str(value).strip(), row + 1)
+        return positions
+
+    def push(self, report: Optional[SyncReport] = None) -> SyncReport:
+        """Пишет в лист локальные изменения и дописывает новые строки."""
+        report = report or SyncReport()
+        after = 1
+        while True:
+            batch = self.local.pending(after, self.push_batch)
+            if not batch:
+                return report
+            positions = self._positions()
+            updates, appends = [], []
+            for _, _, values in batch:
+                row = positions.get(values[self._key])
+                if row is None:
+                    appends.append(values)
+                else:
+                    updates.append(
+                        {
+                            "range": f"A{row}:{self._last_col}{row}",
+                            "values": [values],
+                        }
+                    )
+            if updates:
+                self.remote.batch_update(
+                    updates, value_input_option="USER_ENTERED"
+                )
+                report.pushed += len(updates)
+            if appends:
+                self.remote.append_rows(
+                    appends, value_input_option="USER_ENTERED"
+                )
+                report.appended += len(appends)
+            self.local.mark_synced(
+                (values[self._key], rev, row_hash(values))
+                for _, rev, values in batch
+            )
+            after = batch[-1][0]
+
+    def sync(
+        self, on_change: Optional[Callable[[int], None]] = None
+    ) -> SyncReport:
+        """Полный проход: pull, затем push; блокирующий вызов."""
+        with self._lock:
+            report = self.pull(on_change=on_change)
+            self.push(report)
+        logging.info(report.render())
+        return report
+
+
+@lru_cache(maxsize=None)
+def get_sheet_sync() -> SheetSync:
+    """Синхронизация базы SQLITE_PATH с листом SHEET_KEY."""
+    return SheetSync(
+        SqliteWorksheet(sqlite_path(), COLUMNS),
+        lambda: open_google_sheet(
+            os.getenv("GOOGLE_CREDENTIALS_PATH", JSON_PATH),
+            os.getenv("SHEET_KEY", ""),
+            tuple(SCOPE),
+        ),
+        COLUMNS,
+        chunk_size=int(os.getenv("SHEET_SYNC_CHUNK", "5000")),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--pull", action="store_true", help="только pull")
+    mode.add_argument("--push", action="store_true", help="только push")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s — %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
+    sync = get_sheet_sync()
+    if args.pull:
+        report = sync.pull()
+    elif args.push:
+        report = sync.push()
+    else:
+        report = sync.sync()
+    print(report.render())
+
+
+if __name__ == "__main__":
+    main()
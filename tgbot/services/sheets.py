@@ -0,0 +1,88 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Optional, Sequence
+
+import gspread
+import requests
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
+
+from tgbot.services.metrics import track
+
+
+class SheetsClient:
+    """Авторизованный клиент Google Sheets, один на процесс.
+
+    Учётные данные сервисного аккаунта читаются один раз, HTTP-соединения
+    переиспользуются через общую AuthorizedSession, а токен доступа
+    обновляется фоновым потоком за refresh_margin секунд до истечения —
+    запросы к таблице не ждут OAuth и тратят ровно один вызов API.
+    """
+
+    def __init__(
+        self,
+        json_path: str,
+        scopes: Sequence[str],
+        refresh_margin: float = 300,
+        retry_interval: float = 30,
+    ):
+        self.credentials = Credentials.from_service_account_file(
+            json_path, scopes=list(scopes)
+        )
+        self.client = gspread.authorize(self.credentials)
+        # Токен обновляется через отдельную простую сессию: запрос через
+        # AuthorizedSession клиента сам обновил бы токен и ушёл бы со
+        # старым заголовком Authorization.
+        self._token_request = Request(requests.Session())
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self._stop = threading.Event()
+        self._refresher: Optional[threading.Thread] = None
+
+    def refresh(self) -> None:
+        """Получает новый токен доступа."""
+        with track("sheets", "token_refresh"):
+            self.credentials.refresh(self._token_request)
+
+    def _next_refresh_in(self) -> float:
+        expiry = self.credentials.expiry
+        if not self.credentials.token or expiry is None:
+            return 0
+        # expiry в google-auth — наивное время UTC.
+        left = (expiry - datetime.utcnow()).total_seconds()
+        return max(0.0, left - self.refresh_margin)
+
+    def _refresh_loop(self) -> None:
+        delay = self._next_refresh_in()
+        while not self._stop.wait(delay):
+            try:
+                self.refresh()
+                delay = self._next_refresh_in()
+            except Exception as e:
+                logging.warning("Не удалось обновить токен Sheets: %s", e)
+                delay = self.retry_interval
+
+    def start(self) -> "SheetsClient":
+        """Получает токен и запускает его фоновое обновление."""
+        if self._refresher is None:
+            self.refresh()
+            self._refresher = threading.Thread(
+                target=self._refresh_loop,
+                name="sheets-token-refresh",
+                daemon=True,
+            )
+            self._refresher.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def set_timeout(self, timeout: float) -> None:
+        """Таймаут HTTP-запросов к Sheets, секунды."""
+        self.client.http_client.set_timeout(timeout)
+
+    def open_worksheet(self, sheet_key: str):
+        """Первый лист таблицы; метаданные читаются один раз."""
+        with track("sheets", "open_by_key"):
+            return self.client.open_by_key(sheet_key).sheet1
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from functools import lru_cache
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from tgbot.services.coordination import (
+    Coordinator,
+    LockLost,
+    LockNotAcquired,
+    get_coordinator,
+)
+from tgbot.services.metrics import DEDUPLICATED_REQUESTS
+
+_MISSING = object()
+
+
+class SingleFlight:
+    """Слияние одновременных одинаковых операций пользователя.
+
+    Пока операция с ключом (operation, key) выполняется, повторные вызовы
+    с тем же ключом не запускают её заново, а ждут и получают тот же
+    результат: двойное нажатие в WebApp создаёт один платёж и одну задачу
+    проверки оплаты, а не две.
+
+    С coordinator слияние работает и между процессами: выполняет тот, кто
+    взял блокировку sf:<operation>:<key>, а результат (JSON) сохраняется
+    на result_ttl секунд, и остальные реплики забирают его оттуда.
+    Аренда блокировки продлевается, пока операция идёт, так что долгий
+    вызов (создание платежа с повторами) не отдаёт её другой реплике;
+    timeout ограничивает только ожидание чужого результата.
+    """
+
+    def __init__(
+        self,
+        coordinator: Optional[Coordinator] = None,
+        result_ttl: float = 10,
+        timeout: float = 60,
+    ):
+        self.coordinator = coordinator
+        self.result_ttl = result_ttl
+        self.timeout = timeout
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    async def do(
+        self,
+        operation: str,
+        key: Any,
+        func: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        name = f"{operation}:{key}"
+        call = self._calls.get(name)
+        if call is not None:
+            DEDUPLICATED_REQUESTS.labels(operation, "local").inc()
+            return await asyncio.shield(call)
+
+        call = asyncio.get_running_loop().create_future()
+        self._calls[name] = call
+        try:
+            if self.coordinator is None:
+                result = await func()
+            else:
+                result = await self._do_shared(operation, name, func)
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except Exception as e:
+            call.set_exception(e)
+            # Исключение получают ожидающие; без них не логируем.
+            call.exception()
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            del self._calls[name]
+
+    async def _do_shared(
+        self, operation: str, name: str, func: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        lock_name = f"sf:{name}"
+        result_flag = f"sf_result:{name}"
+        deadline = time.monotonic() + self.timeout
+        delay = 0.05
+        while True:
+            result = await self._shared_result(result_flag)
+            if result is not _MISSING:
+                DEDUPLICATED_REQUESTS.labels(operation, "shared").inc()
+                return result
+            try:
+                async with self.coordinator.lock(
+                    lock_name, ttl=self.timeout, timeout=0
+                ):
+                    # Прошлый владелец мог закончить между проверкой
+                    # результата и блокировкой.
+                    result = await self._shared_result(result_flag)
+                    if result is not _MISSING:
+                        DEDUPLICATED_REQUESTS.labels(operation, "shared").inc()
+                        return result
+                    result = await func()
+                    await self.coordinator.set_flag(
+                        result_flag, json.dumps(result), self.result_ttl
+                    )
+                return result
+            except LockLost:
+                logging.warning("%s выполнен без блокировки", lock_name)
+                return result
+            except LockNotAcquired:
+                if time.monotonic() >= deadline:
+                    raise
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    async def _shared_result(self, result_flag: str) -> Any:
+        raw = await self.coordinator.get_flag(result_flag)
+        if raw is None:
+            return _MISSING
+        try:
+            return json.loads(raw)
+        except ValueError:
+            logging.warning("Повреждён результат %s", result_flag)
+            return _MISSING
+
+
+@lru_cache(maxsize=None)
+def get_single_flight() -> SingleFlight:
+    """Общий SingleFlight процесса; SINGLE_FLIGHT_SHARED — между репликами."""
+    shared = os.getenv("SINGLE_FLIGHT_SHARED", "false").lower() == "true"
+    return SingleFlight(get_coordinator() if shared else None)
@@ -0,0 +1,233 @@
+"""Локальный снимок таблицы подписчиков.
+
+Формат файла (все числа little-endian):
+
+    заголовок  8s magic, u32 формат, u32 число записей, u64 версия,
+               f64 время создания, u32 длина + JSON списка колонок
+    индекс     (i64 user_id, u64 смещение записи) по числу записей с
+               числовым user_id, отсортирован по user_id
+    данные     u32 длина + JSON-массив значений в порядке колонок
+
+Файл открывается через mmap: поиск по user_id — бинарный поиск по
+индексу без чтения всего файла, так что снимок готов к работе сразу
+после старта процесса.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence
+
+MAGIC = b"VPNSNAP\x00"
+FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<8sIIQd")
+_U32 = struct.Struct("<I")
+_INDEX_ENTRY = struct.Struct("<qQ")
+
+
+def _user_id(record: Dict[str, Any]) -> Optional[int]:
+    value = str(record.get("user_id", "")).strip()
+    return int(value) if value.isdigit() else None
+
+
+def write_snapshot(
+    path: str,
+    columns: Sequence[str],
+    records: Iterable[Dict[str, Any]],
+    version: int,
+) -> None:
+    """Записывает снимок атомарно: через временный файл и os.replace."""
+    columns = list(columns)
+    header_columns = json.dumps(columns, ensure_ascii=False).encode()
+    rows: List[bytes] = []
+    keys = []
+    for record in records:
+        payload = json.dumps(
+            [record.get(name, "") for name in columns],
+            ensure_ascii=False,
+            default=str,
+        ).encode()
+        user_id = _user_id(record)
+        if user_id is not None:
+            keys.append((user_id, len(rows)))
+        rows.append(payload)
+    # Стабильная сортировка: при дублях первой остаётся верхняя строка,
+    # как в поиске по листу.
+    keys.sort(key=lambda item: item[0])
+
+    data_start = (
+        _HEADER.size
+        + _U32.size
+        + len(header_columns)
+        + _INDEX_ENTRY.size * len(keys)
+    )
+    offsets = []
+    position = data_start
+    for payload in rows:
+        offsets.append(position)
+        position += _U32.size + len(payload)
+
+    # Временный файл — свой у каждого писателя: процессы, стартующие
+    # одновременно, не пишут в один и тот же файл.
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f"{os.path.basename(path)}.", suffix=".tmp", dir=directory
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(
+                _HEADER.pack(
+                    MAGIC, FORMAT_VERSION, len(keys), version, time.time()
+                )
+            )
+            f.write(_U32.pack(len(header_columns)))
+            f.write(header_columns)
+            for user_id, row in keys:
+                f.write(_INDEX_ENTRY.pack(user_id, offsets[row]))
+            for payload in rows:
+                f.write(_U32.pack(len(payload)))
+                f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class Snapshot:
+    """Открытый снимок: поиск по user_id и обход всех записей."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, fmt, self.count, self.version, self.created = (
+            _HEADER.unpack_from(self._mm, 0)
+        )
+        if magic != MAGIC or fmt != FORMAT_VERSION:
+            self._mm.close()
+            raise ValueError(f"{path}: не снимок подписчиков")
+        (columns_len,) = _U32.unpack_from(self._mm, _HEADER.size)
+        columns_start = _HEADER.size + _U32.size
+        self.columns = json.loads(
+            self._mm[columns_start : columns_start + columns_len]
+        )
+        self._index_start = columns_start + columns_len
+        self._data_start = self._index_start + _INDEX_ENTRY.size * self.count
+        self.mtime = os.stat(path).st_mtime
+
+    def _read_at(self, offset: int) -> Dict[str, Any]:
+        (length,) = _U32.unpack_from(self._mm, offset)
+        start = offset + _U32.size
+        values = json.loads(self._mm[start : start + length])
+        return dict(zip(self.columns, values))
+
+    def _key_at(self, i: int) -> int:
+        return _INDEX_ENTRY.unpack_from(
+            self._mm, self._index_start + i * _INDEX_ENTRY.size
+        )[0]
+
+    def lookup(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Запись по user_id или None."""
+        user_id = int(user_id)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_at(mid) < user_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count or self._key_at(lo) != user_id:
+            return None
+        _, offset = _INDEX_ENTRY.unpack_from(
+            self._mm, self._index_start + lo * _INDEX_ENTRY.size
+        )
+        return self._read_at(offset)
+
+    def records(self) -> Iterator[Dict[str, Any]]:
+        """Все записи в порядке строк листа."""
+        offset = self._data_start
+        end = len(self._mm)
+        while offset < end:
+            (length,) = _U32.unpack_from(self._mm, offset)
+            yield self._read_at(offset)
+            offset += _U32.size + length
+
+    def close(self) -> None:
+        self._mm.close()
+
+
+class SnapshotStore:
+    """Снимок на диске, который подхватывают все процессы хоста.
+
+    save() пишет новую версию; остальные процессы замечают её по mtime
+    не чаще раза в reload_interval секунд.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        columns: Sequence[str],
+        reload_interval: float = 5.0,
+    ):
+        self.path = path
+        self.columns = list(columns)
+        self.reload_interval = reload_interval
+        self._current: Optional[Snapshot] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self) -> Optional[Snapshot]:
+        """Открывает снимок с диска; None — его нет или он повреждён."""
+        try:
+            snapshot = Snapshot(self.path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as e:
+            logging.warning("Снимок %s не прочитан: %s", self.path, e)
+            return None
+        with self._lock:
+            # Старый mmap не закрываем: его может читать другой поток.
+            self._current = snapshot
+            self._checked_at = time.monotonic()
+        return snapshot
+
+    @property
+    def current(self) -> Optional[Snapshot]:
+        """Актуальный снимок; новая версия с диска подхватывается сама."""
+        now = time.monotonic()
+        if now - self._checked_at >= self.reload_interval:
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime is not None and (
+                self._current is None or mtime != self._current.mtime
+            ):
+                self.load()
+        return self._current
+
+    @property
+    def version(self) -> int:
+        snapshot = self.current
+        return snapshot.version if snapshot else 0
+
+    def save(self, records: Iterable[Dict[str, Any]]) -> Snapshot:
+        """Пишет снимок следующей версии и переключается на него."""
+        version = max(self.version + 1, time.time_ns())
+        write_snapshot(self.path, self.columns, records, version)
+        snapshot = self.load()
+        logging.info(
+            "Снимок подписчиков сохранён: %s записей, версия %s",
+            snapshot.count if snapshot else 0,
+            version,
+        )
+        return snapshot
@@ -0,0 +1,400 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+_RANGE_RE = re.compile(r"^([A-Z])(\d+)(?::([A-Z])(\d+))?$")
+_INT_RE = re.compile(r"^-?\d+$")
+
+
+def _parse_range(range_name: str) -> Tuple[int, int, int, int]:
+    """(первая колонка, первая строка, последняя колонка, последняя строка)."""
+    match = _RANGE_RE.match(range_name)
+    first_col = ord(match.group(1)) - ord("A") + 1
+    first_row = int(match.group(2))
+    last_col = ord(match.group(3) or match.group(1)) - ord("A") + 1
+    last_row = int(match.group(4) or first_row)
+    return first_col, first_row, last_col, last_row
+
+
+def row_hash(values: Sequence[Any]) -> str:
+    """Хэш значений строки: по нему синхронизация находит изменения."""
+    payload = json.dumps([str(value) for value in values], ensure_ascii=False)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+class MemoryWorksheet:
+    """Лист подписчиков в памяти с интерфейсом gspread.Worksheet.
+
+    Реализует подмножество методов, которым пользуется
+    SubscriptionManager, поэтому подменяет Google Sheets в бенчмарках и
+    локальной разработке (STORAGE_BACKEND=memory). latency добавляет
+    искусственную задержку к каждому вызову, как у сетевого хранилища.
+    """
+
+    def __init__(self, header: Sequence[str], latency: float = 0.0):
+        self.header = list(header)
+        self.latency = latency
+        self.rows: List[List[Any]] = []
+
+    @classmethod
+    def from_records(
+        cls,
+        header: Sequence[str],
+        records: Iterable[Dict[str, Any]],
+        latency: float = 0.0,
+    ) -> "MemoryWorksheet":
+        sheet = cls(header, latency)
+        sheet.rows = [
+            [record.get(name, "") for name in sheet.header]
+            for record in records
+        ]
+        return sheet
+
+    def _delay(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_all_records(self) -> List[Dict[str, Any]]:
+        self._delay()
+        width = len(self.header)
+        return [
+            dict(zip(self.header, row + [""] * (width - len(row))))
+            for row in self.rows
+        ]
+
+    def get_all_values(self) -> List[List[Any]]:
+        self._delay()
+        return [list(self.header)] + [list(row) for row in self.rows]
+
+    def get(self, range_name: str) -> List[List[Any]]:
+        """Значения диапазона A1; пустые строки в конце отбрасываются."""
+        self._delay()
+        first_col, first_row, last_col, last_row = _parse_range(range_name)
+        rows = [self.header] + self.rows
+        values = [
+            list(row[first_col - 1 : last_col])
+            for row in rows[first_row - 1 : last_row]
+        ]
+        while values and not any(str(value) for value in values[-1]):
+            values.pop()
+        return values
+
+    def col_values(self, col: int) -> List[Any]:
+        """Колонка целиком с заголовком; пустые ячейки в конце отброшены."""
+        self._delay()
+        values = [
+            row[col - 1] if len(row) >= col else ""
+            for row in [self.header] + self.rows
+        ]
+        while values and not str(values[-1]):
+            values.pop()
+        return values
+
+    def update_cell(self, row: int, col: int, value: Any) -> None:
+        self._delay()
+        values = self.rows[row - 2]
+        if len(values) < col:
+            values.extend([""] * (col - len(values)))
+        values[col - 1] = value
+
+    def append_row(self, values: Sequence[Any], **kwargs) -> None:
+        self._delay()
+        self.rows.append(list(values))
+
+    def append_rows(self, values: List[Sequence[Any]], **kwargs) -> None:
+        self._delay()
+        self.rows.extend(list(row) for row in values)
+
+    def batch_update(self, data: List[Dict[str, Any]], **kwargs) -> None:
+        """Несколько диапазонов (A1, в пределах колонок A–Z) одним вызовом."""
+        self._delay()
+        for item in data:
+            col, row, _, _ = _parse_range(item["range"])
+            for i, values in enumerate(item["values"]):
+                target = self.rows[row + i - 2]
+                end = col - 1 + len(values)
+                if len(target) < end:
+                    target.extend([""] * (end - len(target)))
+                target[col - 1 : end] = values
+
+
+class SqliteWorksheet:
+    """Лист подписчиков в SQLite с интерфейсом gspread.Worksheet.
+
+    Рабочее хранилище вместо Google Sheets (STORAGE_BACKEND=sqlite).
+    Номер строки — постоянный локальный идентификатор (данные с 2, без
+    пропусков): синхронизация строки не переставляет и не удаляет, а
+    строки, удалённые из листа, очищает. Поэтому номер, который
+    SubscriptionManager вычислил по get_all_records, указывает на того
+    же пользователя и после прохода синхронизации.
+
+    С листом строки сопоставляются по ключу (user_id), уникальному в
+    базе. У строки есть ревизия локальных правок и хэш версии, последней
+    совпавшей с листом; строка без хэша в листе ещё не записана.
+
+    Соединение одно на экземпляр и защищено блокировкой; база в режиме
+    WAL, поэтому процессы хоста читают её, не мешая друг другу.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        header: Sequence[str],
+        table: str = "subscribers",
+        key: str = "user_id",
+    ):
+        self.path = path
+        self.header = list(header)
+        self.table = table
+        self.key = key
+        self._columns = ", ".join(f'"{name}"' for name in self.header)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        columns = ", ".join(
+            f"\"{name}\" TEXT NOT NULL DEFAULT ''" for name in self.header
+        )
+        self._db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "row_number INTEGER PRIMARY KEY, "
+            f"{columns}, "
+            "rev INTEGER NOT NULL DEFAULT 1, "
+            "synced_rev INTEGER NOT NULL DEFAULT 0, "
+            "synced_hash TEXT)"
+        )
+        self._db.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_{key} "
+            f'ON {table} ("{key}") WHERE "{key}" != \'\''
+        )
+        # Условие частичного индекса: без него поиск по ключу его не видит.
+        self._by_key = f'"{key}" = ? AND "{key}" != \'\''
+        placeholders = ", ".join("?" for _ in self.header)
+        self._insert = (
+            f"INSERT INTO {table} (row_number, {self._columns}, rev, "
+            "synced_rev, synced_hash) VALUES ("
+            f"(SELECT COALESCE(MAX(row_number), 1) + 1 FROM {table}), "
+            f"{placeholders}, ?, 0, ?) "
+            f'ON CONFLICT ("{key}") WHERE "{key}" != \'\' '
+        )
+
+    @classmethod
+    def from_records(
+        cls,
+        path: str,
+        header: Sequence[str],
+        records: Iterable[Dict[str, Any]],
+    ) -> "SqliteWorksheet":
+        sheet = cls(path, header)
+        sheet.append_rows(
+            [[record.get(name, "") for name in sheet.header]]
+            for record in records
+        )
+        return sheet
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _row(self, values: Sequence[Any]) -> List[str]:
+        values = ["" if value is None else str(value) for value in values]
+        width = len(self.header)
+        row = (values + [""] * width)[:width]
+        index = self.header.index(self.key)
+        row[index] = row[index].strip()
+        return row
+
+    def _select(self, where: str = "", args: Sequence[Any] = ()) -> list:
+        with self._lock:
+            return self._db.execute(
+                f"SELECT {self._columns} FROM {self.table} {where} "
+                "ORDER BY row_number",
+                args,
+            ).fetchall()
+
+    def get_all_records(self) -> List[Dict[str, Any]]:
+        # Как gspread: целые числа отдаются числами.
+        return [
+            {
+                name: int(value) if _INT_RE.match(value) else value
+                for name, value in zip(self.header, row)
+            }
+            for row in self._select()
+        ]
+
+    def get_all_values(self) -> List[List[Any]]:
+        return [list(self.header)] + [list(row) for row in self._select()]
+
+    def update_cell(self, row: int, col: int, value: Any) -> None:
+        value = "" if value is None else str(value)
+        if self.header[col - 1] == self.key:
+            value = value.strip()
+        with self._transaction() as db:
+            db.execute(
+                f'UPDATE {self.table} SET "{self.header[col - 1]}" = ?, '
+                "rev = rev + 1 WHERE row_number = ?",
+                (value, row),
+            )
+
+    def append_row(self, values: Sequence[Any], **kwargs) -> None:
+        self.append_rows([values])
+
+    def append_rows(self, values: Iterable[Sequence[Any]], **kwargs) -> None:
+        """Дописывает строки; строка с уже известным ключом обновляет его.
+
+        Так два процесса, одновременно регистрирующие одного
+        пользователя, не создают дубликат.
+        """
+        assignments = ", ".join(
+            f'"{name}" = excluded."{name}"' for name in self.header
+        )
+        with self._transaction() as db:
+            db.executemany(
+                f"{self._insert} DO UPDATE SET {assignments}, rev = rev + 1",
+                ((*self._row(row), 1, None) for row in values),
+            )
+
+    def batch_update(self, data: List[Dict[str, Any]], **kwargs) -> None:
+        """Несколько диапазонов A1 одной транзакцией."""
+        with self._transaction() as db:
+            for item in data:
+                col, row, _, _ = _parse_range(item["range"])
+                for i, values in enumerate(item["values"]):
+                    names = self.header[col - 1 : col - 1 + len(values)]
+                    assignments = ", ".join(f'"{name}" = ?' for name in names)
+                    values = [
+                        "" if value is None else str(value)
+                        for value in values[: len(names)]
+                    ]
+                    if self.key in names:
+                        index = names.index(self.key)
+                        values[index] = values[index].strip()
+                    db.execute(
+                        f"UPDATE {self.table} SET {assignments}, "
+                        "rev = rev + 1 WHERE row_number = ?",
+                        (*values, row + i),
+                    )
+
+    # Синхронизация с листом (tgbot.services.sheet_sync).
+
+    def synced_hashes(self) -> Dict[str, str]:
+        """Ключ -> хэш последней совпавшей с листом версии строки."""
+        with self._lock:
+            return dict(
+                self._db.execute(
+                    f'SELECT "{self.key}", synced_hash FROM {self.table} '
+                    f"WHERE \"{self.key}\" != '' "
+                    "AND synced_hash IS NOT NULL"
+                )
+            )
+
+    def apply_rows(self, rows: Dict[str, Sequence[Any]]) -> List[str]:
+        """Переносит в базу строки листа по их ключам.
+
+        Новый ключ дописывается, строка без локальных правок
+        обновляется. Строка с правками остаётся локальной версией: её
+        запишет push; у строки, ещё не записанной в лист, запоминается
+        хэш листа, и push обновит её там, а не допишет второй раз.
+        Возвращает ключи применённых строк.
+        """
+        assignments = ", ".join(f'"{name}" = ?' for name in self.header)
+        applied = []
+        with self._transaction() as db:
+            for key, values in rows.items():
+                values = self._row(values)
+                digest = row_hash(values)
+                cursor = db.execute(
+                    f"{self._insert} DO NOTHING", (*values, 0, digest)
+                )
+                if not cursor.rowcount:
+                    cursor = db.execute(
+                        f"UPDATE {self.table} SET {assignments}, "
+                        f"synced_hash = ? WHERE {self._by_key} "
+                        "AND synced_hash IS NOT NULL AND rev = synced_rev",
+                        (*values, digest, key),
+                    )
+                if cursor.rowcount:
+                    applied.append(key)
+                    continue
+                db.execute(
+                    f"UPDATE {self.table} SET synced_hash = ? "
+                    f"WHERE {self._by_key} AND synced_hash IS NULL",
+                    (digest, key),
+                )
+        return applied
+
+    def finish_pull(self, missing: Iterable[str]) -> List[str]:
+        """Обрабатывает ключи, которых больше нет в листе.
+
+        Строка без локальных правок очищается — номер остаётся за ней,
+        чтобы не сдвигать остальные; строка с правками снова становится
+        новой, и push её допишет. Возвращает ключи очищенных строк.
+        """
+        cleared = []
+        blank = ", ".join(f"\"{name}\" = ''" for name in self.header)
+        with self._transaction() as db:
+            for key in missing:
+                cursor = db.execute(
+                    f"UPDATE {self.table} SET {blank}, synced_rev = rev, "
+                    f"synced_hash = NULL WHERE {self._by_key} "
+                    "AND synced_hash IS NOT NULL AND rev = synced_rev",
+                    (key,),
+                )
+                if cursor.rowcount:
+                    cleared.append(key)
+                    continue
+                db.execute(
+                    f"UPDATE {self.table} SET synced_hash = NULL "
+                    f"WHERE {self._by_key}",
+                    (key,),
+                )
+        return cleared
+
+    def pending(
+        self, after: int, limit: int
+    ) -> List[Tuple[int, int, List[str]]]:
+        """Строки для записи в лист: (номер, ревизия, значения).
+
+        Изменённые локально и ещё не записанные в лист, с ключом и
+        номером больше after.
+        """
+        with self._lock:
+            return [
+                (row[0], row[1], list(row[2:]))
+                for row in self._db.execute(
+                    f"SELECT row_number, rev, {self._columns} "
+                    f"FROM {self.table} WHERE \"{self.key}\" != '' "
+                    "AND (synced_hash IS NULL OR rev != synced_rev) "
+                    "AND row_number > ? ORDER BY row_number LIMIT ?",
+                    (after, limit),
+                )
+            ]
+
+    def mark_synced(self, rows: Iterable[Tuple[str, int, str]]) -> None:
+        """Отмечает строки (ключ, ревизия, хэш) записанными в лист.
+
+        Правки, сделанные после чтения ревизии, остаются в очереди.
+        """
+        with self._transaction() as db:
+            db.executemany(
+                f"UPDATE {self.table} SET synced_rev = ?, synced_hash = ? "
+                f"WHERE {self._by_key}",
+                ((rev, digest, key) for key, rev, digest in rows),
+            )
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,186 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+import redis
+
+from tgbot.services.redis_client import get_redis
+from vpn_utils import Connection
+
+
+def inbound_links(inbound: dict, host: str) -> List[str]:
+    """VLESS-ссылки клиентов inbound по его текущим настройкам.
+
+    Порт, ключ и SNI берутся с панели, поэтому после их смены подписка
+    сразу отдаёт актуальную конфигурацию.
+    """
+    try:
+        settings = json.loads(inbound.get("settings") or "{}")
+        stream = json.loads(inbound.get("streamSettings") or "{}")
+    except (TypeError, ValueError):
+        return []
+    reality = stream.get("realitySettings", {})
+    params = {
+        "type": stream.get("network", "tcp"),
+        "security": stream.get("security", "reality"),
+        "pbk": reality.get("settings", {}).get("publicKey", ""),
+        "fp": reality.get("settings", {}).get("fingerprint", "chrome"),
+        "sni": (reality.get("serverNames") or [""])[0],
+        "sid": (reality.get("shortIds") or [""])[0],
+        "spx": reality.get("settings", {}).get("spiderX", "/"),
+    }
+    query = urlencode(params, quote_via=quote, safe="")
+    tag = quote(str(inbound.get("remark", "")))
+    return [
+        f"vless://{client['id']}@{host}:{inbound['port']}?{query}#{tag}"
+        for client in settings.get("clients", [])
+        if client.get("id") and client.get("enable", True)
+    ]
+
+
+def inbound_sub_ids(inbound: dict) -> List[str]:
+    try:
+        settings = json.loads(inbound.get("settings") or "{}")
+    except (TypeError, ValueError):
+        return []
+    return [c["subId"] for c in settings.get("clients", []) if c.get("subId")]
+
+
+class SubscriptionFeed:
+    """Ответы /sub/{subId} в формате подписки, с ETag.
+
+    Индекс subId -> (ETag, тело) строится одним запросом списка inbound и
+    живёт ttl секунд, так что клиенты VPN могут опрашивать подписку часто,
+    не нагружая панель. Изменения подключений (создание, продление,
+    выключение, удаление) сбрасывают индекс через invalidate(); при Redis
+    сброс рассылается остальным процессам через канал.
+    """
+
+    CHANNEL = "vpnbot:subscriptions:invalidate"
+
+    def __init__(
+        self,
+        connection_factory: Callable[[], Connection],
+        host: str,
+        client: Optional[redis.Redis] = None,
+        ttl: float = 300.0,
+        miss_refresh_interval: float = 5.0,
+    ):
+        self.connection_factory = connection_factory
+        self.host = host
+        self.redis = client
+        self.ttl = ttl
+        self.miss_refresh_interval = miss_refresh_interval
+        self._index: Dict[str, Tuple[str, bytes]] = {}
+        self._built_at = float("-inf")
+        self._lock = threading.Lock()
+        self._connection: Optional[Connection] = None
+        self._listener = None
+
+    def _build(self) -> None:
+        if self._connection is None:
+            self._connection = self.connection_factory()
+        data = self._connection.list_inbounds()
+        if not data.get("success", True) or "obj" not in data:
+            logging.warning("Подписки не обновлены: ответ панели %s", data)
+            # Старый индекс отдаётся дальше, повтор — не раньше чем через
+            # miss_refresh_interval.
+            self._built_at = (
+                time.monotonic() - self.ttl + self.miss_refresh_interval
+            )
+            return
+        links: Dict[str, List[str]] = {}
+        for inbound in data["obj"] or []:
+            if not inbound.get("enable", True):
+                continue
+            for sub_id in inbound_sub_ids(inbound):
+                links.setdefault(sub_id, []).extend(
+                    inbound_links(inbound, self.host)
+                )
+        index = {}
+        for sub_id, sub_links in links.items():
+            body = base64.b64encode("\n".join(sub_links).encode())
+            index[sub_id] = (f'"{hashlib.sha1(body).hexdigest()}"', body)
+        self._index = index
+        self._built_at = time.monotonic()
+
+    def get(self, sub_id: str) -> Optional[Tuple[str, bytes]]:
+        """(ETag, тело) подписки или None, если subId не найден."""
+        age = time.monotonic() - self._built_at
+        if age < self.ttl:
+            entry = self._index.get(sub_id)
+            if entry is not None or age < self.miss_refresh_interval:
+                return entry
+        with self._lock:
+            # Пока ждали блокировку, индекс мог перестроить другой поток.
+            age = time.monotonic() - self._built_at
+            if age >= self.ttl or (
+                sub_id not in self._index and age >= self.miss_refresh_interval
+            ):
+                self._build()
+            return self._index.get(sub_id)
+
+    def _reset(self) -> None:
+        self._built_at = float("-inf")
+
+    def invalidate(self) -> None:
+        """Сбрасывает индекс после изменения подключений на панели."""
+        self._reset()
+        if self.redis is None:
+            return
+        try:
+            self.redis.publish(self.CHANNEL, "1")
+        except redis.RedisError as e:
+            logging.warning("Не удалось разослать сброс подписок: %s", e)
+
+    def _on_message(self, message: dict) -> None:
+        self._reset()
+
+    def start_listener(self) -> None:
+        """Подписывается на канал сброса в фоновом потоке."""
+        if self.redis is None or self._listener is not None:
+            return
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.CHANNEL: self._on_message})
+        self._listener = pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+    def stop_listener(self) -> None:
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+
+@lru_cache(maxsize=None)
+def get_subscription_feed() -> SubscriptionFeed:
+    """Возвращает общий для процесса SubscriptionFeed."""
+    feed = SubscriptionFeed(
+        Connection,
+        host=os.getenv("IP", ""),
+        client=get_redis(),
+        ttl=float(os.getenv("SUBSCRIPTION_CACHE_TTL", "300")),
+    )
+    feed.start_listener()
+    return feed
+
+
+def subscription_url(sub_id: Optional[str]) -> Optional[str]:
+    """Публичная ссылка на подписку, если задан SUBSCRIPTION_BASE_URL."""
+    base = os.getenv("SUBSCRIPTION_BASE_URL", "").rstrip("/")
+    if not base or not sub_id:
+        return None
+    return f"{base}/sub/{sub_id}"
+
+
+def subscription_hint(sub_id: Optional[str]) -> str:
+    """Строка со ссылкой на подписку для сообщения, если она доступна."""
+    url = subscription_url(sub_id)
+    if not url:
+        return ""
+    return f"📡 Подписка для приложения (обновляется сама):\n{url}\n\n"
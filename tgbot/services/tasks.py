@@ -0,0 +1,176 @@
+import asyncio
+import contextvars
+import logging
+import os
+from functools import lru_cache
+from typing import Awaitable, Dict, Optional, Set
+
+from tgbot.services.metrics import BACKGROUND_TASK_RESULTS, BACKGROUND_TASKS
+
+
+class TaskRejected(Exception):
+    """Группа задач заполнена: нет ни свободного слота, ни места в очереди."""
+
+
+class TaskGroup:
+    """Именованная группа фоновых задач с лимитом одновременных.
+
+    limit задач выполняются, ещё queue ждут слота; следующие отклоняются.
+    limit=None — без ограничения. drain=False — задачи группы (например,
+    бесконечные циклы лидера) при остановке отменяются сразу, а не
+    дожидаются.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: Optional[int] = None,
+        queue: int = 0,
+        drain: bool = True,
+    ):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.drain = drain
+        self.tasks: Set[asyncio.Task] = set()
+        self.running = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def saturated(self) -> bool:
+        if self.limit is None:
+            return False
+        return len(self.tasks) >= self.limit + self.queue
+
+    async def _run(self, coro: Awaitable) -> None:
+        queued = BACKGROUND_TASKS.labels(self.name, "queued")
+        running = BACKGROUND_TASKS.labels(self.name, "running")
+        if self.limit is not None:
+            if self._semaphore is None:
+                self._semaphore = asyncio.Semaphore(self.limit)
+            queued.inc()
+            try:
+                await self._semaphore.acquire()
+            except BaseException:
+                coro.close()
+                raise
+            finally:
+                queued.dec()
+        self.running += 1
+        running.inc()
+        try:
+            await coro
+        finally:
+            self.running -= 1
+            running.dec()
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+
+class TaskSupervisor:
+    """Реестр фоновых задач процесса.
+
+    Держит ссылки на все запущенные задачи (иначе их может собрать GC),
+    ограничивает их число по группам, логирует необработанные ошибки и
+    при остановке даёт задачам завершиться за отведённое время, а
+    оставшиеся отменяет.
+    """
+
+    def __init__(self):
+        self.groups: Dict[str, TaskGroup] = {}
+        self.closed = False
+
+    def add_group(
+        self,
+        name: str,
+        limit: Optional[int] = None,
+        queue: int = 0,
+        drain: bool = True,
+    ) -> TaskGroup:
+        group = TaskGroup(name, limit, queue, drain)
+        self.groups[name] = group
+        return group
+
+    def group(self, name: str) -> TaskGroup:
+        if name not in self.groups:
+            return self.add_group(name)
+        return self.groups[name]
+
+    def has_capacity(self, group: str) -> bool:
+        return not self.closed and not self.group(group).saturated
+
+    def spawn(
+        self, group: str, coro: Awaitable, name: Optional[str] = None
+    ) -> asyncio.Task:
+        """Запускает coro в группе или бросает TaskRejected."""
+        task_group = self.group(group)
+        if self.closed or task_group.saturated:
+            coro.close()
+            BACKGROUND_TASK_RESULTS.labels(group, "rejected").inc()
+            reason = "остановка" if self.closed else "группа заполнена"
+            raise TaskRejected(f"{group}: {reason}")
+        # Чистый контекст: фоновая задача не должна цеплять свои замеры к
+        # span запроса, который её запустил, и держать его живым.
+        task = contextvars.Context().run(
+            asyncio.create_task, task_group._run(coro), name=name or group
+        )
+        task_group.tasks.add(task)
+        task.add_done_callback(lambda done: self._finished(task_group, done))
+        return task
+
+    def _finished(self, group: TaskGroup, task: asyncio.Task) -> None:
+        group.tasks.discard(task)
+        if task.cancelled():
+            result = "cancelled"
+        elif task.exception() is not None:
+            result = "error"
+            logging.error(
+                "Фоновая задача %s завершилась ошибкой",
+                task.get_name(),
+                exc_info=task.exception(),
+            )
+        else:
+            result = "ok"
+        BACKGROUND_TASK_RESULTS.labels(group.name, result).inc()
+
+    async def drain(self, timeout: float = 20) -> int:
+        """Закрывает приём задач и ждёт текущие не дольше timeout.
+
+        Возвращает число задач, отменённых по таймауту.
+        """
+        self.closed = True
+        waiting: Set[asyncio.Task] = set()
+        for group in self.groups.values():
+            if group.drain:
+                waiting |= group.tasks
+            else:
+                for task in group.tasks:
+                    task.cancel()
+        if waiting:
+            logging.info("Ожидание %s фоновых задач...", len(waiting))
+            _, waiting = await asyncio.wait(waiting, timeout=timeout)
+        for task in waiting:
+            logging.warning(
+                "Фоновая задача %s отменена при остановке", task.get_name()
+            )
+            task.cancel()
+        remaining = [
+            task for group in self.groups.values() for task in group.tasks
+        ]
+        await asyncio.gather(*remaining, return_exceptions=True)
+        return len(waiting)
+
+
+@lru_cache(maxsize=None)
+def get_task_supervisor() -> TaskSupervisor:
+    """Супервизор процесса с группами и лимитами по умолчанию."""
+    supervisor = TaskSupervisor()
+    # Бесконечные циклы: при остановке отменяются сразу.
+    supervisor.add_group("jobs", drain=False)
+    supervisor.add_group(
+        "payment_checks",
+        limit=int(os.getenv("PAYMENT_CHECKS_LIMIT", "500")),
+    )
+    supervisor.add_group("expiry_check", limit=1)
+    supervisor.add_group("bulk_extend", limit=1)
+    return supervisor
@@ -0,0 +1,81 @@
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar(
+    "current_span", default=None
+)
+
+
+@dataclass
+class Span:
+    """Узел дерева замеров одного запроса или обработчика."""
+
+    name: str
+    start: float = field(default_factory=time.perf_counter)
+    duration: Optional[float] = None
+    children: List["Span"] = field(default_factory=list)
+
+    @property
+    def self_time(self) -> float:
+        """Время вне вложенных замеров; параллельные дети его не дробят."""
+        children = sum(child.duration or 0 for child in self.children)
+        return max(0.0, (self.duration or 0) - children)
+
+    def render(self, indent: int = 0) -> List[str]:
+        if self.duration is None:
+            took = "ещё выполняется"
+        else:
+            took = f"{self.duration * 1000:.1f} мс"
+        lines = [f"{'  ' * indent}{self.name}: {took}"]
+        for child in self.children:
+            lines.extend(child.render(indent + 1))
+        return lines
+
+
+def slow_threshold() -> float:
+    """Порог медленного запроса в секундах (SLOW_REQUEST_THRESHOLD)."""
+    return float(os.getenv("SLOW_REQUEST_THRESHOLD", "1.0"))
+
+
+@contextmanager
+def trace(name: str) -> Iterator[Span]:
+    """Корневой замер: собирает вложенные span() в дерево."""
+    root = Span(name)
+    token = _current_span.set(root)
+    try:
+        yield root
+    finally:
+        root.duration = time.perf_counter() - root.start
+        _current_span.reset(token)
+
+
+@contextmanager
+def span(name: str) -> Iterator[Optional[Span]]:
+    """Вложенный замер; вне trace() ничего не записывает."""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    node = Span(name)
+    parent.children.append(node)
+    token = _current_span.set(node)
+    try:
+        yield node
+    finally:
+        node.duration = time.perf_counter() - node.start
+        _current_span.reset(token)
+
+
+def log_if_slow(root: Span, threshold: Optional[float] = None) -> None:
+    """Пишет в лог разбивку времени, если запрос дольше порога."""
+    threshold = slow_threshold() if threshold is None else threshold
+    if root.duration is None or root.duration < threshold:
+        return
+    lines = root.render()
+    lines.append(f"  (собственное время: {root.self_time * 1000:.1f} мс)")
+    logging.warning("Медленный запрос:\n%s", "\n".join(lines))
@@ -0,0 +1,244 @@
+import logging
+import time
+from array import array
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple
+
+import redis
+
+from tgbot.services.redis_client import get_redis
+from vpn_utils import parse_remark
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+# Сколько часовых и суточных корзин хранится на пользователя.
+HOURS_KEPT = 48
+DAYS_KEPT = 90
+
+
+def owner_of(inbound: dict) -> Optional[int]:
+    """user_id владельца inbound по remark (user_<id>, _pair, _prob)."""
+    parsed = parse_remark(inbound.get("remark"))
+    return parsed[0] if parsed else None
+
+
+def human_bytes(value: float) -> str:
+    """Размер в читаемом виде: 1.5 ГБ."""
+    if value < 1024:
+        return f"{int(value)} Б"
+    for unit in ("КБ", "МБ", "ГБ", "ТБ"):
+        value /= 1024
+        if value < 1024:
+            break
+    return f"{value:.1f} {unit}"
+
+
+class _Series:
+    """Кольцевые буферы трафика пользователя: часы и сутки."""
+
+    __slots__ = ("hours", "hour_stamps", "days", "day_stamps", "total")
+
+    def __init__(self):
+        self.hours = array("Q", [0] * HOURS_KEPT)
+        self.hour_stamps = array("q", [-1] * HOURS_KEPT)
+        self.days = array("Q", [0] * DAYS_KEPT)
+        self.day_stamps = array("q", [-1] * DAYS_KEPT)
+        self.total = 0
+
+    @staticmethod
+    def _bump(values, stamps, index: int, delta: int) -> None:
+        slot = index % len(values)
+        if stamps[slot] != index:
+            stamps[slot] = index
+            values[slot] = 0
+        values[slot] += delta
+
+    def add(self, ts: float, delta: int) -> None:
+        self._bump(self.hours, self.hour_stamps, int(ts // HOUR), delta)
+        self._bump(self.days, self.day_stamps, int(ts // DAY), delta)
+        self.total += delta
+
+    @staticmethod
+    def _window(values, stamps, current: int, size: int) -> int:
+        return sum(
+            value
+            for value, stamp in zip(values, stamps)
+            if current - size < stamp <= current
+        )
+
+    def usage(self, now: float) -> dict:
+        return {
+            "total": self.total,
+            "last_24h": self._window(
+                self.hours, self.hour_stamps, int(now // HOUR), 24
+            ),
+            "last_30d": self._window(
+                self.days, self.day_stamps, int(now // DAY), 30
+            ),
+        }
+
+
+class MemoryTrafficStore:
+    """Временные ряды трафика в памяти процесса."""
+
+    def __init__(self):
+        self._series: Dict[int, _Series] = {}
+        self._last: Dict[str, int] = {}
+
+    def last_counters(self) -> Dict[str, int]:
+        return dict(self._last)
+
+    def ingest(
+        self,
+        deltas: Dict[int, int],
+        counters: Dict[str, int],
+        ts: Optional[float] = None,
+    ) -> None:
+        ts = time.time() if ts is None else ts
+        for user_id, delta in deltas.items():
+            self._series.setdefault(user_id, _Series()).add(ts, delta)
+        self._last = dict(counters)
+
+    def usage(self, user_id: int, now: Optional[float] = None) -> dict:
+        series = self._series.get(int(user_id))
+        if series is None:
+            return {"total": 0, "last_24h": 0, "last_30d": 0}
+        return series.usage(time.time() if now is None else now)
+
+
+def _expired(field: str, hour: int, day: int) -> bool:
+    """Поле h:<час> или d:<сутки> вне хранимого окна."""
+    kind, _, index = field.partition(":")
+    if not index.lstrip("-").isdigit():
+        return False
+    if kind == "h":
+        return int(index) <= hour - HOURS_KEPT
+    return kind == "d" and int(index) <= day - DAYS_KEPT
+
+
+class RedisTrafficStore:
+    """Временные ряды трафика в Redis, общие для всех процессов.
+
+    На пользователя — один hash: total, h:<час> и d:<сутки>. При записи
+    из hash удаляются все поля старше хранимого окна: их значения уже
+    учтены в суточных корзинах, так что часы сворачиваются в сутки без
+    отдельного прохода. Hash живёт DAYS_KEPT суток с последнего
+    прироста: у удалённых и давно неактивных пользователей он истекает.
+    """
+
+    def __init__(self, client: redis.Redis, prefix: str = "vpnbot:traffic"):
+        self.redis = client
+        self.prefix = prefix
+
+    def _key(self, user_id: int) -> str:
+        return f"{self.prefix}:{user_id}"
+
+    def last_counters(self) -> Dict[str, int]:
+        raw = self.redis.hgetall(f"{self.prefix}:last")
+        return {key: int(value) for key, value in raw.items()}
+
+    def ingest(
+        self,
+        deltas: Dict[int, int],
+        counters: Dict[str, int],
+        ts: Optional[float] = None,
+    ) -> None:
+        ts = time.time() if ts is None else ts
+        hour, day = int(ts // HOUR), int(ts // DAY)
+        keys = [self._key(user_id) for user_id in deltas]
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hkeys(key)
+        fields = pipe.execute() if keys else []
+        for key, delta, names in zip(keys, deltas.values(), fields):
+            pipe.hincrby(key, "total", delta)
+            pipe.hincrby(key, f"h:{hour}", delta)
+            pipe.hincrby(key, f"d:{day}", delta)
+            expired = [name for name in names if _expired(name, hour, day)]
+            if expired:
+                pipe.hdel(key, *expired)
+            pipe.expire(key, DAYS_KEPT * DAY)
+        last_key = f"{self.prefix}:last"
+        pipe.delete(last_key)
+        if counters:
+            pipe.hset(last_key, mapping=counters)
+        pipe.execute()
+
+    def usage(self, user_id: int, now: Optional[float] = None) -> dict:
+        now = time.time() if now is None else now
+        hour, day = int(now // HOUR), int(now // DAY)
+        fields = ["total"]
+        fields += [f"h:{hour - i}" for i in range(24)]
+        fields += [f"d:{day - i}" for i in range(30)]
+        raw = self.redis.hmget(self._key(user_id), fields)
+        values = [int(value or 0) for value in raw]
+        return {
+            "total": values[0],
+            "last_24h": sum(values[1:25]),
+            "last_30d": sum(values[25:]),
+        }
+
+
+def compute_deltas(
+    inbounds: Iterable[dict], last: Dict[str, int]
+) -> Tuple[Dict[int, int], Dict[str, int]]:
+    """Прирост трафика по пользователям с прошлого сбора.
+
+    Inbound, которого нет в last (первый сбор, новый inbound), только
+    запоминается: его счётчик — точка отсчёта, а не прирост, иначе весь
+    накопленный объём попал бы в текущий час. Счётчик меньше прошлого —
+    панель его сбросила, и весь текущий объём считается приростом.
+    """
+    deltas: Dict[int, int] = {}
+    counters: Dict[str, int] = {}
+    for inbound in inbounds:
+        user_id = owner_of(inbound)
+        if user_id is None:
+            continue
+        inbound_id = str(inbound.get("id"))
+        current = int(inbound.get("up", 0) or 0) + int(
+            inbound.get("down", 0) or 0
+        )
+        counters[inbound_id] = current
+        previous = last.get(inbound_id)
+        if previous is None:
+            continue
+        delta = current - previous if current >= previous else current
+        if delta:
+            deltas[user_id] = deltas.get(user_id, 0) + delta
+    return deltas, counters
+
+
+class TrafficCollector:
+    """Периодический сбор трафика всех inbound одним запросом к панели."""
+
+    def __init__(self, store, connection_factory):
+        self.store = store
+        self.connection_factory = connection_factory
+
+    def collect(self) -> int:
+        """Один проход сбора; возвращает число пользователей с приростом."""
+        data = self.connection_factory().list_inbounds()
+        if not data.get("success", True) or "obj" not in data:
+            logging.warning("Трафик не собран: панель вернула %s", data)
+            return 0
+        deltas, counters = compute_deltas(
+            data["obj"] or [], self.store.last_counters()
+        )
+        self.store.ingest(deltas, counters)
+        logging.info(
+            "Трафик собран: %s inbound, прирост у %s пользователей",
+            len(counters),
+            len(deltas),
+        )
+        return len(deltas)
+
+
+@lru_cache(maxsize=None)
+def get_traffic_store():
+    """Redis, если он настроен, иначе — память процесса."""
+    client = get_redis()
+    if client is not None:
+        return RedisTrafficStore(client)
+    return MemoryTrafficStore()
@@ -0,0 +1,81 @@
+import threading
+from datetime import date, datetime
+from typing import Dict, Iterable, Optional
+
+# Через сколько дней после прошлого триала можно взять новый.
+TRIAL_COOLDOWN_DAYS = 180
+
+
+def trial_allowed(last_used: Optional[date], today: date) -> bool:
+    """Правило повторного триала: не чаще раза в TRIAL_COOLDOWN_DAYS."""
+    if last_used is None:
+        return True
+    return (today - last_used).days >= TRIAL_COOLDOWN_DAYS
+
+
+class TrialIndex:
+    """user_id -> дата последнего триала, в памяти процесса.
+
+    Проверка по индексу отсекает повторные запросы триала до создания
+    inbound и чтения таблицы. Индекс прогревается из таблицы при старте и
+    обновляется при каждой записи триала; окончательное решение всё
+    равно принимает upsert_trial, так что запись из другой реплики, которую
+    индекс ещё не видел, не приводит к второму триалу.
+    """
+
+    def __init__(self):
+        self._last_used: Dict[int, date] = {}
+        # user_id -> поколение, в котором сделана запись record().
+        self._written: Dict[int, int] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.warmed = False
+
+    def mark(self) -> int:
+        """Начинает поколение; вызывается перед чтением записей для warm."""
+        with self._lock:
+            self._generation += 1
+            return self._generation
+
+    def warm(
+        self,
+        records: Iterable[dict],
+        parse_date,
+        since: Optional[int] = None,
+    ) -> int:
+        """Заполняет индекс из записей подписчиков; возвращает размер.
+
+        Прочитанные записи заменяют индекс целиком, так что очищенный в
+        таблице last_trial_used перестаёт действовать. Поверх них остаются
+        только записи record() начиная с поколения since (mark() перед
+        чтением): они новее прочитанного.
+        """
+        if since is None:
+            since = self.mark()
+        last_used = {}
+        for record in records:
+            user_id = str(record.get("user_id", "")).strip()
+            used = parse_date(record.get("last_trial_used"))
+            if user_id.isdigit() and used:
+                last_used[int(user_id)] = used
+        with self._lock:
+            self._written = {
+                user_id: generation
+                for user_id, generation in self._written.items()
+                if generation >= since
+            }
+            for user_id in self._written:
+                last_used[user_id] = self._last_used[user_id]
+            self._last_used = last_used
+            self.warmed = True
+        return len(last_used)
+
+    def record(self, user_id: int, used_on: date) -> None:
+        with self._lock:
+            self._last_used[int(user_id)] = used_on
+            self._written[int(user_id)] = self._generation
+
+    def is_eligible(self, user_id: int, today: Optional[date] = None) -> bool:
+        """False — пользователь точно брал триал недавно."""
+        today = today or datetime.today().date()
+        return trial_allowed(self._last_used.get(int(user_id)), today)
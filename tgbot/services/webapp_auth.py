@@ -0,0 +1,103 @@
+"""Проверка initData Telegram WebApp.
+
+Клиент передаёт строку initData как есть; подпись — HMAC-SHA256 от
+отсортированных полей на ключе HMAC-SHA256("WebAppData", токен бота).
+Проверенные строки кэшируются по их полю hash: повторные запросы той же
+сессии WebApp не считают HMAC заново, проверяется только срок.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from tgbot.config import get_config
+
+
+class InvalidInitData(Exception):
+    """initData не прошла проверку: подпись, срок или формат."""
+
+
+def validate_init_data(
+    init_data: str,
+    bot_token: str,
+    max_age: float = 86400,
+    now: Optional[float] = None,
+) -> Tuple[Dict[str, Any], int]:
+    """Пользователь из initData и auth_date или InvalidInitData."""
+    try:
+        fields = dict(
+            parse_qsl(init_data, keep_blank_values=True, strict_parsing=True)
+        )
+    except ValueError:
+        raise InvalidInitData("формат")
+    received = fields.pop("hash", "")
+    check = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.new(
+        b"WebAppData", bot_token.encode(), hashlib.sha256
+    ).digest()
+    expected = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received):
+        raise InvalidInitData("подпись")
+    auth_date = int(fields.get("auth_date") or 0)
+    if (now or time.time()) - auth_date > max_age:
+        raise InvalidInitData("срок")
+    try:
+        user = json.loads(fields.get("user") or "{}")
+        int(user["id"])
+    except (ValueError, TypeError, KeyError):
+        raise InvalidInitData("user")
+    return user, auth_date
+
+
+class InitDataValidator:
+    """Проверка initData с LRU-кэшем проверенных строк по их hash.
+
+    В кэше хранится и сама строка: запрос с тем же hash, но другими
+    полями, проверяется заново и отклоняется.
+    """
+
+    def __init__(
+        self, bot_token: str, max_age: float = 86400, maxsize: int = 10000
+    ):
+        self.bot_token = bot_token
+        self.max_age = max_age
+        self.maxsize = maxsize
+        self._cache: "OrderedDict[str, Tuple[str, dict, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def validate(self, init_data: str) -> Dict[str, Any]:
+        """Пользователь Telegram (id, username, …) или InvalidInitData."""
+        key = dict(parse_qsl(init_data)).get("hash", "")
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+        if cached is not None and cached[0] == init_data:
+            _, user, auth_date = cached
+            if time.time() - auth_date > self.max_age:
+                raise InvalidInitData("срок")
+            return user
+        user, auth_date = validate_init_data(
+            init_data, self.bot_token, self.max_age
+        )
+        with self._lock:
+            self._cache[key] = (init_data, user, auth_date)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return user
+
+
+@lru_cache(maxsize=None)
+def get_init_data_validator() -> InitDataValidator:
+    return InitDataValidator(
+        get_config().tg_bot.token,
+        max_age=float(os.getenv("INIT_DATA_MAX_AGE", "86400")),
+    )
@@ -3,53 +3,156 @@ import json
 import logging
 import os
 import random
+import re
 import string
 import uuid
-from typing import Any, Dict, Optional, Union
+from collections import deque
+from typing import (
+    Any,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import requests
 from dotenv import load_dotenv
 
-load_dotenv()
+from tgbot.services.metrics import instrument
+from tgbot.services.resilience import CircuitOpen, get_policy
 
-LOGIN = os.getenv("LOGIN")
+_REMARK_RE = re.compile(r"^user_(\d+)(?:_(pair|prob))?$")
 
-PASSWORD = os.getenv("PASSWORD")
 
-HOST = os.getenv("HOST", "").rstrip("/")
+def parse_remark(remark: str) -> Optional[Tuple[int, str]]:
+    """Владелец и вид inbound по remark: (user_id, main|pair|prob)."""
+    match = _REMARK_RE.match(str(remark or ""))
+    if not match:
+        return None
+    return int(match.group(1)), match.group(2) or "main"
+
+
+def inbound_client_ids(inbound: Dict[str, Any]) -> Set[str]:
+    """UUID клиентов inbound из его settings."""
+    try:
+        settings = json.loads(inbound.get("settings") or "{}")
+    except (TypeError, ValueError):
+        return set()
+    return {
+        str(client.get("id"))
+        for client in settings.get("clients", [])
+        if client.get("id")
+    }
+
+
+class PortPool:
+    """Диапазон портов для новых inbound.
+
+    Порты, освобождённые сборкой устаревших inbound, выдаются в первую
+    очередь, остальные — случайно из свободной части диапазона.
+    """
+
+    def __init__(self, first: int = 50102, last: int = 52999):
+        self.first = first
+        self.last = last
+        self._released: Deque[int] = deque()
+
+    def __contains__(self, port: int) -> bool:
+        return self.first <= port <= self.last
+
+    def release(self, ports: Iterable[int]) -> None:
+        """Возвращает порты удалённых inbound в пул."""
+        self._released.extend(port for port in ports if port in self)
+
+    def free_count(self, used: Set[int]) -> int:
+        taken = sum(1 for port in used if port in self)
+        return self.last - self.first + 1 - taken
+
+    def allocate(self, used: Set[int]) -> Optional[int]:
+        """Свободный порт с учётом занятых на панели; None — их нет."""
+        while self._released:
+            port = self._released.popleft()
+            if port not in used:
+                return port
+        for _ in range(20):
+            port = random.randint(self.first, self.last)
+            if port not in used:
+                return port
+        free = [p for p in range(self.first, self.last + 1) if p not in used]
+        return random.choice(free) if free else None
+
+
+PORT_POOL = PortPool()
+
+
+class PanelUnavailable(requests.ConnectionError):
+    """Автомат панели разомкнут; запрос не отправлялся."""
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="[%(asctime)s] %(levelname)s — %(message)s",
-    datefmt="%Y-%m-%d %H:%M:%S",
-)
+
+class PanelError(Exception):
+    """Панель доступна, но операция не удалась: повтор сразу не поможет."""
+
+
+def panel_available() -> bool:
+    """False — панель недавно отказывала и запросы к ней отклоняются."""
+    return not get_policy("xui").breaker.is_open
 
 
 class Connection:
     """Класс для работы с API панели X-ray"""
 
     def __init__(
-        self, login: str = LOGIN, password: str = PASSWORD, host: str = HOST
+        self,
+        login: Optional[str] = None,
+        password: Optional[str] = None,
+        host: Optional[str] = None,
     ):
-        self.login = login
-        self.password = password
-        self.host = host
+        self.login = login if login is not None else os.getenv("LOGIN")
+        self.password = (
+            password if password is not None else os.getenv("PASSWORD")
+        )
+        if host is None:
+            host = os.getenv("HOST", "")
+        self.host = host.rstrip("/")
         self.ses = requests.Session()
         self.token: Optional[str] = None
 
+    def _post(
+        self, path: str, data: Any = None, idempotent: bool = False
+    ) -> requests.Response:
+        """POST к панели через автомат и адаптивный таймаут политики xui.
+
+        Повторяются только идемпотентные запросы: повтор добавления
+        клиента или inbound создал бы дубликат. При разомкнутом автомате
+        бросает PanelUnavailable сразу, без сетевого запроса.
+        """
+        try:
+            return get_policy("xui").call(
+                lambda timeout: self.ses.post(
+                    f"{self.host}{path}", json=data, timeout=timeout
+                ),
+                idempotent=idempotent,
+                is_failure=lambda response: response.status_code >= 500,
+            )
+        except CircuitOpen as e:
+            raise PanelUnavailable(f"панель недоступна ({e})") from e
+
     def ensure_login(self) -> bool:
         """Проверка авторизации"""
         if self.token:
             return True
         return self.login_api()
 
+    @instrument("xui", falsy_is_error=True)
     def login_api(self) -> bool:
         """Авторизация в API. Сохраняет токен в self.token."""
         data = {"username": self.login, "password": self.password}
         try:
-            response = self.ses.post(
-                f"{self.host}/login", json=data, timeout=10
-            )
+            response = self._post("/login", data, idempotent=True)
             response.raise_for_status()
         except requests.RequestException as e:
             logging.error("Ошибка сети при авторизации: %s", e)
@@ -69,20 +172,20 @@ class Connection:
         logging.error("Ошибка авторизации: %s", res_json)
         return False
 
+    @instrument("xui", falsy_is_error=True)
     def list_inbounds(self) -> Dict[str, Any]:
         """Возвращает список подключений"""
         if not self.ensure_login():
             return {}
         try:
-            response = self.ses.post(
-                f"{self.host}/panel/inbound/list", json={}, timeout=10
-            )
+            response = self._post("/panel/inbound/list", {}, idempotent=True)
             response.raise_for_status()
             return response.json()
         except requests.RequestException as e:
             logging.error("Ошибка сети при запросе inbound list: %s", e)
             return {}
 
+    @instrument("xui", falsy_is_error=True)
     def add_client(self, days: int) -> Optional[str]:
         """Создаёт нового клиента с UUID"""
         if not self.ensure_login():
@@ -115,9 +218,7 @@ class Connection:
 
         logging.info("Добавляется клиент с UUID: %s", client_uuid)
         try:
-            response = self.ses.post(
-                f"{self.host}/addClient", json=data, timeout=10
-            )
+            response = self._post("/addClient", data)
             if response.status_code == 200:
                 logging.info("Клиент успешно создан ✅")
                 return client_uuid
@@ -157,29 +258,49 @@ class Connection:
             "Inbounds:\n%s", json.dumps(data, indent=2, ensure_ascii=False)
         )
 
-    def create_inbound(
-        self, user_id: int, is_trial: bool = False
-    ) -> Optional[Dict[str, Any]]:
-        """Создаёт новое подключение для пользователя"""
-        if not self.ensure_login():
-            return None
+    def allocate_ports(self, count: int = 1) -> List[int]:
+        """count разных свободных портов по одному списку inbound.
 
+        Пустой список — панель недоступна или портов не хватает.
+        """
         existing = self.list_inbounds().get("obj", [])
         used_ports = {
             int(inb.get("port"))
             for inb in existing
             if str(inb.get("port", "")).isdigit()
         }
+        ports = []
+        for _ in range(count):
+            port = PORT_POOL.allocate(used_ports)
+            if port is None:
+                logging.error("Свободных портов для inbound не осталось")
+                PORT_POOL.release(ports)
+                return []
+            used_ports.add(port)
+            ports.append(port)
+        return ports
+
+    @instrument("xui", falsy_is_error=True)
+    def create_inbound(
+        self,
+        user_id: int,
+        is_trial: bool = False,
+        port: Optional[int] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """Создаёт новое подключение для пользователя.
 
-        # Поиск свободного порта
-        for _ in range(20):
-            port = random.randint(50102, 52999)
-            if port not in used_ports:
-                break
-        else:
-            logging.error("Не удалось найти свободный порт после 20 попыток")
+        port — заранее выделенный allocate_ports; без него порт
+        выбирается по текущему списку inbound.
+        """
+        if not self.ensure_login():
             return None
 
+        if port is None:
+            ports = self.allocate_ports()
+            if not ports:
+                return None
+            port = ports[0]
+
         client_uuid = str(uuid.uuid4())
         sub_id = "".join(
             random.choices(string.ascii_lowercase + string.digits, k=16)
@@ -268,16 +389,14 @@ class Connection:
         }
 
         try:
-            response = self.ses.post(
-                f"{self.host}/panel/api/inbounds/add", json=payload, timeout=10
-            )
+            response = self._post("/panel/api/inbounds/add", payload)
             if response.status_code == 200:
                 logging.info(
                     "Inbound создан для user_id=%s на порту %s ✅",
                     user_id,
                     port,
                 )
-                return {"uuid": client_uuid, "port": port}
+                return {"uuid": client_uuid, "port": port, "sub_id": sub_id}
             logging.error(
                 "Ошибка создания inbound: %s — %s",
                 response.status_code,
@@ -287,17 +406,26 @@ class Connection:
             logging.error("Сетевая ошибка при создании inbound: %s", e)
         return None
 
+    @instrument("xui", falsy_is_error=True)
     def update_client(self, client_uuid: str, days: int = 30) -> bool:
         """Продлевает существующего клиента на days дней."""
-        if not self.ensure_login():
-            return False
-
         expiry_time = int(
             (
                 datetime.datetime.utcnow() + datetime.timedelta(days=days)
             ).timestamp()
             * 1000
         )
+        return self._set_expiry(client_uuid, expiry_time)
+
+    @instrument("xui", falsy_is_error=True)
+    def set_client_expiry(self, client_uuid: str, expiry_time: int) -> bool:
+        """Ставит клиенту срок действия expiry_time (мс с эпохи)."""
+        return self._set_expiry(client_uuid, expiry_time)
+
+    def _set_expiry(self, client_uuid: str, expiry_time: int) -> bool:
+        if not self.ensure_login():
+            return False
+
         data = {
             "uuid": client_uuid,
             "expiryTime": expiry_time,
@@ -305,8 +433,8 @@ class Connection:
             "enable": True,
         }
         try:
-            response = self.ses.post(
-                f"{self.host}/panel/api/client/update", json=data, timeout=10
+            response = self._post(
+                "/panel/api/client/update", data, idempotent=True
             )
             if response.status_code == 200:
                 logging.info(
@@ -318,7 +446,109 @@ class Connection:
             logging.error("Сетевая ошибка при продлении клиента: %s", e)
         return False
 
+    @instrument("xui", falsy_is_error=True)
+    def update_inbound(self, inbound: Dict[str, Any]) -> bool:
+        """Сохраняет inbound целиком (панель принимает только полный)."""
+        if not self.ensure_login():
+            return False
+        payload = {k: v for k, v in inbound.items() if k != "clientStats"}
+        try:
+            response = self._post(
+                f"/panel/api/inbounds/update/{inbound['id']}",
+                payload,
+                idempotent=True,
+            )
+            if response.status_code == 200:
+                return True
+            logging.error(
+                "Ошибка обновления inbound %s: %s",
+                inbound.get("id"),
+                response.text,
+            )
+        except requests.RequestException as e:
+            logging.error("Сетевая ошибка при обновлении inbound: %s", e)
+        return False
+
+    @instrument("xui", falsy_is_error=True)
+    def delete_inbound(self, inbound_id: int) -> bool:
+        """Удаляет inbound вместе с его клиентами."""
+        if not self.ensure_login():
+            return False
+        try:
+            response = self._post(
+                f"/panel/api/inbounds/del/{inbound_id}", idempotent=True
+            )
+            if response.status_code == 200:
+                return True
+            logging.error(
+                "Ошибка удаления inbound %s: %s", inbound_id, response.text
+            )
+        except requests.RequestException as e:
+            logging.error("Сетевая ошибка при удалении inbound: %s", e)
+        return False
+
+    def discard_inbounds(self, created: Iterable[Dict[str, Any]]) -> int:
+        """Удаляет inbound, созданные create_inbound, но не выданные.
+
+        created — результаты create_inbound; inbound ищется по порту и
+        UUID клиента. Возвращает число удалённых.
+        """
+        wanted = {(result["port"], result["uuid"]) for result in created}
+        deleted = 0
+        for inbound in self.list_inbounds().get("obj") or []:
+            clients = inbound_client_ids(inbound)
+            if any(
+                port == inbound.get("port") and uuid in clients
+                for port, uuid in wanted
+            ) and self.delete_inbound(inbound["id"]):
+                deleted += 1
+        return deleted
+
+    def set_inbound_enabled(
+        self, inbound: Dict[str, Any], enabled: bool
+    ) -> bool:
+        """Включает или выключает inbound на панели."""
+        return self.update_inbound({**inbound, "enable": enabled})
+
+    def set_user_inbounds_enabled(
+        self,
+        user_id: Union[int, str],
+        enabled: bool,
+        client_ids: Iterable[str] = (),
+    ) -> int:
+        """Включает или выключает inbound пользователя.
+
+        Выключаются все его inbound. Включаются inbound с текущими
+        клиентами client_ids (client_uuid и client_uuid_pair), включая
+        пробный, если продление шло через его клиента.
+
+        Возвращает число inbound, у которых изменилось состояние.
+        """
+        remarks = {
+            f"user_{user_id}",
+            f"user_{user_id}_pair",
+            f"user_{user_id}_prob",
+        }
+        current = {str(client) for client in client_ids if client}
+        changed = 0
+        for inbound in self.list_inbounds().get("obj") or []:
+            if inbound.get("remark") not in remarks:
+                continue
+            if enabled and not current & inbound_client_ids(inbound):
+                continue
+            if bool(inbound.get("enable")) == enabled:
+                continue
+            if self.set_inbound_enabled(inbound, enabled):
+                changed += 1
+        return changed
+
 
 if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s — %(message)s",
+        datefmt="%Y-%m-%d %H:%M:%S",
+    )
     x3 = Connection()
     x3.print_inbounds()